@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# Default location of the registry database.
+DEFAULT_REGISTRY_PATH = os.path.expanduser("~/.code_executor_agents.sqlite3")
+
+# Agents not used for this long are torn down by gc().
+MAX_IDLE_SECONDS = 7 * 24 * 60 * 60
+
+# Alias statuses of agents that will not become usable again, gc() tears them down once they are idle.
+# Agents in other states (CREATING, UPDATING, ...) may be in use or in progress and are left alone.
+BROKEN_STATUSES = ("FAILED", "NOT_PREPARED")
+
+
+def config_hash(config):
+    """
+    Returns a stable hash of an agent configuration.
+
+    :param config: The configuration, e.g. foundation model, instruction and action group signature.
+    :return: The hex digest of the canonicalized configuration.
+    """
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class AgentRegistry:
+    """
+    Local SQLite registry of provisioned Bedrock agents, keyed by the hash of their configuration.
+    CodeExecutorAgent looks up a prepared agent here before provisioning a new one.
+    """
+
+    def __init__(self, path=DEFAULT_REGISTRY_PATH):
+        """
+        :param path: Path of the SQLite database.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS agents ("
+            "agent_id TEXT PRIMARY KEY, config_hash TEXT NOT NULL, agent_name TEXT NOT NULL, "
+            "agent_alias_id TEXT NOT NULL, role_name TEXT NOT NULL, policy_name TEXT NOT NULL, "
+            "role_arn TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS agents_by_config ON agents (config_hash, last_used_at)"
+        )
+        self._db.commit()
+
+    def register(self, record):
+        """
+        Adds a prepared agent to the registry.
+
+        :param record: Dict with config_hash, agent_id, agent_name, agent_alias_id, role_name,
+                       policy_name and role_arn.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO agents VALUES "
+                "(:agent_id, :config_hash, :agent_name, :agent_alias_id, :role_name, :policy_name, "
+                ":role_arn, :created_at, :last_used_at)",
+                dict(record, created_at=now, last_used_at=now),
+            )
+            self._db.commit()
+
+    def candidates(self, config_hash):
+        """
+        :param config_hash: The hash of the agent configuration.
+        :return: The registered agents with this configuration, least recently used first.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM agents WHERE config_hash = ? ORDER BY last_used_at",
+                (config_hash,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def touch(self, agent_id):
+        """
+        Marks the agent as used, so the warm pool is used round-robin and gc() keeps it.
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE agents SET last_used_at = ? WHERE agent_id = ?",
+                (time.time(), agent_id),
+            )
+            self._db.commit()
+
+    def remove(self, agent_id):
+        with self._lock:
+            self._db.execute("DELETE FROM agents WHERE agent_id = ?", (agent_id,))
+            self._db.commit()
+
+    def records(self):
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM agents ORDER BY last_used_at").fetchall()
+        return [dict(row) for row in rows]
+
+    def gc(self, bedrock_agent, iam, max_idle_seconds=MAX_IDLE_SECONDS):
+        """
+        Tears down the agents that were not used for max_idle_seconds and are prepared or broken (see
+        BROKEN_STATUSES), and removes them from the registry. Agents whose alias no longer exists are removed
+        right away, agents in a transitional state are kept.
+
+        :param bedrock_agent: A bedrock-agent client.
+        :param iam: An IAM client.
+        :param max_idle_seconds: The maximum idle time of an agent.
+        :return: The IDs of the removed agents.
+        """
+        removed = []
+        now = time.time()
+        for record in self.records():
+            status = alias_status(bedrock_agent, record)
+            idle = now - record["last_used_at"] > max_idle_seconds
+            if status is None or (idle and status in ("PREPARED",) + BROKEN_STATUSES):
+                print(f"Tearing down agent {record['agent_name']} ({record['agent_id']})...")
+                teardown(bedrock_agent, iam, record)
+                self.remove(record["agent_id"])
+                removed.append(record["agent_id"])
+        return removed
+
+
+def alias_status(bedrock_agent, record):
+    """
+    :return: The status of the agent's alias, e.g. PREPARED or UPDATING, or None if it no longer exists.
+    """
+    # Imported on use, so importing the registry (and the code executor agent) does not load botocore
+    from botocore.exceptions import ClientError
+
+    try:
+        response = bedrock_agent.get_agent_alias(
+            agentId=record["agent_id"], agentAliasId=record["agent_alias_id"]
+        )
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "ResourceNotFoundException":
+            return None
+        raise
+    return response["agentAlias"]["agentAliasStatus"]
+
+
+def is_prepared(bedrock_agent, record):
+    """
+    Checks whether the agent's alias still exists and is prepared.
+    """
+    return alias_status(bedrock_agent, record) == "PREPARED"
+
+
+def teardown(bedrock_agent, iam, record):
+    """
+    Deletes the agent, its alias, and its IAM role and policy. Resources that are already gone are skipped.
+    """
+    from botocore.exceptions import ClientError
+
+    steps = [
+        lambda: bedrock_agent.delete_agent_alias(
+            agentId=record["agent_id"], agentAliasId=record["agent_alias_id"]
+        ),
+        lambda: bedrock_agent.delete_agent(
+            agentId=record["agent_id"], skipResourceInUseCheck=True
+        ),
+        lambda: iam.delete_role_policy(
+            RoleName=record["role_name"], PolicyName=record["policy_name"]
+        ),
+        lambda: iam.delete_role(RoleName=record["role_name"]),
+    ]
+    for step in steps:
+        try:
+            step()
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in ("ResourceNotFoundException", "NoSuchEntity"):
+                raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the registry of prepared code executor agents.")
+    parser.add_argument("--registry", default=DEFAULT_REGISTRY_PATH, help="Path of the registry database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the registered agents.")
+    gc_parser = commands.add_parser("gc", help="Tear down stale agents.")
+    gc_parser.add_argument("--max-idle-hours", type=float, default=MAX_IDLE_SECONDS / 3600)
+    warm_parser = commands.add_parser("warm", help="Keep a number of prepared agents ready.")
+    warm_parser.add_argument("--size", type=int, required=True)
+    warm_parser.add_argument("--agent-name", default="code-agent")
+    args = parser.parse_args()
+
+    registry = AgentRegistry(args.registry)
+    if args.command == "list":
+        for record in registry.records():
+            print(json.dumps(record))
+    elif args.command == "gc":
+        import boto3
+
+        removed = registry.gc(
+            boto3.client(service_name="bedrock-agent", region_name="us-east-1"),
+            boto3.client("iam"),
+            max_idle_seconds=args.max_idle_hours * 3600,
+        )
+        print(f"Removed {len(removed)} agent(s).")
+    elif args.command == "warm":
+        from code_executor_agent import CodeExecutorAgent
+
+        agents = CodeExecutorAgent.warm_pool(registry, args.size, args.agent_name)
+        print(f"{len(agents)} agent(s) ready.")
@@ -0,0 +1,235 @@
+"""
+Runs BackendWriter conversations for a JSONL file of prompts on a pool of worker processes.
+
+Every input line is a JSON object with a "prompt" and an optional "id" (the line number otherwise).
+Results are appended to the output JSONL as they complete, one line per prompt with its final code,
+S3 location, turn count and timings. The output file is the checkpoint: prompts that already have a
+successful result are skipped when the run is started again, failed prompts are retried.
+
+    python batch_runner.py prompts.jsonl results.jsonl --workers 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import save_to_s3_tool as SaveToS3_tool
+import tool_usage
+from utils import instrumentation
+from utils.rate_limiter import limiter as bedrock_limiter
+
+# Prompts submitted to the pool ahead of the free workers, per worker.
+PREFETCH_PER_WORKER = 2
+
+# The writer, turn limit and latency budget of the current worker process, and the span totals of the running prompt.
+_writer = None
+_max_turns = tool_usage.MAX_RECURSIONS
+_budget = None
+_totals = {}
+
+
+def read_prompts(path):
+    """
+    :param path: The input JSONL file.
+    :return: The (id, prompt) pairs, in file order.
+    """
+    prompts = []
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            prompts.append((str(record.get("id", f"line-{line_number}")), record["prompt"]))
+    return prompts
+
+
+def completed_ids(path):
+    """
+    Reads the checkpoint: the IDs of prompts with a successful result in the output file, i.e. a
+    conversation with the status complete. Other results are run again, and a line cut short by an
+    interrupted run is ignored.
+
+    :param path: The output JSONL file.
+    :return: The set of completed IDs.
+    """
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == tool_usage.ConversationStatus.COMPLETE.value:
+                completed.add(result["id"])
+    return completed
+
+
+def _collect(event):
+    """Instrumentation consumer adding up the spans of the running prompt."""
+    if event["type"] != "span_end" or event["name"] not in ("model_call", "tool", "s3_save"):
+        return
+    _totals[f"{event['name']}_ms"] = _totals.get(f"{event['name']}_ms", 0.0) + event["duration_ms"]
+    _totals[f"{event['name']}s"] = _totals.get(f"{event['name']}s", 0) + 1
+    for tokens in ("input_tokens", "output_tokens"):
+        if tokens in event:
+            _totals[tokens] = _totals.get(tokens, 0) + event[tokens]
+
+
+def _init_worker(workers, max_turns, budget, writer_options):
+    """
+    Creates the writer of a worker process. The process-wide quotas are split between the workers,
+    so all of them together stay within the account's quotas.
+    """
+    global _writer, _max_turns, _budget
+    logging.getLogger().setLevel(logging.WARNING)
+    instrumentation.subscribe(_collect)
+    for model_id, rate in tool_usage.MODEL_REQUESTS_PER_SECOND.items():
+        bedrock_limiter.set_quota(model_id, rate / workers)
+    if writer_options.pop("router", False):
+        writer_options["router"] = tool_usage.default_model_router()
+    _writer = tool_usage.BackendWriter(**writer_options)
+    _max_turns = max_turns
+    _budget = budget
+
+
+def _s3_location(conversation):
+    """The S3 location of the code saved last in the conversation, or None."""
+    location = None
+    for message in conversation:
+        for content_block in message["content"]:
+            tool_result = content_block.get("toolResult")
+            if tool_result is None:
+                continue
+            for content in tool_result["content"]:
+                response = content.get("json")
+                if isinstance(response, dict) and "key" in response:
+                    location = {
+                        "bucket": SaveToS3_tool.get_bucket_name(),
+                        "key": response["key"],
+                        "sha256": response.get("sha256"),
+                    }
+    return location
+
+
+def _run_prompt(prompt_id, prompt):
+    """Runs one conversation in a worker process and returns its result line."""
+    _totals.clear()
+    start = time.perf_counter()
+    try:
+        done = tool_usage._run_coroutine(_writer.run_async(prompt, max_turns=_max_turns, budget=_budget))
+    except Exception as error:
+        return {
+            "id": prompt_id,
+            "error": f"{type(error).__name__}: {error}",
+            "timings": dict(_totals, seconds=time.perf_counter() - start),
+        }
+    return {
+        "id": prompt_id,
+        "status": done["status"],
+        "turns": done["turns"],
+        "resulting_code": done["resulting_code"],
+        "s3": _s3_location(done["conversation"]),
+        "timings": dict(_totals, seconds=time.perf_counter() - start),
+    }
+
+
+def run_batch(input_path, output_path, workers=None, max_turns=tool_usage.MAX_RECURSIONS, budget=None,
+              **writer_options):
+    """
+    Runs all prompts of the input file that have no successful result in the output file yet.
+
+    :param input_path: The input JSONL file with the prompts.
+    :param output_path: The output JSONL file, results are appended.
+    :param workers: The number of worker processes, defaults to the number of CPUs.
+    :param max_turns: The maximum number of model turns per conversation.
+    :param budget: Optional latency budget per conversation in seconds, a conversation that runs out of it
+                   has the status deadline_exceeded.
+    :param writer_options: Further arguments of the BackendWriter, e.g. write_behind=True, or
+                           router=True for the default model router.
+    :return: The number of succeeded (complete) and failed prompts of this run, a conversation that ends with
+             another status counts as failed and is run again on the next run.
+    """
+    workers = workers or os.cpu_count() or 1
+    completed = completed_ids(output_path)
+    pending = [(prompt_id, prompt) for prompt_id, prompt in read_prompts(input_path) if prompt_id not in completed]
+    print(f"{len(completed)} prompt(s) already done, {len(pending)} to run on {workers} worker(s).")
+
+    succeeded = failed = 0
+    queue = iter(pending)
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(workers, max_turns, budget, writer_options),
+    )
+    interrupted = False
+    try:
+        with open(output_path, "a", encoding="utf-8") as results:
+            # Terminate a line cut short by an interrupted run, so the next result starts on its own line
+            if results.tell() > 0:
+                with open(output_path, "rb") as file:
+                    file.seek(-1, os.SEEK_END)
+                    if file.read(1) != b"\n":
+                        results.write("\n")
+
+            running = set()
+            while True:
+                # Only a few prompts are queued ahead, so an interrupted run loses little work
+                while len(running) < workers * PREFETCH_PER_WORKER:
+                    item = next(queue, None)
+                    if item is None:
+                        break
+                    running.add(executor.submit(_run_prompt, *item))
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results.write(json.dumps(result) + "\n")
+                    results.flush()
+                    if "error" in result:
+                        failed += 1
+                        print(f"{result['id']}: failed, {result['error']}")
+                    else:
+                        if result["status"] == tool_usage.ConversationStatus.COMPLETE.value:
+                            succeeded += 1
+                        else:
+                            failed += 1
+                        print(f"{result['id']}: {result['status']} after {result['turns']} turn(s), "
+                              f"{result['timings']['seconds']:.1f}s")
+    except KeyboardInterrupt:
+        # The queued prompts are cancelled and the running ones are not waited for
+        interrupted = True
+        print("Interrupted, run again to resume.")
+        raise
+    finally:
+        executor.shutdown(wait=not interrupted, cancel_futures=interrupted)
+    return succeeded, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run BackendWriter conversations for a JSONL file of prompts.")
+    parser.add_argument("input", help="JSONL file with one {\"id\": ..., \"prompt\": ...} object per line.")
+    parser.add_argument("output", help="JSONL file the results are appended to, also the checkpoint.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes, defaults to the CPUs.")
+    parser.add_argument("--max-turns", type=int, default=tool_usage.MAX_RECURSIONS)
+    parser.add_argument("--budget", type=float, default=None, help="Latency budget per prompt in seconds.")
+    parser.add_argument("--write-behind", action="store_true", help="Upload the code in the background.")
+    parser.add_argument("--router", action="store_true", help="Route the model calls, see model_router.py.")
+    args = parser.parse_args()
+
+    succeeded, failed = run_batch(
+        args.input,
+        args.output,
+        workers=args.workers,
+        max_turns=args.max_turns,
+        budget=args.budget,
+        write_behind=args.write_behind,
+        router=args.router,
+    )
+    print(f"Done: {succeeded} succeeded, {failed} failed.")
+    raise SystemExit(1 if failed else 0)
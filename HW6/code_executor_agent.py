@@ -1,17 +1,43 @@
-import boto3
 import json
 import time, random 
 import uuid, string
-import matplotlib.pyplot as plt
-import io
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-class CodeExecutorAgent:
-    def __init__(self, agent_name):
-        self.region_name = 'us-east-1'
-        self.bedrock_agent = boto3.client(service_name = 'bedrock-agent', region_name = self.region_name)
-        self.iam = boto3.client('iam')
-        self.agentName = agent_name#'code-interpreter-test-agent'
-        self.instruction = """
+from agent_registry import config_hash, is_prepared
+from utils import deadline
+from utils.deadline import DeadlineExceeded
+from utils.instrumentation import span
+from utils.rate_limiter import limiter as bedrock_limiter
+from utils.waiters import wait_for
+
+# Deadline in seconds for every wait on the provisioning of an agent.
+PROVISIONING_TIMEOUT = 300
+
+# Maximum number of agents provisioned at the same time by CodeExecutorAgent.provision_many.
+MAX_PROVISIONING_WORKERS = 8
+
+# Number of bedrock-agent-runtime clients shared round-robin by all agents in the process.
+RUNTIME_CLIENT_POOL_SIZE = 4
+
+# Maximum number of sessions of one agent that are invoked at the same time.
+MAX_SESSIONS = 16
+
+# Requests per second to the bedrock-agent control plane (the provisioning polls) and to invoke_agent,
+# shared by all agents in the process. Match these to the service quotas of the account.
+CONTROL_PLANE_QUOTA = 'bedrock-agent'
+CONTROL_PLANE_REQUESTS_PER_SECOND = 5
+INVOKE_AGENT_QUOTA = 'bedrock-agent-runtime'
+INVOKE_AGENT_REQUESTS_PER_SECOND = 100 / 60
+
+bedrock_limiter.set_quota(CONTROL_PLANE_QUOTA, CONTROL_PLANE_REQUESTS_PER_SECOND)
+bedrock_limiter.set_quota(INVOKE_AGENT_QUOTA, INVOKE_AGENT_REQUESTS_PER_SECOND)
+
+REGION_NAME = 'us-east-1'
+FOUNDATION_MODEL = 'anthropic.claude-3-sonnet-20240229-v1:0'
+INSTRUCTION = """
         You are an advanced AI agent with the capability to execute Python code. Here are your tasks:
 
             1. Execute the provided Python code exactly as given.
@@ -19,14 +45,211 @@ class CodeExecutorAgent:
             3. After correcting the code, test it to ensure it works as expected.
             4. Return the final executed code, or if not possible to correct after 5 attempts, return the best attempt with a note on remaining issues.
                         """
-        self.foundationModel = 'anthropic.claude-3-sonnet-20240229-v1:0'
+
+# Everything that makes two agents interchangeable, agents with the same hash are reused from the registry.
+AGENT_CONFIG = {
+    'region': REGION_NAME,
+    'foundationModel': FOUNDATION_MODEL,
+    'instruction': INSTRUCTION,
+    'actionGroups': ['AMAZON.CodeInterpreter'],
+}
+
+_runtime_clients = []
+_runtime_clients_lock = threading.Lock()
+_next_runtime_client = itertools.count()
+
+
+def _client(service_name):
+    """
+    Creates a boto3 client, boto3 is imported on first use so importing this module stays cheap.
+    """
+    import boto3
+
+    return boto3.client(service_name=service_name, region_name=REGION_NAME)
+
+
+def _runtime_client():
+    """
+    Returns one of the process-wide bedrock-agent-runtime clients, they are created on first use.
+    """
+    with _runtime_clients_lock:
+        if not _runtime_clients:
+            _runtime_clients.extend(
+                _client('bedrock-agent-runtime')
+                for _ in range(RUNTIME_CLIENT_POOL_SIZE)
+            )
+        return _runtime_clients[next(_next_runtime_client) % len(_runtime_clients)]
+
+
+class _SessionSlots:
+    """
+    Bounds the number of sessions of an agent in use at the same time. Every lease gets a new session ID,
+    session IDs are client-side UUIDs, so no agent context is carried over between unrelated invocations.
+    """
+
+    def __init__(self, max_sessions):
+        self._slots = threading.BoundedSemaphore(max_sessions)
+
+    @contextmanager
+    def lease(self):
+        with self._slots:
+            yield str(uuid.uuid4())
+
+
+class CodeExecutorAgent:
+    def __init__(self, agent_name, bedrock_agent_client=None, iam_client=None, registry=None, reuse=True,
+                 runtime_client=None, max_sessions=MAX_SESSIONS):
+        """
+        :param agent_name: The name prefix of the agent.
+        :param bedrock_agent_client: Optional bedrock-agent client.
+        :param iam_client: Optional IAM client.
+        :param registry: Optional agent_registry.AgentRegistry. A prepared agent with the same configuration
+                         is reused from it, and newly provisioned agents are added to it.
+        :param reuse: If False, a new agent is provisioned even if the registry has a matching one.
+        :param runtime_client: Optional bedrock-agent-runtime client for invoke() and stream(),
+                               by default a client from the process-wide pool is used per call.
+        :param max_sessions: The maximum number of concurrent invocations of this agent.
+        """
+        self.region_name = REGION_NAME
+        self.bedrock_agent = bedrock_agent_client or _client('bedrock-agent')
+        self.iam = iam_client or _client('iam')
+        self.agentName = agent_name#'code-interpreter-test-agent'
+        self.instruction = INSTRUCTION
+        self.foundationModel = FOUNDATION_MODEL
+        self.configHash = config_hash(AGENT_CONFIG)
         self.randomSuffix = "".join(
             random.choices(string.ascii_uppercase + string.digits, k=5)
         )
-        self.roles_and_policies()
-        self.create_agent()
-        self.configure_code_interpreter()
-        self.prepare_agent()
+        self.runtimeClient = runtime_client
+        self.sessions = _SessionSlots(max_sessions)
+        # Seconds spent in each provisioning phase
+        self.timings = {}
+
+        if registry is not None and reuse:
+            with self._phase('registry_lookup'):
+                reused = self._reuse_from(registry)
+            if reused:
+                print(f"Reusing agentId: {self.agentId}, agentAliasId: {self.agentAliasId}")
+                return
+
+        # The inline role policy is attached in the background while the agent is being created
+        with ThreadPoolExecutor(max_workers=1) as self._background:
+            with self._phase('roles_and_policies'):
+                self.roles_and_policies()
+            with self._phase('create_agent'):
+                self.create_agent()
+            with self._phase('configure_code_interpreter'):
+                self.configure_code_interpreter()
+            with self._phase('prepare_agent'):
+                self.prepare_agent()
+
+        print("Provisioning timings: " + ", ".join(
+            f"{phase} {seconds:.1f}s" for phase, seconds in self.timings.items()
+        ))
+
+        if registry is not None:
+            registry.register({
+                'config_hash': self.configHash,
+                'agent_id': self.agentId,
+                'agent_name': self.agentName,
+                'agent_alias_id': self.agentAliasId,
+                'role_name': self.roleName,
+                'policy_name': self.policyName,
+                'role_arn': self.roleArn,
+            })
+
+    @classmethod
+    def provision_many(cls, agent_names, max_workers=MAX_PROVISIONING_WORKERS, **kwargs):
+        """
+        Provisions several agents concurrently. The boto3 clients are shared between the agents.
+
+        :param agent_names: The names of the agents.
+        :param max_workers: The maximum number of agents provisioned at the same time.
+        :param kwargs: Further arguments of the constructor, e.g. registry. The bedrock_agent_client and
+                       iam_client given here are shared, otherwise new ones are created.
+        :return: The agents, in the order of agent_names.
+        """
+        kwargs['bedrock_agent_client'] = kwargs.get('bedrock_agent_client') or _client('bedrock-agent')
+        kwargs['iam_client'] = kwargs.get('iam_client') or _client('iam')
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(cls, agent_name, **kwargs)
+                for agent_name in agent_names
+            ]
+            return [future.result() for future in futures]
+
+    @classmethod
+    def warm_pool(cls, registry, size, agent_name, max_workers=MAX_PROVISIONING_WORKERS):
+        """
+        Makes sure the registry holds at least `size` prepared agents with the current configuration,
+        provisioning the missing ones concurrently.
+
+        :param registry: The agent_registry.AgentRegistry.
+        :param size: The number of prepared agents to keep.
+        :param agent_name: The name prefix of newly provisioned agents.
+        :return: The registry records of the prepared agents.
+        """
+        bedrock_agent = _client('bedrock-agent')
+
+        def prepared():
+            return [
+                record for record in registry.candidates(config_hash(AGENT_CONFIG))
+                if is_prepared(bedrock_agent, record)
+            ]
+
+        ready = prepared()
+        missing = size - len(ready)
+        if missing > 0:
+            cls.provision_many(
+                [agent_name] * missing, max_workers=max_workers, registry=registry, reuse=False,
+                bedrock_agent_client=bedrock_agent,
+            )
+            ready = prepared()
+        return ready
+
+    def _reuse_from(self, registry):
+        """
+        Takes over the least recently used prepared agent with the same configuration from the registry.
+        Agents that are no longer prepared are skipped, AgentRegistry.gc() tears them down.
+
+        :return: True if an agent was reused.
+        """
+        for record in registry.candidates(self.configHash):
+            if not is_prepared(self.bedrock_agent, record):
+                continue
+            self.agentId = record['agent_id']
+            self.agentAliasId = record['agent_alias_id']
+            self.roleArn = record['role_arn']
+            self.roleName = record['role_name']
+            self.policyName = record['policy_name']
+            registry.touch(self.agentId)
+            return True
+        return False
+
+    @contextmanager
+    def _phase(self, name):
+        start = time.perf_counter()
+        try:
+            with span(f"provisioning.{name}", agent=self.agentName):
+                yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+
+    def _wait(self, fetch, is_ready, description, progress):
+        """
+        Waits with exponential backoff for a provisioning step, see utils.waiters.wait_for.
+        The polls share the control plane quota, throttled polls are retried.
+
+        :param progress: Function formatting the fetched state for the progress output.
+        """
+        return wait_for(
+            lambda: bedrock_limiter.call(CONTROL_PLANE_QUOTA, fetch),
+            is_ready,
+            f"{description} of {self.agentName}",
+            is_failed=lambda state: 'FAILED' in progress(state),
+            timeout=PROVISIONING_TIMEOUT,
+            on_poll=lambda state: print(progress(state)),
+        )
     
     def roles_and_policies(self):
         
@@ -63,13 +286,16 @@ class CodeExecutorAgent:
         }
 
         role_name = f"test-agent-{self.randomSuffix}"
+        self.roleName = role_name
+        self.policyName = f"policy-test-agent-{self.randomSuffix}"
         role = self.iam.create_role(
             RoleName=role_name,
             AssumeRolePolicyDocument = json.dumps(trustPolicy)
         )
-        self.iam.put_role_policy(
+        self._role_policy = self._background.submit(
+            self.iam.put_role_policy,
             RoleName=role_name,
-            PolicyName = f"policy-test-agent-{self.randomSuffix}",
+            PolicyName = self.policyName,
             PolicyDocument = json.dumps(policy)
         )
 
@@ -94,14 +320,12 @@ class CodeExecutorAgent:
         print("Waiting for agent status of 'NOT_PREPARED'...")
 
         # Wait for agent to reach 'NOT_PREPARED' status
-        agentStatus = ''
-        while agentStatus != 'NOT_PREPARED':
-            response = self.bedrock_agent.get_agent(
-                agentId = self.agentId
-            )
-            agentStatus = response['agent']['agentStatus']
-            print(f"Agent status: {agentStatus}")
-            time.sleep(2)
+        self._wait(
+            lambda: self.bedrock_agent.get_agent(agentId = self.agentId),
+            lambda response: response['agent']['agentStatus'] == 'NOT_PREPARED',
+            "agent status 'NOT_PREPARED'",
+            lambda response: f"Agent status: {response['agent']['agentStatus']}",
+        )
 
     def configure_code_interpreter(self):
 
@@ -126,20 +350,24 @@ class CodeExecutorAgent:
 
         print("Waiting for action group status of 'ENABLED'...")
 
-        # Wait for action group to reach 'ENABLED' status
-        actionGroupStatus = ''
-        while actionGroupStatus != 'ENABLED':
-            response = self.bedrock_agent.get_agent_action_group(
-                agentId=self.agentId,
-                actionGroupId=actionGroupId,
-                agentVersion='DRAFT'
+        # Wait for action group to reach 'ENABLED' status, it usually is right away
+        if response['agentActionGroup']['actionGroupState'] != 'ENABLED':
+            self._wait(
+                lambda: self.bedrock_agent.get_agent_action_group(
+                    agentId=self.agentId,
+                    actionGroupId=actionGroupId,
+                    agentVersion='DRAFT'
+                ),
+                lambda response: response['agentActionGroup']['actionGroupState'] == 'ENABLED',
+                "action group status 'ENABLED'",
+                lambda response: f"Action Group status: {response['agentActionGroup']['actionGroupState']}",
             )
-            actionGroupStatus = response['agentActionGroup']['actionGroupState']
-            print(f"Action Group status: {actionGroupStatus}")
-            time.sleep(2)
 
     def prepare_agent(self):
 
+        # The role policy must be attached before the agent is used
+        self._role_policy.result()
+
         print("Preparing the agent...")
 
         # Prepare the agent for use
@@ -150,14 +378,12 @@ class CodeExecutorAgent:
         print("Waiting for agent status of 'PREPARED'...")
 
         # Wait for agent to reach 'PREPARED' status
-        agentStatus = ''
-        while agentStatus != 'PREPARED':
-            response = self.bedrock_agent.get_agent(
-                agentId=self.agentId
-            )
-            agentStatus = response['agent']['agentStatus']
-            print(f"Agent status: {agentStatus}")
-            time.sleep(2)
+        self._wait(
+            lambda: self.bedrock_agent.get_agent(agentId=self.agentId),
+            lambda response: response['agent']['agentStatus'] == 'PREPARED',
+            "agent status 'PREPARED'",
+            lambda response: f"Agent status: {response['agent']['agentStatus']}",
+        )
 
         print("Creating an agent alias...")
 
@@ -170,16 +396,116 @@ class CodeExecutorAgent:
         self.agentAliasId = response['agentAlias']['agentAliasId']
 
         # Wait for agent alias to be prepared
-        agentAliasStatus = ''
-        while agentAliasStatus != 'PREPARED':
-            response = self.bedrock_agent.get_agent_alias(
+        self._wait(
+            lambda: self.bedrock_agent.get_agent_alias(
                 agentId=self.agentId,
                 agentAliasId=self.agentAliasId
-            )
-            agentAliasStatus = response['agentAlias']['agentAliasStatus']
-            print(f"Agent alias status: {agentAliasStatus}")
-            time.sleep(2)
+            ),
+            lambda response: response['agentAlias']['agentAliasStatus'] == 'PREPARED',
+            "agent alias status 'PREPARED'",
+            lambda response: f"Agent alias status: {response['agentAlias']['agentAliasStatus']}",
+        )
 
         print('Done.\n')
 
-        print(f"agentId: {self.agentId}, agentAliasId: {self.agentAliasId}")
\ No newline at end of file
+        print(f"agentId: {self.agentId}, agentAliasId: {self.agentAliasId}")
+
+    def stream(self, input_text, session_id=None, enable_trace=True):
+        """
+        Invokes the agent and yields its output as it arrives. Without a session_id, the invocation runs
+        in a new session; pass the same session_id to continue a conversation with its earlier context.
+
+        Yields the following events (dicts with a "type" key):
+        - chunk: a part of the agent's answer, in "text".
+        - code: code the code interpreter is about to run, in "code".
+        - code_output: the result of running code, with "output", "error", "files" and "timeout".
+        - file: a file generated by the code interpreter, with "name", "mediaType" and "bytes".
+        - trace: any other trace of the agent, in "trace".
+
+        :param input_text: The request to the agent.
+        :param session_id: Optional session ID, e.g. to continue an earlier conversation.
+        :param enable_trace: If False, no code, code_output and trace events are produced.
+        :raises DeadlineExceeded: If the current deadline of the turn (see utils.deadline) passes before
+                                  the answer is complete, the events yielded until then are kept by the caller.
+        """
+        if session_id is None:
+            with self.sessions.lease() as session_id:
+                yield from self._stream(input_text, session_id, enable_trace)
+        else:
+            yield from self._stream(input_text, session_id, enable_trace)
+
+    def invoke(self, input_text, session_id=None, enable_trace=True):
+        """
+        Invokes the agent and waits for the complete answer.
+
+        :param input_text: The request to the agent.
+        :param session_id: Optional session ID, see stream().
+        :param enable_trace: If False, the executed code and its outputs are not collected.
+        :return: Dict with the "output" text, the executed "code", the "code_outputs" and the generated "files".
+        """
+        result = {"output": "", "code": [], "code_outputs": [], "files": []}
+        chunks = []
+        for event in self.stream(input_text, session_id=session_id, enable_trace=enable_trace):
+            if event["type"] == "chunk":
+                chunks.append(event["text"])
+            elif event["type"] == "code":
+                result["code"].append(event["code"])
+            elif event["type"] == "code_output":
+                result["code_outputs"].append(event)
+            elif event["type"] == "file":
+                result["files"].append(event)
+        result["output"] = "".join(chunks)
+        return result
+
+    def _stream(self, input_text, session_id, enable_trace):
+        runtime_client = self.runtimeClient or _runtime_client()
+        response = bedrock_limiter.call(
+            INVOKE_AGENT_QUOTA,
+            runtime_client.invoke_agent,
+            agentId=self.agentId,
+            agentAliasId=self.agentAliasId,
+            sessionId=session_id,
+            inputText=input_text,
+            enableTrace=enable_trace,
+        )
+
+        completion = response['completion']
+        for event in completion:
+            try:
+                deadline.check("the agent's answer was complete")
+            except DeadlineExceeded:
+                # Closing the event stream releases the connection of the abandoned answer
+                getattr(completion, 'close', lambda: None)()
+                raise
+
+            if 'chunk' in event:
+                yield {"type": "chunk", "text": event['chunk']['bytes'].decode('utf-8')}
+
+            elif 'files' in event:
+                for file in event['files']['files']:
+                    yield {"type": "file", "name": file['name'], "mediaType": file['type'], "bytes": file['bytes']}
+
+            elif 'trace' in event:
+                yield from self._trace_events(event['trace'].get('trace', {}))
+
+    @staticmethod
+    def _trace_events(trace):
+        """
+        Extracts the code interpreter's inputs and outputs from an agent trace.
+        """
+        orchestration = trace.get('orchestrationTrace', {})
+        invocation = orchestration.get('invocationInput', {}).get('codeInterpreterInvocationInput')
+        observation = orchestration.get('observation', {}).get('codeInterpreterInvocationOutput')
+
+        if invocation is not None:
+            yield {"type": "code", "code": invocation.get('code', ''), "files": invocation.get('files', [])}
+        elif observation is not None:
+            yield {
+                "type": "code_output",
+                "output": observation.get('executionOutput', ''),
+                "error": observation.get('executionError', ''),
+                "files": observation.get('files', []),
+                "timeout": observation.get('executionTimeout', False),
+            }
+        else:
+            yield {"type": "trace", "trace": trace}
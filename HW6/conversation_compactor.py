@@ -0,0 +1,124 @@
+import hashlib
+import json
+
+# Rough number of characters per token, used to turn a token budget into a byte budget.
+CHARS_PER_TOKEN = 4
+
+# Default number of most recent messages that are always sent verbatim.
+KEEP_LAST_MESSAGES = 4
+
+# Strings in older messages longer than this are replaced with a short reference.
+MAX_FIELD_CHARS = 200
+
+
+def payload_size(messages):
+    """
+    Returns the size of the messages as sent to the Converse API.
+
+    :param messages: The conversation messages.
+    :return: The size of the JSON encoded messages in bytes.
+    """
+    return len(json.dumps(messages, ensure_ascii=False).encode("utf-8"))
+
+
+class ConversationCompactor:
+    """
+    Shrinks the conversation sent to Amazon Bedrock once it exceeds a byte (or token) budget.
+
+    Older messages are compacted first: long strings in toolUse inputs (e.g. the code passed to
+    SaveToS3Tool) and in toolResult content are replaced with a short reference. Text blocks, such as
+    the user's request, are always kept verbatim. Messages are never dropped and toolUse / toolResult
+    IDs are kept, so every toolUse stays paired with its toolResult. The latest keep_last_messages
+    messages are always sent verbatim.
+
+    Any object with a compact(conversation) method returning (messages, report) can be used instead.
+    """
+
+    def __init__(
+        self,
+        max_bytes=None,
+        max_tokens=None,
+        keep_last_messages=KEEP_LAST_MESSAGES,
+        max_field_chars=MAX_FIELD_CHARS,
+    ):
+        """
+        :param max_bytes: The payload budget in bytes.
+        :param max_tokens: The payload budget in tokens, used if max_bytes is not given.
+        :param keep_last_messages: The number of most recent messages that are never compacted.
+        :param max_field_chars: Strings longer than this are replaced in compacted messages.
+        """
+        if max_bytes is None:
+            if max_tokens is None:
+                raise ValueError("Either max_bytes or max_tokens must be set.")
+            max_bytes = max_tokens * CHARS_PER_TOKEN
+        self.max_bytes = max_bytes
+        self.keep_last_messages = keep_last_messages
+        self.max_field_chars = max_field_chars
+
+    def compact(self, conversation):
+        """
+        Returns a compacted copy of the conversation, the conversation itself is not modified.
+
+        :param conversation: The conversation history including the next message to send.
+        :return: The messages to send and a report with the original, compacted and saved bytes.
+        """
+        original_bytes = payload_size(conversation)
+        messages = list(conversation)
+        compacted_bytes = original_bytes
+
+        # Compact the oldest messages first, until the payload fits into the budget
+        last_compactable = max(len(messages) - self.keep_last_messages, 0)
+        for index in range(last_compactable):
+            if compacted_bytes <= self.max_bytes:
+                break
+            message = messages[index]
+            compacted = {
+                "role": message["role"],
+                "content": [self._compact_block(block) for block in message["content"]],
+            }
+            compacted_bytes += payload_size(compacted) - payload_size(message)
+            messages[index] = compacted
+
+        return messages, {
+            "original_bytes": original_bytes,
+            "compacted_bytes": compacted_bytes,
+            "saved_bytes": original_bytes - compacted_bytes,
+        }
+
+    def _compact_block(self, block):
+        """
+        :param block: A content block of a message.
+        :return: The content block with long strings in toolUse inputs and toolResult content replaced.
+        """
+        if "toolUse" in block:
+            tool_use = block["toolUse"]
+            return {"toolUse": dict(tool_use, input=self._compact_value(tool_use["input"]))}
+        if "toolResult" in block:
+            tool_result = block["toolResult"]
+            return {
+                "toolResult": dict(
+                    tool_result, content=self._compact_value(tool_result["content"])
+                )
+            }
+        return block
+
+    def _compact_value(self, value):
+        """
+        Replaces strings longer than max_field_chars, also inside nested dicts and lists.
+
+        :param value: The value to compact.
+        :return: The compacted value.
+        """
+        if isinstance(value, str):
+            if len(value) <= self.max_field_chars:
+                return value
+            digest = hashlib.sha256(value.encode("utf-8")).hexdigest()[:12]
+            return (
+                f"{value[:self.max_field_chars // 2]}"
+                f"... [{len(value)} chars omitted from an earlier turn, sha256:{digest}]"
+            )
+        if isinstance(value, dict):
+            return {key: self._compact_value(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._compact_value(item) for item in value]
+        return value
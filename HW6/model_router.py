@@ -0,0 +1,143 @@
+import random
+import threading
+from enum import Enum
+
+# Weight of the latest observation in the moving averages of latency and error rate.
+EWMA_ALPHA = 0.2
+
+# A model's expected latency is multiplied by (1 + ERROR_PENALTY * error rate) when ranking.
+ERROR_PENALTY = 4.0
+
+# Requests at least this large (in bytes) are tracked separately, their latency is dominated by the input.
+LARGE_REQUEST_BYTES = 32 * 1024
+
+# Probability of trying a random interchangeable model instead of the best ranked one, so the
+# averages of the other models stay current.
+EXPLORATION = 0.05
+
+
+# Tools whose successful results the model usually only summarizes, the results of any other tool
+# (e.g. a test run of RunPythonTool) are acted on.
+SUMMARY_TOOLS = frozenset({"SaveToS3Tool"})
+
+
+class TurnType(Enum):
+    # The user's request, or tool results the model has to act on (e.g. a test run or a failed tool): writes code.
+    CODE_GENERATION = "code_generation"
+    # Successful results of SUMMARY_TOOLS only, the model usually only summarizes what was done.
+    TOOL_RESULT_SUMMARY = "tool_result_summary"
+
+
+def turn_type(conversation):
+    """
+    :param conversation: The conversation history including the next message to send.
+    :return: The TurnType of the next model call.
+    """
+    tool_results = [
+        content_block["toolResult"]
+        for content_block in conversation[-1]["content"]
+        if "toolResult" in content_block
+    ]
+    if not tool_results:
+        return TurnType.CODE_GENERATION
+    tool_names = {
+        content_block["toolUse"]["toolUseId"]: content_block["toolUse"]["name"]
+        for content_block in (conversation[-2]["content"] if len(conversation) > 1 else [])
+        if "toolUse" in content_block
+    }
+    for tool_result in tool_results:
+        if tool_names.get(tool_result["toolUseId"]) not in SUMMARY_TOOLS:
+            return TurnType.CODE_GENERATION
+        for content in tool_result["content"]:
+            response = content.get("json")
+            if isinstance(response, dict) and (
+                response.get("error") == "true" or response.get("status") in ("failed", "timeout", "killed")
+            ):
+                return TurnType.CODE_GENERATION
+    return TurnType.TOOL_RESULT_SUMMARY
+
+
+class ModelRouter:
+    """
+    Picks the model of every call by turn type. Each turn type has a route with interchangeable models,
+    ranked by the moving average of their observed latency and error rate per turn type and request size,
+    and fallback models that are tried in order after them, e.g. when a model is throttled or times out.
+    A route with a single model and fallbacks always uses that model while it is available.
+    """
+
+    def __init__(self, routes, alpha=EWMA_ALPHA, error_penalty=ERROR_PENALTY, exploration=EXPLORATION):
+        """
+        :param routes: Mapping of TurnType to a dict with the interchangeable "models" and the "fallbacks",
+                       lists of model IDs in order of preference.
+        :param alpha: The weight of the latest observation in the moving averages.
+        :param error_penalty: How much the error rate counts against a model.
+        :param exploration: The probability of trying a random interchangeable model.
+        """
+        self.routes = routes
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.exploration = exploration
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, conversation, request_bytes):
+        """
+        :param conversation: The conversation history including the next message to send.
+        :param request_bytes: The size of the request.
+        :return: The turn type and the model IDs to try, best first.
+        """
+        kind = turn_type(conversation)
+        route = self.routes[kind]
+        size = self._size_class(request_bytes)
+        with self._lock:
+            # Models without observations keep their configured order ahead of the measured ones
+            ranked = sorted(
+                route["models"],
+                key=lambda model_id: self._score(model_id, kind, size),
+            )
+        if len(ranked) > 1 and random.random() < self.exploration:
+            ranked.insert(0, ranked.pop(random.randrange(1, len(ranked))))
+        return kind, ranked + [model_id for model_id in route.get("fallbacks", []) if model_id not in ranked]
+
+    def record(self, model_id, kind, request_bytes, latency_ms=None, error=False):
+        """
+        Updates the moving averages of the model with the outcome of a call.
+
+        :param model_id: The model that was called.
+        :param kind: The TurnType of the call.
+        :param request_bytes: The size of the request.
+        :param latency_ms: The latency of a successful call.
+        :param error: True if the call was throttled, timed out or failed.
+        """
+        with self._lock:
+            stats = self._stats.setdefault((model_id, kind, self._size_class(request_bytes)), {
+                "latency_ms": None, "error_rate": 0.0, "calls": 0,
+            })
+            stats["calls"] += 1
+            stats["error_rate"] += self.alpha * ((1.0 if error else 0.0) - stats["error_rate"])
+            if latency_ms is not None:
+                if stats["latency_ms"] is None:
+                    stats["latency_ms"] = latency_ms
+                else:
+                    stats["latency_ms"] += self.alpha * (latency_ms - stats["latency_ms"])
+
+    def stats(self):
+        """
+        :return: The moving averages per model, turn type and request size class.
+        """
+        with self._lock:
+            return {
+                f"{model_id} {kind.value} {size}": dict(stats)
+                for (model_id, kind, size), stats in self._stats.items()
+            }
+
+    def _score(self, model_id, kind, size):
+        """Expected latency of the model, penalized by its error rate. Must be called with the lock held."""
+        stats = self._stats.get((model_id, kind, size))
+        if stats is None or stats["latency_ms"] is None:
+            return 0.0 if stats is None else float("inf")
+        return stats["latency_ms"] * (1 + self.error_penalty * stats["error_rate"])
+
+    @staticmethod
+    def _size_class(request_bytes):
+        return "large" if request_bytes >= LARGE_REQUEST_BYTES else "small"
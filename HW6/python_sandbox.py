@@ -0,0 +1,356 @@
+"""
+Pool of pre-started Python subprocesses that run untrusted code with resource limits and without network.
+
+Every sandbox process runs one job and exits, so no state leaks between jobs. The interpreter start-up
+is paid ahead of time: idle sandboxes wait for their job on stdin, and a replacement is started in the
+background as soon as one is taken. This file is also the entry point of the sandbox processes and
+must only use the standard library.
+"""
+
+import json
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Number of idle sandboxes kept warm.
+POOL_SIZE = 4
+
+# Default limits of a job.
+CPU_SECONDS = 10
+WALL_SECONDS = 15
+MEMORY_BYTES = 512 * 1024 * 1024
+FILE_SIZE_BYTES = 16 * 1024 * 1024
+OPEN_FILES = 256
+# Processes and threads of the sandbox's user, a backstop should a job get past the audit hook to fork.
+PROCESSES = 64
+
+# Seconds to wait for the output pipes after the sandbox's processes are killed.
+DRAIN_SECONDS = 1
+
+# Captured bytes of stdout and stderr each, the beginning and the end are kept.
+MAX_OUTPUT_BYTES = 8 * 1024
+
+# Audit events a job may not trigger: starting processes and loading native code that could bypass the hook.
+_BLOCKED_EVENTS = {
+    "subprocess.Popen", "os.system", "os.exec", "os.posix_spawn", "os.spawn", "os.fork", "os.forkpty",
+    "pty.spawn", "ctypes.dlopen", "ctypes.dlsym", "ctypes.cdata",
+    "gc.get_objects", "gc.get_referrers", "gc.get_referents",
+}
+
+# Modules a job may not import again. _posixsubprocess starts processes without raising an audit event,
+# its fork_exec is replaced before the job runs and a fresh copy of the module would restore it.
+_BLOCKED_MODULES = {"_posixsubprocess"}
+
+# Functions of the os module that start processes, removed before the job runs.
+_BLOCKED_FUNCTIONS = ("fork", "forkpty", "posix_spawn", "posix_spawnp", "system", "execv", "execve")
+
+# First byte a sandbox writes once it is ready for a job, with or without its own network namespace.
+_READY = b"+"
+_UNISOLATED = b"-"
+
+# Linux namespaces, a new user namespace allows an unprivileged process to create a network namespace.
+_CLONE_NEWUSER = 0x10000000
+_CLONE_NEWNET = 0x40000000
+
+
+class SandboxUnavailable(RuntimeError):
+    """Raised when the sandboxes cannot be isolated from the network, no code is run then."""
+
+
+class SandboxPool:
+    """
+    Runs code in pre-started sandbox processes. Each process has CPU, memory, file size, process and open
+    file limits, no network (a separate network namespace, and an audit hook refusing network sockets and
+    new processes), and its own temporary working directory. Where the kernel does not allow a network
+    namespace, the pool refuses to run code.
+    """
+
+    def __init__(self, size=POOL_SIZE, cpu_seconds=CPU_SECONDS, wall_seconds=WALL_SECONDS,
+                 memory_bytes=MEMORY_BYTES, max_output_bytes=MAX_OUTPUT_BYTES):
+        """
+        :param size: The number of idle sandboxes kept warm.
+        :param cpu_seconds: The CPU time limit of a job.
+        :param wall_seconds: The wall clock limit of a job, the sandbox is killed after it.
+        :param memory_bytes: The address space limit of a sandbox.
+        :param max_output_bytes: The captured bytes of stdout and stderr each.
+        """
+        self.size = size
+        self.cpu_seconds = cpu_seconds
+        self.wall_seconds = wall_seconds
+        self.memory_bytes = memory_bytes
+        self.max_output_bytes = max_output_bytes
+        self._idle = queue.Queue()
+        self._closed = False
+        self._unavailable = None
+        for _ in range(size):
+            self._idle.put(self._spawn())
+
+    def run(self, code, tests=None, timeout=None):
+        """
+        Runs the code in a sandbox. The code runs as the module "solution". The tests, if any, run afterwards
+        as "__main__" with the names of the code in scope; without tests the code itself runs as "__main__".
+
+        :param code: The Python code.
+        :param tests: Optional test code, e.g. assert statements or a unittest.main() call.
+        :param timeout: Optional wall clock limit in seconds, if earlier than the pool's wall_seconds.
+        :return: Dict with the "status" (passed, failed, timeout or killed), "exit_code", the captured
+                 "stdout" and "stderr", and "duration_ms".
+        :raises SandboxUnavailable: If the sandbox could not be moved into its own network namespace.
+        """
+        if self._closed:
+            raise RuntimeError("The sandbox pool is shut down.")
+        if self._unavailable:
+            raise SandboxUnavailable(self._unavailable)
+        try:
+            process, workdir = self._idle.get_nowait()
+        except queue.Empty:
+            process, workdir = self._spawn()
+        threading.Thread(target=self._replenish, daemon=True).start()
+
+        # The sandbox reports whether it is isolated before it reads the job
+        ready = process.stdout.read(1)
+        if ready != _READY:
+            _kill_group(process)
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+            reason = process.stderr.read().decode("utf-8", errors="replace").strip()
+            if ready != _UNISOLATED:
+                raise RuntimeError(f"The sandbox did not start: {reason}")
+            self._unavailable = f"The sandbox could not be isolated from the network: {reason}"
+            raise SandboxUnavailable(self._unavailable)
+
+        job = {
+            "code": code,
+            "tests": tests,
+            "cpu_seconds": self.cpu_seconds,
+            "memory_bytes": self.memory_bytes,
+        }
+        wall_seconds = self.wall_seconds if timeout is None else min(timeout, self.wall_seconds)
+        start = time.perf_counter()
+        readers = [_LimitedReader(pipe, self.max_output_bytes) for pipe in (process.stdout, process.stderr)]
+        status = None
+        try:
+            try:
+                process.stdin.write(json.dumps(job).encode("utf-8"))
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            # Waiting for the end of the output first, Popen.wait() with a timeout polls in steps of up to 50ms
+            deadline = start + wall_seconds
+            for reader in readers:
+                reader.join(max(0.0, deadline - time.perf_counter()))
+            try:
+                exit_code = process.wait(timeout=max(0.0, deadline - time.perf_counter()))
+            except subprocess.TimeoutExpired:
+                _kill_group(process)
+                exit_code = process.wait()
+                status = "timeout"
+            # Processes left behind in the sandbox's session would keep the output pipes open
+            if any(reader.is_alive() for reader in readers):
+                _kill_group(process)
+            for reader in readers:
+                reader.join(DRAIN_SECONDS)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if status is None:
+            # A negative exit code is the signal that ended the process, e.g. SIGXCPU at the CPU limit
+            status = "passed" if exit_code == 0 else "killed" if exit_code < 0 else "failed"
+        stderr = readers[1].text()
+        if exit_code == -signal.SIGXCPU:
+            stderr += f"\nKilled: CPU time limit of {self.cpu_seconds}s exceeded."
+        elif status == "timeout":
+            stderr += f"\nKilled: time limit of {wall_seconds:.1f}s exceeded."
+        return {
+            "status": status,
+            "exit_code": exit_code,
+            "stdout": readers[0].text(),
+            "stderr": stderr,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+
+    def shutdown(self):
+        """Stops the idle sandboxes."""
+        self._closed = True
+        while True:
+            try:
+                process, workdir = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _kill_group(process)
+            process.wait()
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _spawn(self):
+        workdir = tempfile.mkdtemp(prefix="sandbox-")
+        process = subprocess.Popen(
+            # Isolated mode: no environment variables, user site-packages or working directory on the path
+            [sys.executable, "-I", os.path.abspath(__file__)],
+            cwd=workdir,
+            env={"PATH": os.defpath, "HOME": workdir, "TMPDIR": workdir},
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        return process, workdir
+
+    def _replenish(self):
+        if self._idle.qsize() >= self.size:
+            return
+        sandbox = self._spawn()
+        self._idle.put(sandbox)
+        if self._closed:
+            self.shutdown()
+
+
+class _LimitedReader:
+    """
+    Drains a pipe on a thread and keeps only the beginning and the end of the output.
+    """
+
+    def __init__(self, pipe, max_bytes):
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+        self._half = max_bytes // 2
+        self._thread = threading.Thread(target=self._read, args=(pipe,), daemon=True)
+        self._thread.start()
+
+    def _read(self, pipe):
+        with pipe:
+            for chunk in iter(lambda: pipe.read1(64 * 1024), b""):
+                self.total += len(chunk)
+                room = self._half - len(self.head)
+                if room > 0:
+                    self.head += chunk[:room]
+                    chunk = chunk[room:]
+                self.tail = (self.tail + chunk)[-self._half:]
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def text(self):
+        omitted = self.total - len(self.head) - len(self.tail)
+        middle = f"\n...[{omitted} bytes omitted]...\n".encode() if omitted > 0 else b""
+        return (bytes(self.head) + middle + bytes(self.tail)).decode("utf-8", errors="replace")
+
+
+def _kill_group(process):
+    """Kills the sandbox and every process it started, they share the sandbox's session and process group."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _isolate_network():
+    """Moves the process into a new, empty network namespace where the kernel allows it."""
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        return libc.unshare(_CLONE_NEWUSER | _CLONE_NEWNET) == 0
+    except (OSError, AttributeError):
+        return False
+
+
+def _refuse_fork_exec(*args, **kwargs):
+    raise PermissionError("Starting processes is not allowed in the sandbox.")
+
+
+def _audit(event, args):
+    if event in _BLOCKED_EVENTS:
+        raise PermissionError(f"{event} is not allowed in the sandbox.")
+    if event == "import" and args[0] in _BLOCKED_MODULES:
+        raise PermissionError(f"Importing {args[0]} is not allowed in the sandbox.")
+    # Local sockets are used by asyncio and multiprocessing primitives, network sockets are refused
+    if event == "socket.__new__" and args[1] != 1:
+        raise PermissionError("Network access is not allowed in the sandbox.")
+    if event in ("socket.connect", "socket.bind", "socket.sendto") and not isinstance(args[1], (str, bytes)):
+        raise PermissionError("Network access is not allowed in the sandbox.")
+    if event == "socket.getaddrinfo":
+        raise PermissionError("Network access is not allowed in the sandbox.")
+
+
+def _serve():
+    """Entry point of a sandbox process: waits for one job on stdin and runs it."""
+    # Everything that does not depend on the job is done while the sandbox is idle
+    import gc
+    import resource
+    import traceback
+    import types
+
+    if not _isolate_network():
+        sys.stdout.buffer.write(_UNISOLATED)
+        sys.stdout.flush()
+        print("unshare() of a user and network namespace is not permitted.", file=sys.stderr)
+        return 1
+    # subprocess (and so asyncio) stays importable, but cannot start a process. It binds fork_exec when
+    # imported, so its reference is replaced too; the network namespace and RLIMIT_NPROC stay the backstop.
+    import _posixsubprocess
+    _posixsubprocess.fork_exec = _refuse_fork_exec
+    subprocess._fork_exec = _refuse_fork_exec
+    for name in _BLOCKED_FUNCTIONS:
+        for module in (os, sys.modules["posix"]):
+            if hasattr(module, name):
+                delattr(module, name)
+    gc.collect()
+    sys.addaudithook(_audit)
+    sys.stdout.buffer.write(_READY)
+    sys.stdout.flush()
+
+    raw = sys.stdin.buffer.read()
+    if not raw:
+        return 0
+    job = json.loads(raw)
+
+    resource.setrlimit(resource.RLIMIT_CPU, (job["cpu_seconds"], job["cpu_seconds"] + 1))
+    resource.setrlimit(resource.RLIMIT_AS, (job["memory_bytes"], job["memory_bytes"]))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE_BYTES, FILE_SIZE_BYTES))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (OPEN_FILES, OPEN_FILES))
+    resource.setrlimit(resource.RLIMIT_NPROC, (PROCESSES, PROCESSES))
+
+    # The sandbox's own __main__ is replaced, so e.g. unittest.main() finds the tests
+    solution = types.ModuleType("solution")
+    solution.__file__ = os.path.abspath("solution.py")
+    sys.modules["solution"] = solution
+    main = types.ModuleType("__main__")
+    try:
+        if job.get("tests"):
+            exec(compile(job["code"], "solution.py", "exec"), solution.__dict__)
+            main.__dict__.update({name: value for name, value in vars(solution).items() if not name.startswith("__")})
+            main.__file__ = os.path.abspath("tests.py")
+            sys.modules["__main__"] = main
+            exec(compile(job["tests"], "tests.py", "exec"), main.__dict__)
+        else:
+            main.__file__ = solution.__file__
+            sys.modules["__main__"] = main
+            exec(compile(job["code"], "solution.py", "exec"), main.__dict__)
+    except SystemExit as exit:
+        return exit.code if isinstance(exit.code, int) else (0 if exit.code is None else 1)
+    except BaseException as error:
+        # The frame of _serve() is left out, the traceback starts in the code
+        traceback.print_exception(type(error), error, error.__traceback__.tb_next)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit_code = _serve()
+    # Skipping the interpreter's teardown of the loaded modules, it takes longer than a typical job
+    import atexit
+
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
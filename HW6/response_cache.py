@@ -0,0 +1,175 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+
+# Default size of the in-memory tier in bytes of serialized responses.
+MAX_MEMORY_BYTES = 32 * 1024 * 1024
+
+# Default time to live of responses in the SQLite tier, in seconds.
+TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+class CacheMode(Enum):
+    # Serve hits from the cache, call the model and store the response on a miss.
+    READ_WRITE = "read_write"
+    # Always call the model and (re)store the response, e.g. to record a regression run.
+    RECORD = "record"
+    # Only serve responses from the cache, a miss raises ReplayMissError.
+    REPLAY = "replay"
+
+
+class ReplayMissError(LookupError):
+    """
+    Raised in replay mode when a request has no recorded response.
+    """
+
+
+def request_key(request):
+    """
+    Returns a stable hash of a Converse request.
+
+    :param request: The request arguments, i.e. modelId, system, toolConfig and messages.
+    :return: The hex digest of the canonicalized request.
+    """
+    canonical = json.dumps(
+        request, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of model responses with an in-memory LRU tier and an optional
+    persistent SQLite tier. Responses are stored as the list of events of the response stream.
+    """
+
+    def __init__(
+        self,
+        db_path=None,
+        max_memory_bytes=MAX_MEMORY_BYTES,
+        ttl_seconds=TTL_SECONDS,
+        mode=CacheMode.READ_WRITE,
+    ):
+        """
+        :param db_path: Path of the SQLite database, None keeps the cache in memory only.
+        :param max_memory_bytes: The size limit of the in-memory tier, least recently used entries are evicted.
+        :param ttl_seconds: How long responses stay valid in the SQLite tier.
+        :param mode: The CacheMode.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.mode = CacheMode(mode)
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, body TEXT NOT NULL, created_at REAL NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        """
+        :param key: The request key, see request_key().
+        :return: The recorded response events, or None on a miss.
+        """
+        with self._lock:
+            body = self._memory.get(key)
+            if body is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return json.loads(body)
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT body, expires_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] < time.time():
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                    self.counters["expirations"] += 1
+                elif row is not None:
+                    self.counters["disk_hits"] += 1
+                    self._remember(key, row[0])
+                    return json.loads(row[0])
+
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, key, events):
+        """
+        Stores the response events in both tiers.
+
+        :param key: The request key, see request_key().
+        :param events: The events of the response stream.
+        """
+        body = json.dumps(events, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, body)
+            if self._db is not None:
+                now = time.time()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, body, now, now + self.ttl_seconds),
+                )
+                self._db.commit()
+
+    def stats(self):
+        """
+        :return: The hit, miss, eviction and expiration counters, the hit rate and the memory tier size.
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        )
+        return stats
+
+    def purge_expired(self):
+        """
+        Deletes the expired responses from the SQLite tier.
+
+        :return: The number of deleted responses.
+        """
+        if self._db is None:
+            return 0
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM responses WHERE expires_at < ?", (time.time(),)
+            ).rowcount
+            self._db.commit()
+            self.counters["expirations"] += deleted
+        return deleted
+
+    def _remember(self, key, body):
+        """
+        Adds a serialized response to the in-memory tier and evicts the least recently used
+        entries until the tier fits into max_memory_bytes. Must be called with the lock held.
+        """
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        if len(body) > self.max_memory_bytes:
+            return
+        self._memory[key] = body
+        self._memory_bytes += len(body)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+            self.counters["evictions"] += 1
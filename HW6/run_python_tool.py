@@ -0,0 +1,79 @@
+import atexit
+import threading
+
+from python_sandbox import SandboxPool, SandboxUnavailable
+from utils import deadline
+
+# Code and tests longer than this (in characters) are refused before they reach a sandbox.
+MAX_CODE_CHARS = 200 * 1024
+
+_sandbox_pool = None
+_sandbox_pool_lock = threading.Lock()
+
+
+def get_tool_spec():
+    """
+    Returns the tool specification for the RunPythonTool.
+
+    :return: The tool specification for the RunPythonTool.
+    """
+    return {
+        "toolSpec": {
+            "name": "RunPythonTool",
+            "description": (
+                "Run Python code and its tests in a sandbox without network access and return the exit code "
+                "and the (truncated) output. The code runs as the module 'solution'; the tests run afterwards "
+                "as '__main__' with the names of the code in scope, e.g. assert statements or unittest.main(). "
+                "Without tests the code runs as '__main__'."
+            ),
+            "inputSchema": {
+                "json": {
+                    "type": "object",
+                    "properties": {
+                        "code": {
+                            "type": "string",
+                            "description": "The code to be run",
+                            "maxLength": MAX_CODE_CHARS,
+                        },
+                        "tests": {
+                            "type": "string",
+                            "description": "The tests of the code",
+                            "maxLength": MAX_CODE_CHARS,
+                        },
+                    },
+                    "required": ["code"],
+                }
+            },
+        }
+    }
+
+
+def get_sandbox_pool():
+    """
+    Returns the process-wide sandbox pool, it is started on the tool's first call and stopped at exit.
+
+    :return: The python_sandbox.SandboxPool.
+    """
+    global _sandbox_pool
+    if _sandbox_pool is None:
+        with _sandbox_pool_lock:
+            if _sandbox_pool is None:
+                _sandbox_pool = SandboxPool()
+                atexit.register(_sandbox_pool.shutdown)
+    return _sandbox_pool
+
+
+def RunPython(code, tests=None):
+    """
+    Runs the code and its tests in a sandbox, stopped at the current deadline of the turn (see utils.deadline)
+    if that comes before the sandbox's own time limit.
+    ::param code: The code to be run.
+    ::param tests: Optional tests run after the code.
+    ::return: The status (passed, failed, timeout or killed), exit code, output and duration of the run, or
+              an error if the sandboxes cannot be isolated from the network on this host.
+    """
+    deadline.check("the code was run")
+    try:
+        return get_sandbox_pool().run(code, tests, timeout=deadline.remaining())
+    except SandboxUnavailable as error:
+        return {"error": "true", "message": f"The RunPythonTool is unavailable: {error}"}
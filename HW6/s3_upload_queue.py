@@ -0,0 +1,166 @@
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+
+# Maximum number of artifacts waiting to be uploaded before SaveToS3 blocks.
+MAX_QUEUE_SIZE = 64
+
+# Maximum number of queued artifacts an uploader thread takes at once.
+BATCH_SIZE = 8
+
+# Number of background uploader threads.
+UPLOAD_WORKERS = 2
+
+# Retry schedule for failed uploads: the delay doubles after every attempt, with jitter.
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8
+
+
+class UploadFailed(Exception):
+    """Raised by flush() for the uploads that failed after all attempts."""
+
+    def __init__(self, failures):
+        """
+        :param failures: List of (arguments, error) of the failed uploads.
+        """
+        super().__init__(
+            f"{len(failures)} upload(s) failed: " + "; ".join(str(error) for _, error in failures)
+        )
+        self.failures = failures
+
+
+class UploadQueue:
+    """
+    Write-behind queue for S3 uploads. Artifacts are uploaded by background threads, so the
+    caller gets an upload ID right away. The queue is bounded: when it is full, submit() blocks
+    until there is room again (backpressure). flush() waits for the given uploads, e.g. the ones
+    of a conversation, and raises UploadFailed for those that could not be written. Call flush()
+    without IDs before exiting, so no write is lost.
+    """
+
+    def __init__(
+        self,
+        upload,
+        max_queue_size=MAX_QUEUE_SIZE,
+        batch_size=BATCH_SIZE,
+        workers=UPLOAD_WORKERS,
+        max_attempts=MAX_ATTEMPTS,
+    ):
+        """
+        :param upload: The function performing one upload, called with the submitted arguments.
+        :param max_queue_size: The maximum number of pending artifacts.
+        :param batch_size: The maximum number of artifacts an uploader thread takes at once.
+        :param workers: The number of uploader threads.
+        :param max_attempts: The number of attempts per artifact before it is reported as failed.
+        """
+        self.upload = upload
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._ids = itertools.count(1)
+        # Upload IDs not finished yet, and (arguments, error) of the failed ones not reported by flush()
+        self._pending = set()
+        self._failed = {}
+        self._pending_changed = threading.Condition()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._threads = [
+            threading.Thread(target=self._work, name=f"s3-upload-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, *args, timeout=None):
+        """
+        Enqueues an upload, blocks while the queue is full.
+
+        :param args: The arguments of the upload function.
+        :param timeout: The maximum time to wait for room in the queue, None waits forever.
+        :return: The ID of the upload, see flush().
+        :raises queue.Full: If there was no room in the queue within the timeout.
+        """
+        upload_id = next(self._ids)
+        with self._pending_changed:
+            self._pending.add(upload_id)
+        try:
+            self._queue.put((upload_id, args), timeout=timeout)
+        except queue.Full:
+            self._done(upload_id)
+            raise
+        return upload_id
+
+    def flush(self, timeout=None, upload_ids=None):
+        """
+        Waits until the given uploads are finished (uploaded or failed).
+
+        :param timeout: The maximum time to wait, None waits forever.
+        :param upload_ids: The IDs returned by submit(), None waits for all submitted uploads.
+        :return: True if the uploads finished, False if the timeout expired.
+        :raises UploadFailed: If any of the uploads failed, each failure is reported once.
+        """
+        with self._pending_changed:
+            if upload_ids is None:
+                flushed = self._pending_changed.wait_for(lambda: not self._pending, timeout)
+                failures, self._failed = list(self._failed.values()), {}
+            else:
+                upload_ids = set(upload_ids)
+                flushed = self._pending_changed.wait_for(lambda: self._pending.isdisjoint(upload_ids), timeout)
+                failures = [self._failed.pop(upload_id) for upload_id in sorted(upload_ids & self._failed.keys())]
+        if failures:
+            raise UploadFailed(failures)
+        return flushed
+
+    def shutdown(self, timeout=None):
+        """
+        Flushes the queue and stops the uploader threads.
+
+        :param timeout: The maximum time to wait for the pending uploads.
+        :return: True if all uploads finished before the threads were stopped.
+        :raises UploadFailed: If uploads failed since the last flush.
+        """
+        try:
+            return self.flush(timeout)
+        finally:
+            for _ in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join(timeout)
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            for upload_id, args in (item for item in batch if item is not None):
+                self._upload_with_retries(upload_id, args)
+                self._done(upload_id)
+
+            if stop:
+                return
+
+    def _upload_with_retries(self, upload_id, args):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.upload(*args)
+                return
+            except Exception as error:
+                if attempt == self.max_attempts:
+                    logging.error(f"Upload failed after {attempt} attempts: {error}")
+                    with self._pending_changed:
+                        self._failed[upload_id] = (args, error)
+                    return
+                delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempt - 1), BACKOFF_MAX_SECONDS)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _done(self, upload_id):
+        with self._pending_changed:
+            self._pending.discard(upload_id)
+            self._pending_changed.notify_all()
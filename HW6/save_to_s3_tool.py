@@ -1,5 +1,59 @@
-import boto3
-from config import bucket_name
+import atexit
+import gzip
+import hashlib
+import io
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_upload_queue import UploadFailed, UploadQueue
+from utils import deadline
+from utils.instrumentation import span
+
+# Artifacts are stored under a key derived from the hash of their content.
+KEY_PREFIX = "artifacts/"
+
+# Stable key that always points to the latest saved code, None disables the alias.
+DEFAULT_ALIAS = "backend.py"
+
+# Artifacts at least this large (in bytes) are gzip compressed if compression is enabled, the alias is never.
+GZIP_THRESHOLD = 16 * 1024
+
+# Artifacts at least this large (in bytes, after compression) are uploaded in parts.
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# Timeouts (in seconds) of the S3 requests, so a stalled connection fails instead of holding the turn.
+S3_CONNECT_TIMEOUT = 5
+S3_READ_TIMEOUT = 30
+
+# Seconds SaveToS3 waits for room in a full write-behind queue before it reports an error.
+SUBMIT_TIMEOUT = 30
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+# The bucket from config.py, read on first use.
+_bucket_name = None
+
+# Content hashes known to exist in the bucket and the hash each alias points to, per process.
+_known_hashes = set()
+_alias_hashes = {}
+_state_lock = threading.Lock()
+
+# Threads writing the aliases alongside the uploads of the artifacts, see _alias_writer().
+ALIAS_WORKERS = 4
+_alias_executor = None
+
+# Saves are numbered when SaveToS3 is called, an alias is only written by a later save than the one
+# it holds, so concurrent or queued saves leave it at the latest one.
+_save_numbers = itertools.count(1)
+_alias_save_numbers = {}
+_alias_write_lock = threading.Lock()
+
+# Background uploader used in write-behind mode, see enable_write_behind().
+_upload_queue = None
+
 
 def get_tool_spec():
     """
@@ -27,21 +81,224 @@ def get_tool_spec():
     }
 
 
-def SaveToS3(code):
+def get_bucket_name():
+    """
+    Returns the bucket the code is saved to, config.py is imported on first use.
+
+    :return: The bucket name.
+    """
+    global _bucket_name
+    if _bucket_name is None:
+        from config import bucket_name
+
+        _bucket_name = bucket_name
+    return _bucket_name
+
+
+def __getattr__(name):
+    # The bucket used to be imported at module load, keep save_to_s3_tool.bucket_name working
+    if name == "bucket_name":
+        return get_bucket_name()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def get_s3_client():
+    """
+    Returns the process-wide S3 client, it is created on first use and shared between threads.
+
+    :return: The S3 client.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                from botocore.config import Config
+
+                _s3_client = boto3.client(
+                    's3',
+                    config=Config(connect_timeout=S3_CONNECT_TIMEOUT, read_timeout=S3_READ_TIMEOUT),
+                )
+    return _s3_client
+
+
+def enable_write_behind(**options):
+    """
+    Switches SaveToS3 to write-behind mode: uploads are queued and done in the background,
+    and SaveToS3 returns a pending receipt right away. Pending uploads are flushed at exit.
+    ::param options: Options of the s3_upload_queue.UploadQueue.
+    """
+    global _upload_queue
+    with _state_lock:
+        if _upload_queue is None:
+            _upload_queue = UploadQueue(_save, **options)
+            atexit.register(flush)
+
+
+def flush(timeout=None, upload_ids=None):
+    """
+    Waits until the queued uploads are finished. Does nothing if write-behind mode is off.
+    ::param timeout: The maximum time to wait, None waits forever.
+    ::param upload_ids: The "upload_id" of the pending receipts to wait for, None waits for all queued uploads.
+    ::return: True if the uploads finished, False if the timeout expired.
+    ::raises UploadFailed: If any of the uploads failed, so the code was not saved.
+    """
+    if _upload_queue is None:
+        return True
+    return _upload_queue.flush(timeout, upload_ids)
+
+
+def SaveToS3(code, alias=DEFAULT_ALIAS, compress=False):
     """
-    Saves the input code to the s3 bucket.
+    Saves the input code to the s3 bucket under a content-addressed key.
+    Code that is already in the bucket is not uploaded again.
     ::param code: The code to be saved.
-    ::return: The output of the save
-    """
-    file_code = code
-    s3_client = boto3.client('s3')
-    file_name = "backend.py"
-    s3_client.put_object(
-        Bucket=bucket_name,
-        Key=file_name,
-        Body=file_code
-    )
+    ::param alias: Optional stable key that is pointed to the saved code.
+    ::param compress: If True, the content-addressed artifact is stored gzip compressed above GZIP_THRESHOLD.
+    ::return: The output of the save, or a pending receipt in write-behind mode
+    """
+    save_number = next(_save_numbers)
+    if _upload_queue is None:
+        return _save(code, alias, compress, save_number)
+
+    digest = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    try:
+        upload_id = _upload_queue.submit(
+            code, alias, compress, save_number, timeout=deadline.remaining(SUBMIT_TIMEOUT)
+        )
+    except queue.Full:
+        return {
+            'error': 'true',
+            'message': "The code was not saved, the upload queue stayed full. Try again later.",
+        }
+    return {
+        'statusCode': 202,
+        'body': f"Output queued for saving to s3://{get_bucket_name()}/{alias or _key(digest)}",
+        'key': _key(digest),
+        'sha256': digest,
+        'pending': True,
+        'upload_id': upload_id,
+    }
+
+
+def _key(digest):
+    return f"{KEY_PREFIX}{digest}.py"
+
+
+def _save(code, alias, compress, save_number):
+    """
+    Uploads the code unless it is already in the bucket, and writes it to the alias at the same time.
+    No request is started once the current deadline of the turn has passed, see utils.deadline.
+    """
+    deadline.check("the code was saved to S3")
+    s3_client = get_s3_client()
+    file_code = code.encode('utf-8')
+    digest = hashlib.sha256(file_code).hexdigest()
+    file_name = _key(digest)
+
+    with span("s3_save", bytes=len(file_code)) as record:
+        alias_update = None
+        if alias is not None:
+            deadline.check(f"the alias {alias} was updated")
+            # The alias is a plain copy of the code, written while the artifact is checked and uploaded
+            alias_update = _alias_writer().submit(_put_alias, s3_client, alias, file_code, digest, save_number)
+
+        skipped = _exists(s3_client, file_name, digest)
+        record['skipped'] = skipped
+        if not skipped:
+            deadline.check("the code was uploaded to S3")
+            record['uploaded_bytes'] = _upload(s3_client, file_name, file_code, digest, compress)
+            with _state_lock:
+                _known_hashes.add(digest)
+
+        if alias_update is not None:
+            alias_update.result()
+
     return {
         'statusCode': 200,
-        'body': f"Output saved to s3://{bucket_name}/{file_name}"
-    }
\ No newline at end of file
+        'body': f"Output saved to s3://{get_bucket_name()}/{alias or file_name}",
+        'key': file_name,
+        'sha256': digest,
+        'skipped': skipped,
+    }
+
+
+def _alias_writer():
+    """
+    Returns the threads writing the aliases, they are started on first use.
+    """
+    global _alias_executor
+    with _state_lock:
+        if _alias_executor is None:
+            _alias_executor = ThreadPoolExecutor(max_workers=ALIAS_WORKERS, thread_name_prefix="s3-alias")
+    return _alias_executor
+
+
+def _put_alias(s3_client, alias, file_code, digest, save_number):
+    """
+    Writes the uncompressed code to the alias, so a plain get_object of the alias returns the source.
+    Alias writes are serialized, and skipped if the alias already holds a later save or the same code.
+    """
+    with _alias_write_lock:
+        if save_number < _alias_save_numbers.get(alias, 0):
+            return
+        if _alias_hashes.get(alias) != digest:
+            s3_client.put_object(
+                Bucket=get_bucket_name(),
+                Key=alias,
+                Body=file_code,
+                ContentType='text/x-python',
+                Metadata={'sha256': digest},
+            )
+        with _state_lock:
+            _alias_hashes[alias] = digest
+            _alias_save_numbers[alias] = save_number
+
+
+def _exists(s3_client, file_name, digest):
+    """
+    Checks whether the content-addressed object is already in the bucket.
+    """
+    if digest in _known_hashes:
+        return True
+    try:
+        s3_client.head_object(Bucket=get_bucket_name(), Key=file_name)
+    except Exception as error:
+        from botocore.exceptions import ClientError
+
+        if isinstance(error, ClientError) and error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    with _state_lock:
+        _known_hashes.add(digest)
+    return True
+
+
+def _upload(s3_client, file_name, file_code, digest, compress):
+    """
+    Uploads the code, compressed above GZIP_THRESHOLD and in parts above MULTIPART_THRESHOLD.
+    :return: The number of uploaded bytes.
+    """
+    extra_args = {'ContentType': 'text/x-python', 'Metadata': {'sha256': digest}}
+    if compress and len(file_code) >= GZIP_THRESHOLD:
+        file_code = gzip.compress(file_code)
+        extra_args['ContentEncoding'] = 'gzip'
+
+    if len(file_code) >= MULTIPART_THRESHOLD:
+        from boto3.s3.transfer import TransferConfig
+
+        s3_client.upload_fileobj(
+            io.BytesIO(file_code),
+            get_bucket_name(),
+            file_name,
+            ExtraArgs=extra_args,
+            Config=TransferConfig(multipart_threshold=MULTIPART_THRESHOLD),
+        )
+    else:
+        s3_client.put_object(
+            Bucket=get_bucket_name(),
+            Key=file_name,
+            Body=file_code,
+            **extra_args
+        )
+    return len(file_code)
@@ -0,0 +1,203 @@
+import logging
+import threading
+
+# Timeout (in seconds) of tools registered without one.
+DEFAULT_TOOL_TIMEOUT = 60
+
+# Maximum number of concurrently running tools per concurrency class.
+DEFAULT_CONCURRENCY_LIMITS = {"default": 4, "s3": 8, "sandbox": 4}
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+def compile_schema(schema, path="input"):
+    """
+    Compiles a JSON schema into a validation function, so the schema is interpreted once and not on
+    every tool call. Supports the subset used by tool input schemas: type, properties, required,
+    additionalProperties (false), items, enum, minLength and maxLength.
+
+    :param schema: The JSON schema.
+    :param path: The name of the validated value in error messages.
+    :return: Function returning the list of errors of a value, empty if it is valid.
+    """
+    checks = []
+
+    if "type" in schema:
+        expected = _JSON_TYPES[schema["type"]]
+        type_name = schema["type"]
+
+        def check_type(value, errors):
+            # bool is a subclass of int, but not a JSON number
+            if not isinstance(value, expected) or (isinstance(value, bool) and type_name != "boolean"):
+                errors.append(f"{path} must be of type {type_name}")
+                return False
+            return True
+
+        checks.append(check_type)
+
+    if "enum" in schema:
+        allowed = schema["enum"]
+
+        def check_enum(value, errors):
+            if value not in allowed:
+                errors.append(f"{path} must be one of {allowed}")
+            return True
+
+        checks.append(check_enum)
+
+    if "minLength" in schema or "maxLength" in schema:
+        min_length, max_length = schema.get("minLength", 0), schema.get("maxLength")
+
+        def check_length(value, errors):
+            if not isinstance(value, str):
+                errors.append(f"{path} must be of type string")
+                return False
+            if len(value) < min_length or (max_length is not None and len(value) > max_length):
+                errors.append(f"{path} must be between {min_length} and {max_length} characters long")
+            return True
+
+        checks.append(check_length)
+
+    if "properties" in schema or "required" in schema:
+        properties = {
+            name: compile_schema(property_schema, f"{path}.{name}")
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+        required = schema.get("required", [])
+        closed = schema.get("additionalProperties") is False
+
+        def check_properties(value, errors):
+            # Without a "type" in the schema the type check did not run
+            if not isinstance(value, dict):
+                errors.append(f"{path} must be of type object")
+                return False
+            for name in required:
+                if name not in value:
+                    errors.append(f"{path}.{name} is required")
+            for name, item in value.items():
+                if name in properties:
+                    errors.extend(properties[name](item))
+                elif closed:
+                    errors.append(f"{path}.{name} is not allowed")
+            return True
+
+        checks.append(check_properties)
+
+    if "items" in schema:
+        validate_item = compile_schema(schema["items"], f"{path}[]")
+
+        def check_items(value, errors):
+            if not isinstance(value, list):
+                errors.append(f"{path} must be of type array")
+                return False
+            for item in value:
+                errors.extend(validate_item(item))
+            return True
+
+        checks.append(check_items)
+
+    def validate(value):
+        errors = []
+        for check in checks:
+            # Later checks assume the type check passed
+            if not check(value, errors):
+                break
+        return errors
+
+    return validate
+
+
+class ToolRegistry:
+    """
+    Registry of the tools available to the model. Each tool declares its spec, handler, timeout and
+    concurrency class. Dispatch is a dict lookup, inputs are validated against the precompiled input
+    schema before the handler runs, and the toolConfig for the Converse API is built once.
+    """
+
+    def __init__(self, concurrency_limits=None):
+        """
+        :param concurrency_limits: Optional mapping of concurrency class to the maximum number of
+                                   concurrently running tools of that class.
+        """
+        self.concurrency_limits = dict(DEFAULT_CONCURRENCY_LIMITS, **(concurrency_limits or {}))
+        self._tools = {}
+        self._semaphores = {}
+        self._tool_config = None
+
+    def register(self, spec, handler, timeout=DEFAULT_TOOL_TIMEOUT, concurrency_class="default"):
+        """
+        :param spec: The tool specification, as returned by get_tool_spec() of a tool module.
+        :param handler: Function called with the validated input, returns the tool's response.
+        :param timeout: The tool's timeout in seconds.
+        :param concurrency_class: The class whose concurrency limit applies to the tool.
+        """
+        tool_spec = spec["toolSpec"]
+        if concurrency_class not in self._semaphores:
+            limit = self.concurrency_limits.get(concurrency_class, self.concurrency_limits["default"])
+            self._semaphores[concurrency_class] = threading.BoundedSemaphore(limit)
+        self._tools[tool_spec["name"]] = {
+            "spec": spec,
+            "handler": handler,
+            "validate": compile_schema(tool_spec["inputSchema"]["json"]),
+            "timeout": timeout,
+            "semaphore": self._semaphores[concurrency_class],
+        }
+        self._tool_config = None
+
+    def tool_config(self):
+        """
+        :return: The toolConfig for the Converse API, built once and cached until a tool is registered.
+        """
+        if self._tool_config is None:
+            self._tool_config = {"tools": [tool["spec"] for tool in self._tools.values()]}
+        return self._tool_config
+
+    def timeout(self, tool_name):
+        tool = self._tools.get(tool_name)
+        return tool["timeout"] if tool else DEFAULT_TOOL_TIMEOUT
+
+    def invoke(self, payload):
+        """
+        Invokes the requested tool. Unknown tools, invalid inputs and failing handlers result in an
+        error response for the model instead of an exception.
+
+        :param payload: The toolUse payload with toolUseId, name and input, and the inputError if the
+                        streamed input could not be decoded.
+        :return: The toolUseId and the tool's response or an error message.
+        """
+        tool_name = payload["name"]
+        tool = self._tools.get(tool_name)
+
+        if tool is None:
+            response = {
+                "error": "true",
+                "message": f"The requested tool with name '{tool_name}' does not exist.",
+            }
+        elif "inputError" in payload:
+            response = {
+                "error": "true",
+                "message": f"Invalid input for the tool '{tool_name}': input is not valid JSON: {payload['inputError']}.",
+            }
+        elif errors := tool["validate"](payload["input"]):
+            response = {
+                "error": "true",
+                "message": f"Invalid input for the tool '{tool_name}': {'; '.join(errors)}.",
+                "errors": errors,
+            }
+        else:
+            try:
+                with tool["semaphore"]:
+                    response = tool["handler"](payload["input"])
+            except Exception as error:
+                logging.exception(f"The tool '{tool_name}' failed.")
+                response = {"error": "true", "message": f"The tool '{tool_name}' failed: {error}"}
+
+        return {"toolUseId": payload["toolUseId"], "content": response}
@@ -1,10 +1,24 @@
-import boto3
+import asyncio
+import contextlib
+import functools
 import logging
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from enum import Enum
 import json
 
 import utils.tool_use_print_utils as output
+from utils import instrumentation
+from utils.deadline import Deadline, DeadlineExceeded
+from utils.rate_limiter import is_throttling_error, limiter as bedrock_limiter
+import run_python_tool as RunPython_tool
 import save_to_s3_tool as SaveToS3_tool
+from model_router import ModelRouter, TurnType
+from response_cache import CacheMode, ReplayMissError, request_key
+from tool_registry import ToolRegistry
 
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
@@ -15,193 +29,882 @@ AWS_REGION = "us-east-1"
 # https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference.html
 class SupportedModels(Enum):
     CLAUDE_SONNET = "anthropic.claude-3-sonnet-20240229-v1:0"
+    CLAUDE_3_5_SONNET = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+    CLAUDE_HAIKU = "anthropic.claude-3-haiku-20240307-v1:0"
 
 
 # Set the model ID, e.g., Claude 3 Haiku.
 MODEL_ID = SupportedModels.CLAUDE_SONNET.value
 
+# Models per turn type when a ModelRouter is used, see default_model_router(). Code is always written by
+# MODEL_ID, successful tool results are summarized by the faster of the interchangeable models.
+MODEL_ROUTES = {
+    TurnType.CODE_GENERATION: {
+        "models": [MODEL_ID],
+        "fallbacks": [SupportedModels.CLAUDE_3_5_SONNET.value],
+    },
+    TurnType.TOOL_RESULT_SUMMARY: {
+        "models": [SupportedModels.CLAUDE_HAIKU.value, MODEL_ID],
+        "fallbacks": [SupportedModels.CLAUDE_3_5_SONNET.value],
+    },
+}
+
+# Seconds without data from the model before a call times out, the router then falls back to another model.
+MODEL_READ_TIMEOUT = 60
+
+# Requests per second allowed per model, match these to the service quotas of the account.
+MODEL_REQUESTS_PER_SECOND = {
+    SupportedModels.CLAUDE_SONNET.value: 500 / 60,
+    SupportedModels.CLAUDE_3_5_SONNET.value: 250 / 60,
+    SupportedModels.CLAUDE_HAIKU.value: 1000 / 60,
+}
+
+for _model_id, _rate in MODEL_REQUESTS_PER_SECOND.items():
+    bedrock_limiter.set_quota(_model_id, _rate)
+
 SYSTEM_PROMPT = """
 You are a good backend engineer who writes python scripts for the applications based on the architecture from the architecture.
 Then invokes SaveToS3Tool and saves the code to s3.
 
 - Explain your step-by-step process, and give brief updates before each step.
-- For the code you write run tests to ensure it works as expected.
+- For the code you write run tests with the RunPythonTool to ensure it works as expected.
 - Complete the entire process until you have all required data before sending the complete response.
 - Only use the SaveToS3Tool for code saving the final code version.
 - Repeat the tool use for subsequent requests if necessary.
 """
 
-# The maximum number of recursive calls allowed in the tool_use_demo function.
+# The maximum number of model turns allowed in one conversation.
 # This helps prevent infinite loops and potential performance issues.
 MAX_RECURSIONS = 5
 
 
-class BackendWriter:
+class ConversationStatus(Enum):
+    COMPLETE = "complete"
+    STOPPED = "stopped"
+    MAX_TURNS_REACHED = "max_turns_reached"
+    # The latency budget of the turn ran out, the conversation holds the messages completed until then.
+    DEADLINE_EXCEEDED = "deadline_exceeded"
+    # Queued uploads to S3 failed after all attempts, the code the conversation saved is lost.
+    UPLOAD_FAILED = "upload_failed"
+
+
+# The maximum number of model calls in flight at the same time across all asynchronous
+# conversations running on an event loop.
+MAX_CONCURRENT_MODEL_CALLS = 8
+
+# Upper bound on the number of tools executed at the same time when the model
+# requests several tools in one message and parallel tool use is enabled.
+MAX_TOOL_WORKERS = 4
+
+# Timeout (in seconds) of the SaveToS3Tool, applied in parallel tool use mode.
+SAVE_TO_S3_TIMEOUT = 30
+
+# Timeout (in seconds) of the RunPythonTool, the sandbox itself stops the code after its wall clock limit.
+RUN_PYTHON_TIMEOUT = 30
+
+# How often (in seconds) the running tools are checked for timeouts.
+TOOL_POLL_INTERVAL = 0.05
+
+# One model call semaphore per event loop, asyncio primitives cannot be shared between loops.
+_model_call_semaphores = weakref.WeakKeyDictionary()
+
+
+def _model_call_semaphore():
     """
-    Demonstrates the tool use feature with the Amazon Bedrock Converse API.
+    Returns the semaphore limiting the in-flight model calls on the running event loop.
     """
+    loop = asyncio.get_running_loop()
+    if loop not in _model_call_semaphores:
+        _model_call_semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENT_MODEL_CALLS)
+    return _model_call_semaphores[loop]
 
-    def __init__(self):
-        # Prepare the system prompt
-        self.system_prompt = [{"text": SYSTEM_PROMPT}]
 
-        # Prepare the tool configuration with the weather tool's specification
-        self.tool_config = {"tools": [SaveToS3_tool.get_tool_spec()]}
+def _with_deadline(deadline, function):
+    """
+    Returns the function wrapped to run with the deadline applied, e.g. on a worker thread, see Deadline.run().
+    """
+    return function if deadline is None else functools.partial(deadline.run, function)
+
+
+async def _within(deadline, awaitable, what):
+    """
+    Awaits the awaitable, or raises DeadlineExceeded once the deadline has passed. Work running on a
+    worker thread is not interrupted, it is abandoned and finishes in the background.
+
+    :param deadline: The Deadline, or None to wait without a limit.
+    :param what: What is awaited, used in the error message.
+    """
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining())
+    except DeadlineExceeded:
+        raise
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(f"The time budget of {deadline.seconds}s ran out before {what}.") from None
+
+
+# Number of runs printing their progress, the progress output consumes the instrumentation events meanwhile.
+_printing_runs = 0
+_printing_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _progress_output(enabled):
+    """
+    Subscribes the progress output to the instrumentation events for the enclosed run, if enabled.
+    """
+    global _printing_runs
+    if not enabled:
+        yield
+        return
+    with _printing_lock:
+        _printing_runs += 1
+        instrumentation.subscribe(output.print_event)
+    try:
+        yield
+    finally:
+        with _printing_lock:
+            _printing_runs -= 1
+            if not _printing_runs:
+                instrumentation.unsubscribe(output.print_event)
+
+
+def _run_coroutine(coroutine):
+    """
+    Runs the coroutine to completion from synchronous code. If the current thread is already
+    running an event loop (e.g. in a Jupyter notebook), the coroutine runs on a helper thread.
+
+    :param coroutine: The coroutine to run.
+    :return: The coroutine's result.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _is_call_error(error):
+    """
+    Whether the error is a failed or timed out call to AWS. botocore is imported here, on the error path,
+    so importing this module does not load it.
+    """
+    from botocore.exceptions import ClientError, ConnectTimeoutError, ReadTimeoutError
+
+    return isinstance(error, (ClientError, ConnectTimeoutError, ReadTimeoutError))
 
-        # Create a Bedrock Runtime client in the specified AWS Region.
-        self.bedrockRuntimeClient = boto3.client(
-            "bedrock-runtime", region_name=AWS_REGION
-        )
 
-    def run(self, prompt):
+class _MessageAssembler:
+    """
+    Assembles a model message from the events of a converse_stream response.
+    """
+
+    def __init__(self):
+        self.role = "assistant"
+        self.blocks = {}
+        self.stop_reason = None
+        # Why the input of a tool use request could not be decoded, by toolUseId
+        self.input_errors = {}
+
+    def feed(self, event):
         """
-        Starts the conversation with the user and handles the interaction with Bedrock.
+        Consumes one stream event. The input of a tool use request is streamed as JSON fragments,
+        which are collected and parsed once the content block is complete.
+
+        :param event: The event from the response stream.
+        :return: The list of conversation events produced by the stream event.
+        """
+        if "messageStart" in event:
+            self.role = event["messageStart"]["role"]
+            return [{"type": "message_start", "role": self.role}]
+
+        if "contentBlockStart" in event:
+            start = event["contentBlockStart"]["start"]
+            if "toolUse" in start:
+                self.blocks[event["contentBlockStart"]["contentBlockIndex"]] = {
+                    "toolUse": dict(start["toolUse"]),
+                    "fragments": [],
+                }
+
+        elif "contentBlockDelta" in event:
+            index = event["contentBlockDelta"]["contentBlockIndex"]
+            delta = event["contentBlockDelta"]["delta"]
+            if "text" in delta:
+                self.blocks.setdefault(index, {"text": []})["text"].append(delta["text"])
+                return [{"type": "text_delta", "text": delta["text"]}]
+            if "toolUse" in delta:
+                self.blocks[index]["fragments"].append(delta["toolUse"]["input"])
+
+        elif "contentBlockStop" in event:
+            block = self.blocks.get(event["contentBlockStop"]["contentBlockIndex"])
+            if block and "toolUse" in block:
+                raw_input = "".join(block.pop("fragments"))
+                try:
+                    block["toolUse"]["input"] = json.loads(raw_input) if raw_input else {}
+                except json.JSONDecodeError as error:
+                    # The message sent back to the model needs an object, the tool is not invoked with it
+                    logging.warning(f"Warning: Malformed input for tool '{block['toolUse']['name']}'.")
+                    block["toolUse"]["input"] = {}
+                    self.input_errors[block["toolUse"]["toolUseId"]] = str(error)
+                return [{"type": "tool_use", "toolUse": block["toolUse"]}]
+
+        elif "messageStop" in event:
+            self.stop_reason = event["messageStop"]["stopReason"]
+            return [{"type": "message_stop", "stopReason": self.stop_reason}]
+
+        return []
+
+    def message(self):
         """
-        # Print the greeting and a short user guide
-        output.header()
+        :return: The assembled message and the stop reason.
+        """
+        content = []
+        for index in sorted(self.blocks):
+            block = self.blocks[index]
+            if "text" in block:
+                content.append({"text": "".join(block["text"])})
+            else:
+                content.append({"toolUse": block["toolUse"]})
 
-        # Start with an emtpy conversation
-        conversation = []
-
-        # Get the first user input
-        user_input = prompt
-        message = {"role": "user", "content": [{"text": user_input}]}
-        conversation.append(message)
-        # Send the conversation to Amazon Bedrock
-        bedrock_response = self._send_conversation_to_bedrock(conversation)
-
-        # Recursively handle the model's response until the model has returned
-        # its final response or the recursion counter has reached 0
-        self._process_model_response(
-            bedrock_response, conversation, max_recursion=MAX_RECURSIONS
-        )
+        return {"role": self.role, "content": content}, self.stop_reason
+
+
+def _resulting_code(conversation):
+    """
+    :param conversation: The conversation history.
+    :return: The code of the last SaveToS3Tool request in the conversation, or None.
+    """
+    code = None
+    for message in conversation:
+        for content_block in message["content"]:
+            tool_use = content_block.get("toolUse")
+            if tool_use and tool_use["name"] == "SaveToS3Tool":
+                code = tool_use["input"].get("code", code)
+    return code
+
+
+def _pending_uploads(conversation):
+    """
+    :param conversation: The conversation history.
+    :return: The upload IDs of the SaveToS3Tool requests in the conversation that were queued in write-behind mode.
+    """
+    return [
+        content["json"]["upload_id"]
+        for message in conversation
+        for content_block in message["content"]
+        if "toolResult" in content_block
+        for content in content_block["toolResult"]["content"]
+        if isinstance(content.get("json"), dict) and "upload_id" in content["json"]
+    ]
 
-        # Repeat the loop until the user decides to exit the application
-        # user_input = self._get_user_input()
 
-        output.footer()
-        
+def default_tool_registry():
+    """
+    :return: A ToolRegistry with the tools available to the BackendWriter.
+    """
+    tools = ToolRegistry()
+    tools.register(
+        SaveToS3_tool.get_tool_spec(),
+        lambda input_data: SaveToS3_tool.SaveToS3(input_data['code']),
+        timeout=SAVE_TO_S3_TIMEOUT,
+        concurrency_class="s3",
+    )
+    tools.register(
+        RunPython_tool.get_tool_spec(),
+        lambda input_data: RunPython_tool.RunPython(input_data['code'], input_data.get('tests')),
+        timeout=RUN_PYTHON_TIMEOUT,
+        concurrency_class="sandbox",
+    )
+    return tools
+
+
+def default_model_router():
+    """
+    :return: A ModelRouter with the MODEL_ROUTES.
+    """
+    return ModelRouter(MODEL_ROUTES)
 
-    def _send_conversation_to_bedrock(self, conversation):
+
+class BackendWriter:
+    """
+    Demonstrates the tool use feature with the Amazon Bedrock Converse API.
+    """
+
+    def __init__(
+        self,
+        parallel_tools=False,
+        max_tool_workers=MAX_TOOL_WORKERS,
+        tool_timeouts=None,
+        bedrock_runtime_client=None,
+        compactor=None,
+        response_cache=None,
+        write_behind=False,
+        tool_registry=None,
+        rate_limiter=None,
+        router=None,
+    ):
+        """
+        :param parallel_tools: If True, all toolUse blocks of a message are dispatched at the same time
+                               on a bounded thread pool instead of one after another.
+        :param max_tool_workers: The maximum number of tools running concurrently.
+        :param tool_timeouts: Optional mapping of tool name to timeout in seconds, overrides the
+                              timeouts declared in the tool registry.
+        :param bedrock_runtime_client: Optional bedrock-runtime client, e.g. a stub for testing.
+        :param compactor: Optional conversation compactor, e.g. a ConversationCompactor, applied before
+                          every call to Bedrock to keep the payload within a budget.
+        :param response_cache: Optional response_cache.ResponseCache in front of the calls to Bedrock.
+        :param write_behind: If True, SaveToS3Tool queues the upload and returns right away,
+                             run() waits for the queued uploads before it finishes.
+        :param tool_registry: Optional ToolRegistry, defaults to default_tool_registry().
+        :param rate_limiter: Optional utils.rate_limiter.RateLimiter for the calls to Bedrock, defaults to
+                             the process-wide limiter shared by all writers.
+        :param router: Optional model_router.ModelRouter choosing the model of every call, e.g.
+                       default_model_router(). Without a router every call goes to MODEL_ID.
         """
-        Sends the conversation, the system prompt, and the tool spec to Amazon Bedrock, and returns the response.
+        self.parallel_tools = parallel_tools
+        self.max_tool_workers = max_tool_workers
+        self.tool_timeouts = tool_timeouts or {}
+        self.compactor = compactor
+        self.response_cache = response_cache
+        self.rate_limiter = rate_limiter or bedrock_limiter
+        self.router = router
+        if write_behind:
+            SaveToS3_tool.enable_write_behind()
 
-        :param conversation: The conversation history including the next message to send.
-        :return: The response from Amazon Bedrock.
+        # Prepare the system prompt
+        self.system_prompt = [{"text": SYSTEM_PROMPT}]
+
+        # Prepare the tool configuration with the specifications of the registered tools
+        self.tools = tool_registry or default_tool_registry()
+        self.tool_config = self.tools.tool_config()
+
+        # The Bedrock Runtime client is created on the first model call, see bedrockRuntimeClient
+        self._bedrock_runtime_client = bedrock_runtime_client
+        self._client_lock = threading.Lock()
+
+    @property
+    def bedrockRuntimeClient(self):
+        """
+        The Bedrock Runtime client in the specified AWS Region, created on first use.
+        Throttled calls are retried by the rate limiter, which also slows down the other callers.
         """
-        output.call_to_bedrock(conversation)
+        if self._bedrock_runtime_client is None:
+            with self._client_lock:
+                if self._bedrock_runtime_client is None:
+                    import boto3
+                    from botocore.config import Config
+
+                    self._bedrock_runtime_client = boto3.client(
+                        "bedrock-runtime",
+                        region_name=AWS_REGION,
+                        config=Config(
+                            retries={"mode": "standard", "max_attempts": 1},
+                            read_timeout=MODEL_READ_TIMEOUT,
+                        ),
+                    )
+        return self._bedrock_runtime_client
+
+    def run(self, prompt, max_turns=MAX_RECURSIONS, budget=None):
+        """
+        Starts the conversation with the user and handles the interaction with Bedrock.
+        The model's response is printed while it is being generated.
 
-        # Send the conversation, system prompt, and tool configuration, and return the response
-        return self.bedrockRuntimeClient.converse(
-            modelId=MODEL_ID,
-            messages=conversation,
-            system=self.system_prompt,
-            toolConfig=self.tool_config,
+        :param prompt: The user's request.
+        :param max_turns: The maximum number of model turns before the conversation is stopped.
+        :param budget: Optional latency budget in seconds, see stream_async().
+        :return: The final "done" event of the conversation, see stream_async().
+        """
+        result = _run_coroutine(
+            self.run_async(prompt, max_turns=max_turns, print_output=True, budget=budget)
         )
+        self.resulting_code = result["resulting_code"]
+        return result
 
-    def _process_model_response(
-        self, model_response, conversation, max_recursion=MAX_RECURSIONS
-    ):
+    def stream(self, prompt, max_turns=MAX_RECURSIONS, budget=None):
         """
-        Processes the response received via Amazon Bedrock and performs the necessary actions
-        based on the stop reason.
+        Synchronous version of stream_async(), yields the same events.
 
-        :param model_response: The model's response returned via Amazon Bedrock.
-        :param conversation: The conversation history.
-        :param max_recursion: The maximum number of recursive calls allowed.
+        :param prompt: The user's request.
+        :param max_turns: The maximum number of model turns before the conversation is stopped.
+        :param budget: Optional latency budget in seconds, see stream_async().
+        """
+        # The event loop is driven from a helper thread, so this also works inside a running loop
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        events = self.stream_async(prompt, max_turns=max_turns, budget=budget)
+        try:
+            while True:
+                try:
+                    yield executor.submit(
+                        loop.run_until_complete, events.__anext__()
+                    ).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            executor.submit(loop.run_until_complete, events.aclose()).result()
+            executor.shutdown()
+            loop.close()
+
+    async def run_async(self, prompt, max_turns=MAX_RECURSIONS, print_output=False, budget=None):
+        """
+        Runs the conversation to the end without blocking the event loop.
+
+        :param prompt: The user's request.
+        :param max_turns: The maximum number of model turns before the conversation is stopped.
+        :param print_output: If True, the greeting, the streamed response and the footer are printed.
+        :param budget: Optional latency budget in seconds, see stream_async(). It includes waiting
+                       for the queued uploads in write-behind mode.
+        :return: The final "done" event of the conversation, see stream_async(). In write-behind mode
+                 its status is upload_failed, with the "failed_uploads", if queued uploads failed.
         """
+        with _progress_output(print_output):
+            return await self._run_async(prompt, max_turns, print_output, budget)
+
+    async def _run_async(self, prompt, max_turns, print_output, budget):
+        if print_output:
+            # Print the greeting and a short user guide
+            output.header()
+
+        deadline = budget if budget is None or isinstance(budget, Deadline) else Deadline(budget)
+        result = None
+        async for event in self.stream_async(prompt, max_turns=max_turns, budget=deadline):
+            if event["type"] == "done":
+                result = event
+            elif not print_output:
+                continue
+            elif event["type"] == "message_start":
+                output.model_response_start()
+            elif event["type"] == "text_delta":
+                output.model_response_delta(event["text"])
+            elif event["type"] == "message_stop":
+                output.model_response_end()
+
+        # Make sure the uploads queued by this conversation are written before it is reported as done
+        try:
+            flushed = await asyncio.to_thread(
+                SaveToS3_tool.flush,
+                None if deadline is None else deadline.remaining(),
+                _pending_uploads(result["conversation"]),
+            )
+        except SaveToS3_tool.UploadFailed as error:
+            result["status"] = ConversationStatus.UPLOAD_FAILED.value
+            result["failed_uploads"] = [str(failure) for _, failure in error.failures]
+        else:
+            if not flushed:
+                # The uploads go on in the background and are flushed at exit
+                result["status"] = ConversationStatus.DEADLINE_EXCEEDED.value
 
-        if max_recursion <= 0:
-            # Stop the process, the number of recursive calls could indicate an infinite loop
+        if result["status"] == ConversationStatus.MAX_TURNS_REACHED.value:
             logging.warning(
                 "Warning: Maximum number of recursions reached. Please try again."
             )
-            exit(1)
+        elif result["status"] == ConversationStatus.DEADLINE_EXCEEDED.value:
+            logging.warning(
+                f"Warning: The time budget of {deadline.seconds}s ran out, the result is incomplete."
+            )
+        elif result["status"] == ConversationStatus.UPLOAD_FAILED.value:
+            logging.error(
+                f"Error: The code could not be saved to S3: {'; '.join(result['failed_uploads'])}"
+            )
 
-        # Append the model's response to the ongoing conversation
-        message = model_response["output"]["message"]
-        conversation.append(message)
+        if print_output:
+            output.footer()
+        return result
 
-        if model_response["stopReason"] == "tool_use":
-            # If the stop reason is "tool_use", forward everything to the tool use handler
-            self._handle_tool_use(message, conversation, max_recursion)
+    async def stream_async(self, prompt, max_turns=MAX_RECURSIONS, budget=None):
+        """
+        Runs the conversation as a loop of streamed model turns and tool invocations.
+        All conversation state is local to the call, so one writer can serve many prompts concurrently.
+        Bedrock and tool calls run on worker threads, and the number of model calls in flight is
+        limited by MAX_CONCURRENT_MODEL_CALLS.
+
+        Yields the following events (dicts with a "type" key) as they happen:
+        - message_start: the model started a new message.
+        - text_delta: a chunk of generated text, in "text".
+        - tool_use: a complete tool use request, in "toolUse".
+        - tool_result: the result returned to the model, in "toolResult".
+        - message_stop: the model finished a message, with its "stopReason".
+        - done: the final event, with the "status", number of "turns", the "conversation",
+          and the "resulting_code" saved by the model.
+
+        :param prompt: The user's request.
+        :param max_turns: The maximum number of model turns before the conversation is stopped.
+        :param budget: Optional latency budget in seconds, or a Deadline. Model calls, tools, S3 uploads and
+                       agent calls get the remaining time as their timeout. Once it has run out, running
+                       tools are cancelled and the conversation ends with the status deadline_exceeded and
+                       the messages completed until then, including the text of an interrupted message.
+        """
+        deadline = budget if budget is None or isinstance(budget, Deadline) else Deadline(budget)
 
+        # Start with an emtpy conversation
+        conversation = [{"role": "user", "content": [{"text": prompt}]}]
+        status = ConversationStatus.MAX_TURNS_REACHED
+        stop_reason = None
+        turn = 0
+
+        for turn in range(1, max_turns + 1):
+            # Send the conversation to Amazon Bedrock and collect the streamed message
+            assembler = _MessageAssembler()
+            try:
+                async for event in self._stream_model_message(conversation, assembler, deadline):
+                    yield event
+            except DeadlineExceeded:
+                # Tool use requests of the interrupted message are dropped, they would have no results
+                message, _ = assembler.message()
+                text = [content_block for content_block in message["content"] if "text" in content_block]
+                if text:
+                    conversation.append({"role": message["role"], "content": text})
+                status = ConversationStatus.DEADLINE_EXCEEDED
+                break
+            message, stop_reason = assembler.message()
+
+            # Append the model's response to the ongoing conversation
+            conversation.append(message)
+
+            if stop_reason != "tool_use":
+                status = (
+                    ConversationStatus.COMPLETE
+                    if stop_reason == "end_turn"
+                    else ConversationStatus.STOPPED
+                )
+                break
 
-        if model_response["stopReason"] == "end_turn":
-            # If the stop reason is "end_turn", print the model's response text, and finish the process
-            output.model_response(message["content"][0]["text"])
-            return
+            # Forward the tool use requests to the tools and return the results to the model
+            tool_results = await asyncio.to_thread(
+                self._dispatch_tool_uses, message, deadline, assembler.input_errors
+            )
+            for tool_result in tool_results:
+                yield {"type": "tool_result", "toolResult": tool_result["toolResult"]}
+            conversation.append({"role": "user", "content": tool_results})
+
+            if deadline is not None and deadline.expired():
+                status = ConversationStatus.DEADLINE_EXCEEDED
+                break
+
+        # Reaching max_turns could indicate an infinite loop
+        yield {
+            "type": "done",
+            "status": status.value,
+            "stopReason": stop_reason,
+            "turns": turn,
+            "conversation": conversation,
+            "resulting_code": _resulting_code(conversation),
+        }
+
+    def _send_conversation_to_bedrock(self, conversation, span=None):
+        """
+        Sends the conversation, the system prompt, and the tool spec to Amazon Bedrock,
+        and returns the response's event stream.
 
-    def _handle_tool_use(
-        self, model_response, conversation, max_recursion=MAX_RECURSIONS
-    ):
+        :param conversation: The conversation history including the next message to send.
+        :param span: Optional attributes of the model_call span, the request size is added to them.
+        :return: The event stream of the response from Amazon Bedrock.
         """
-        Handles the tool use case by invoking the specified tool and sending the tool's response back to Bedrock.
-        The tool response is appended to the conversation, and the conversation is sent back to Amazon Bedrock for further processing.
-
-        :param model_response: The model's response containing the tool use request.
-        :param conversation: The conversation history.
-        :param max_recursion: The maximum number of recursive calls allowed.
-        """
-
-        # Initialize an empty list of tool results
-        tool_results = []
-        # The model's response can consist of multiple content blocks
-        for content_block in model_response["content"]:
-            if "text" in content_block:
-                # If the content block contains text, print it to the console
-                output.model_response(content_block["text"])
-            print(content_block)
-            if "toolUse" in content_block:
-                # If the content block is a tool use request, forward it to the tool
-                tool_response = self._invoke_tool(content_block["toolUse"])
-
-                # Add the tool use ID and the tool's response to the list of results
-                tool_results.append(
-                    {
-                        "toolResult": {
-                            "toolUseId": (tool_response["toolUseId"]),
-                            "content": [{"json": tool_response["content"]}],
-                        }
-                    }
+        span = {} if span is None else span
+
+        # Shrink older turns if the conversation exceeds the compactor's budget
+        messages = conversation
+        if self.compactor is not None:
+            messages, report = self.compactor.compact(conversation)
+            if report["saved_bytes"] > 0:
+                instrumentation.emit({"type": "conversation_compacted", **report})
+
+        request = {
+            "modelId": MODEL_ID,
+            "messages": messages,
+            "system": self.system_prompt,
+            "toolConfig": self.tool_config,
+        }
+        span["messages"] = len(messages)
+        span["request_bytes"] = len(json.dumps(messages).encode("utf-8"))
+
+        if self.response_cache is None:
+            # Send the conversation, system prompt, and tool configuration, and return the response
+            return self._routed_converse_stream(request, conversation, span)
+
+        # Identical requests are answered from the cache, whichever model the router picks
+        key = request_key(request)
+        if self.response_cache.mode != CacheMode.RECORD:
+            events = self.response_cache.get(key)
+            if events is not None:
+                span["cached"] = True
+                instrumentation.emit({"type": "response_from_cache", "key": key})
+                return iter(events)
+            if self.response_cache.mode == CacheMode.REPLAY:
+                raise ReplayMissError(f"No recorded response for request {key}.")
+
+        return self._record_response(
+            key, self._routed_converse_stream(request, conversation, span)
+        )
+
+    def _routed_converse_stream(self, request, conversation, span):
+        """
+        Starts the streamed response with the model picked by the router. A candidate that is throttled
+        or times out is recorded as failing and the next one is tried, the last one is retried by the
+        rate limiter.
+
+        :param request: The Converse request with the default model.
+        :param conversation: The conversation history including the next message to send.
+        :param span: The attributes of the model_call span, the model and turn type are added to them.
+        :return: The event stream of the response from Amazon Bedrock.
+        """
+        if self.router is None:
+            span["model_id"] = request["modelId"]
+            return self._converse_stream(request)
+
+        kind, candidates = self.router.candidates(conversation, span["request_bytes"])
+        span["turn_type"] = kind.value
+        for index, model_id in enumerate(candidates):
+            last = index == len(candidates) - 1
+            try:
+                stream = self._converse_stream(
+                    dict(request, modelId=model_id), max_attempts=None if last else 1
+                )
+            except Exception as error:
+                if not _is_call_error(error):
+                    raise
+                from botocore.exceptions import ClientError
+
+                self.router.record(model_id, kind, span["request_bytes"], error=True)
+                if last or (isinstance(error, ClientError) and not is_throttling_error(error)):
+                    raise
+                reason = error.response["Error"]["Code"] if isinstance(error, ClientError) else type(error).__name__
+                logging.warning(
+                    f"Warning: {model_id} is not available ({reason}), "
+                    f"falling back to {candidates[index + 1]}."
                 )
+                continue
+            span["model_id"] = model_id
+            return stream
 
-        # Embed the tool results in a new user message
-        message = {"role": "user", "content": tool_results}
+    def _converse_stream(self, request, max_attempts=None):
+        """
+        Starts the streamed response within the model's quota, throttled calls are retried.
 
-        # Append the new message to the ongoing conversation
-        conversation.append(message)
+        :param request: The Converse request.
+        :param max_attempts: Optional number of attempts, see RateLimiter.call().
+        :return: The event stream of the response from Amazon Bedrock.
+        """
+        return self.rate_limiter.call(
+            request["modelId"],
+            self.bedrockRuntimeClient.converse_stream,
+            max_attempts=max_attempts,
+            **request,
+        )["stream"]
+
+    def _record_response(self, key, stream):
+        """
+        Passes the response events through and stores them in the response cache once the
+        response is complete.
 
-        # Send the conversation to Amazon Bedrock
-        response = self._send_conversation_to_bedrock(conversation)
+        :param key: The request key.
+        :param stream: The event stream of the response from Amazon Bedrock.
+        """
+        events = []
+        for event in stream:
+            events.append(event)
+            yield event
+        if any("messageStop" in event for event in events):
+            self.response_cache.put(key, events)
+
+    async def _stream_model_message(self, conversation, assembler, deadline=None):
+        """
+        Streams one model message, yielding text deltas and tool use events as they arrive.
 
-        # Recursively handle the model's response until the model has returned
-        # its final response or the recursion counter has reached 0
-        self._process_model_response(response, conversation, max_recursion - 1)
+        :param conversation: The conversation history including the next message to send.
+        :param assembler: The _MessageAssembler collecting the message.
+        :param deadline: Optional Deadline of the turn.
+        :raises DeadlineExceeded: If the deadline passed before the message was complete, the
+                                  assembler holds the events received until then.
+        """
+        semaphore = _model_call_semaphore()
+        await _within(deadline, semaphore.acquire(), "a model call could be made")
+        try:
+            with instrumentation.span(
+                "model_call",
+                returning_tool_results="toolResult" in conversation[-1]["content"][0],
+            ) as span:
+                start = time.perf_counter()
+                response = await _within(
+                    deadline,
+                    asyncio.to_thread(
+                        _with_deadline(deadline, self._send_conversation_to_bedrock), conversation, span
+                    ),
+                    "the model call started",
+                )
+                stream = iter(response)
+                try:
+                    while True:
+                        try:
+                            event = await _within(
+                                deadline, asyncio.to_thread(next, stream, None), "the model's message was complete"
+                            )
+                        except DeadlineExceeded:
+                            # Closing the response ends the read the abandoned worker thread is blocked in
+                            with contextlib.suppress(Exception):
+                                getattr(response, "close", lambda: None)()
+                            raise
+                        if event is None:
+                            break
+                        if "metadata" in event:
+                            # Token usage and the model's own latency arrive after messageStop
+                            usage = event["metadata"].get("usage", {})
+                            span["input_tokens"] = usage.get("inputTokens", 0)
+                            span["output_tokens"] = usage.get("outputTokens", 0)
+                            span["latency_ms"] = event["metadata"].get("metrics", {}).get("latencyMs", 0)
+                        for conversation_event in assembler.feed(event):
+                            yield conversation_event
+                except Exception as error:
+                    # Part of the message was already streamed, so there is no fallback to another model
+                    if _is_call_error(error):
+                        self._record_route(span, error=True)
+                    raise
+                self._record_route(
+                    span, latency_ms=span.get("latency_ms") or (time.perf_counter() - start) * 1000
+                )
+        finally:
+            semaphore.release()
+
+    def _record_route(self, span, latency_ms=None, error=False):
+        """
+        Reports the outcome of a routed model call to the router, cached responses are not reported.
+        """
+        if self.router is not None and "turn_type" in span and not span.get("cached"):
+            self.router.record(
+                span["model_id"], TurnType(span["turn_type"]), span["request_bytes"],
+                latency_ms=latency_ms, error=error,
+            )
+
+    def _dispatch_tool_uses(self, message, deadline=None, input_errors=None):
+        """
+        Invokes the tools requested in the model's message.
+
+        :param message: The model's message containing the tool use requests.
+        :param deadline: Optional Deadline of the turn, tools still running when it passes are cancelled.
+        :param input_errors: Optional mapping of toolUseId to the reason its input is not valid JSON,
+                             these requests are answered with the reason instead of invoking the tool.
+        :return: The toolResult content blocks, in the order of the toolUse blocks.
+        """
+        input_errors = input_errors or {}
+        tool_uses = [
+            dict(content_block["toolUse"], inputError=input_errors[content_block["toolUse"]["toolUseId"]])
+            if content_block["toolUse"]["toolUseId"] in input_errors
+            else content_block["toolUse"]
+            for content_block in message["content"]
+            if "toolUse" in content_block
+        ]
+
+        # Forward the tool use requests to the tools, the responses keep the order of the blocks
+        # With a deadline the tools run on worker threads even one at a time, so a hanging tool can be abandoned
+        if deadline is not None or (self.parallel_tools and len(tool_uses) > 1):
+            tool_responses = self._invoke_tools_concurrently(tool_uses, deadline)
+        else:
+            tool_responses = [self._invoke_tool(tool_use) for tool_use in tool_uses]
+
+        # Add the tool use ID and the tool's response to the list of results
+        return [
+            {
+                "toolResult": {
+                    "toolUseId": (tool_response["toolUseId"]),
+                    "content": [{"json": tool_response["content"]}],
+                }
+            }
+            for tool_response in tool_responses
+        ]
 
     def _invoke_tool(self, payload):
         """
         Invokes the specified tool with the given payload and returns the tool's response.
-        If the requested tool does not exist, an error message is returned.
+        If the requested tool does not exist or the input is invalid, an error message is returned.
 
         :param payload: The payload containing the tool name and input data.
         :return: The tool's response or an error message.
         """
-        tool_name = payload["name"]
+        with instrumentation.span(
+            "tool",
+            tool=payload["name"],
+            input=payload["input"],
+            input_bytes=len(json.dumps(payload["input"]).encode("utf-8")),
+        ) as span:
+            response = self.tools.invoke(payload)
+            span["failed"] = isinstance(response["content"], dict) and response["content"].get("error") == "true"
+        return response
+
+    def _invoke_tools_concurrently(self, tool_uses, deadline=None):
+        """
+        Invokes all requested tools on a bounded thread pool and waits for them to finish.
+        A tool that runs longer than its timeout gets an error response, the other results are kept.
+        Without parallel tool use the tools run one at a time.
+
+        :param tool_uses: The toolUse payloads in the order the model requested them.
+        :param deadline: Optional Deadline of the turn. The tools run with it applied, and the tools
+                         still pending when it passes are cancelled with an error response.
+        :return: The tools' responses in the same order as tool_uses.
+        """
+        executor = ThreadPoolExecutor(
+            max_workers=min(self.max_tool_workers if self.parallel_tools else 1, len(tool_uses)),
+            thread_name_prefix="tool",
+        )
+        started_at = {}
+        invoke_tool = _with_deadline(deadline, self._invoke_tool)
+
+        def run(index, payload):
+            started_at[index] = time.monotonic()
+            return invoke_tool(payload)
+
+        futures = {
+            executor.submit(run, index, payload): index
+            for index, payload in enumerate(tool_uses)
+        }
+        tool_responses = [None] * len(tool_uses)
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(
+                    pending, timeout=TOOL_POLL_INTERVAL, return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    tool_responses[futures[future]] = future.result()
+
+                # The timeout only starts counting once a worker picked the tool up
+                now = time.monotonic()
+                for future in list(pending):
+                    index = futures[future]
+                    payload = tool_uses[index]
+                    timeout = self.tool_timeouts.get(payload["name"]) or self.tools.timeout(payload["name"])
+                    if index in started_at and now - started_at[index] > timeout:
+                        logging.warning(
+                            f"Warning: Tool '{payload['name']}' timed out after {timeout}s."
+                        )
+                        pending.discard(future)
+                        tool_responses[index] = {
+                            "toolUseId": payload["toolUseId"],
+                            "content": {
+                                "error": "true",
+                                "message": f"The tool '{payload['name']}' timed out after {timeout} seconds.",
+                            },
+                        }
 
-        if tool_name == "SaveToS3Tool":
-            input_data = payload["input"]
-            output.tool_use(tool_name, input_data)
-            # Invoke the weather tool with the input data provided by
-            response = SaveToS3_tool.SaveToS3(input_data['code'])
-            self.resulting_code = input_data['code']
-        else:
-            error_message = (
-                f"The requested tool with name '{tool_name}' does not exist."
-            )
-            response = {"error": "true", "message": error_message}
+                if pending and deadline is not None and deadline.expired():
+                    for future in pending:
+                        payload = tool_uses[futures[future]]
+                        logging.warning(f"Warning: Tool '{payload['name']}' was cancelled, the time budget ran out.")
+                        tool_responses[futures[future]] = {
+                            "toolUseId": payload["toolUseId"],
+                            "content": {
+                                "error": "true",
+                                "message": f"The tool '{payload['name']}' was cancelled, "
+                                           f"the time budget of {deadline.seconds} seconds ran out.",
+                            },
+                        }
+                    pending = set()
+        finally:
+            # Do not block the conversation on tools that timed out
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return {"toolUseId": payload["toolUseId"], "content": response}
+        return tool_responses
 
     @staticmethod
     def _get_user_input(prompt="Your weather info request"):
@@ -226,6 +929,25 @@ class BackendWriter:
             return user_input
 
 
+class AsyncBackendWriter(BackendWriter):
+    """
+    Asyncio-native BackendWriter, run() and stream() are coroutines / async generators.
+    Conversation state is kept per request, so one instance can serve many prompts concurrently:
+
+        writer = AsyncBackendWriter()
+        results = await asyncio.gather(*(writer.run(prompt) for prompt in prompts))
+    """
+
+    async def run(self, prompt, max_turns=MAX_RECURSIONS, print_output=False, budget=None):
+        return await self.run_async(prompt, max_turns=max_turns, print_output=print_output, budget=budget)
+
+    def stream(self, prompt, max_turns=MAX_RECURSIONS, budget=None):
+        return self.stream_async(prompt, max_turns=max_turns, budget=budget)
+
+
 if __name__ == "__main__":
-    tool_use_demo = BackendWriter()
-    tool_use_demo.run()
\ No newline at end of file
+    # The request is taken from the command line, or asked for; see batch_runner.py for many requests
+    prompt = " ".join(sys.argv[1:]) or BackendWriter._get_user_input("Your architecture description")
+    if prompt is not None:
+        tool_use_demo = BackendWriter()
+        tool_use_demo.run(prompt)
\ No newline at end of file
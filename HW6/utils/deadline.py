@@ -0,0 +1,95 @@
+"""
+Latency budgets for a user's turn. A Deadline is created when the turn starts and passed down the call chain;
+code running on its behalf applies it with Deadline.run() or Deadline.applied(), so the calls further down
+(the rate limiter, S3, the sandbox, the code executor agent) use the remaining time as their timeout via
+remaining() and check(), without every signature taking a deadline parameter.
+"""
+
+import contextvars
+import time
+from contextlib import contextmanager
+
+# The deadline applied to the running code, see Deadline.applied().
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when the latency budget of a turn has run out before a call could complete."""
+
+
+class Deadline:
+    """
+    A point in time by which a turn must be answered, shared by all calls made for the turn.
+    """
+
+    def __init__(self, seconds):
+        """
+        :param seconds: The latency budget, starting now.
+        """
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """:return: The seconds left, 0 once the deadline has passed."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, timeout=None):
+        """
+        :param timeout: The call's own timeout, if any.
+        :return: The timeout to use for a call, the call's own one capped at the remaining time.
+        """
+        return self.remaining() if timeout is None else min(timeout, self.remaining())
+
+    def check(self, what="the call"):
+        """
+        :param what: The call about to be made, used in the error message.
+        :raises DeadlineExceeded: If the deadline has passed.
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"The time budget of {self.seconds}s ran out before {what}.")
+
+    @contextmanager
+    def applied(self):
+        """
+        Makes this the current deadline of the enclosed block, see current(). An earlier current
+        deadline stays in effect.
+        """
+        outer = _current.get()
+        token = _current.set(self if outer is None or self.expires_at < outer.expires_at else outer)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs) with this deadline applied, e.g. on a worker thread.
+        """
+        with self.applied():
+            return function(*args, **kwargs)
+
+
+def current():
+    """:return: The Deadline applied to the running code, or None."""
+    return _current.get()
+
+
+def remaining(timeout=None):
+    """
+    :param timeout: The call's own timeout, returned as is without a current deadline.
+    :return: The timeout to use for a call, capped at the remaining time of the current deadline.
+    """
+    deadline = _current.get()
+    return timeout if deadline is None else deadline.timeout(timeout)
+
+
+def check(what="the call"):
+    """
+    :raises DeadlineExceeded: If the current deadline has passed.
+    """
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.check(what)
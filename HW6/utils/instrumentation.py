@@ -0,0 +1,193 @@
+"""
+Lightweight instrumentation: spans around model calls, tool invocations, S3 uploads and provisioning waits.
+Every span emits a span_start and a span_end event to the subscribed consumers, and the numeric attributes
+of finished spans (duration, tokens, bytes) are collected in in-process histograms.
+"""
+
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Relative width of the histogram buckets, percentiles are accurate to about 19%.
+BUCKET_BASE = 2 ** 0.25
+
+# Strings longer than this are truncated in the JSONL sink, e.g. the code passed to a tool.
+MAX_FIELD_CHARS = 200
+
+
+class Histogram:
+    """
+    Histogram with exponentially growing buckets, so it needs constant memory however many values it records.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buckets = {}
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bucket = math.ceil(math.log(value, BUCKET_BASE)) if value > 0 else None
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, q):
+        """
+        :param q: The percentile, between 0 and 100.
+        :return: The upper bound of the bucket holding the percentile, clamped to the recorded range.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = self._buckets.get(None, 0)
+        if seen >= rank:
+            return max(self.min, 0.0)
+        for bucket in sorted(key for key in self._buckets if key is not None):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(max(BUCKET_BASE ** bucket, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max if self.count else 0.0,
+        }
+
+
+class JsonlSink:
+    """
+    Consumer that appends every event as one JSON line to a file.
+    """
+
+    def __init__(self, path, max_field_chars=MAX_FIELD_CHARS):
+        """
+        :param path: The file the events are appended to.
+        :param max_field_chars: Longer strings are truncated.
+        """
+        self.max_field_chars = max_field_chars
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(self._truncate(event), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_field_chars:
+            return value[:self.max_field_chars] + f"...[{len(value) - self.max_field_chars} chars]"
+        if isinstance(value, dict):
+            return {key: self._truncate(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._truncate(item) for item in value]
+        return value
+
+
+class Instrumentation:
+    """
+    Distributes events to consumers and keeps one histogram per span name and numeric attribute,
+    e.g. "model_call.duration_ms" or "model_call.output_tokens".
+    """
+
+    def __init__(self):
+        self._consumers = []
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, consumer):
+        """
+        :param consumer: Function called with every event, a dict with a "type" key.
+        """
+        with self._lock:
+            if consumer not in self._consumers:
+                self._consumers.append(consumer)
+
+    def unsubscribe(self, consumer):
+        with self._lock:
+            if consumer in self._consumers:
+                self._consumers.remove(consumer)
+
+    def emit(self, event):
+        """
+        Passes the event to all consumers. A failing consumer is logged and does not affect the caller.
+        """
+        for consumer in list(self._consumers):
+            try:
+                consumer(event)
+            except Exception:
+                logging.exception("An instrumentation consumer failed.")
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Times the enclosed block. The yielded dict holds the span's attributes, attributes added to it
+        inside the block (e.g. token counts) are part of the span_end event and the histograms.
+
+        :param name: The name of the span, e.g. "model_call".
+        :param attributes: The attributes known when the span starts.
+        """
+        record = dict(attributes)
+        self.emit({"type": "span_start", "name": name, "time": time.time(), **attributes})
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception as error:
+            record["error"] = type(error).__name__
+            raise
+        finally:
+            record["duration_ms"] = (time.perf_counter() - start) * 1000
+            with self._lock:
+                for attribute, value in record.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        self._histograms.setdefault(f"{name}.{attribute}", Histogram()).record(value)
+            self.emit({"type": "span_end", "name": name, "time": time.time(), **record})
+
+    def histograms(self):
+        """
+        :return: The summary of every histogram by metric name, see Histogram.summary().
+        """
+        with self._lock:
+            return {metric: histogram.summary() for metric, histogram in sorted(self._histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+# The process-wide instrumentation used by the tools, the BackendWriter and the code executor agent.
+instrumentation = Instrumentation()
+span = instrumentation.span
+emit = instrumentation.emit
+subscribe = instrumentation.subscribe
+unsubscribe = instrumentation.unsubscribe
+histograms = instrumentation.histograms
+
+
+def enable_jsonl(path):
+    """
+    Appends all events of the process-wide instrumentation to a JSONL file.
+
+    :param path: The file the events are appended to.
+    :return: The JsonlSink, unsubscribe and close it to stop.
+    """
+    sink = JsonlSink(path)
+    subscribe(sink)
+    return sink
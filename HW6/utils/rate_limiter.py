@@ -0,0 +1,199 @@
+"""
+Client-side rate limiting for the calls to Amazon Bedrock. Every quota (a model ID, or a control plane API)
+has a token bucket whose rate adapts to throttling: it is halved when the service throttles and grows back
+slowly while calls succeed. Throttled calls are retried with jittered exponential backoff.
+"""
+
+import random
+import threading
+import time
+
+from utils import deadline
+from utils.deadline import DeadlineExceeded
+from utils.instrumentation import emit
+
+# Requests per second and burst size of quotas without an explicit configuration.
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 4
+
+# The adaptive rate never drops below this, in requests per second.
+MIN_RATE = 0.1
+
+# Factor applied to the rate on throttling, and the fraction of the quota added back per successful call.
+DECREASE_FACTOR = 0.5
+INCREASE_FRACTION = 0.05
+
+# The rate is decreased at most once per this many seconds, so a burst of throttled calls counts once.
+DECREASE_COOLDOWN = 1.0
+
+# Retries of throttled calls.
+MAX_ATTEMPTS = 6
+BASE_BACKOFF = 0.5
+MAX_BACKOFF = 20
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "Throttling",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+}
+
+
+def is_throttling_error(error):
+    # botocore is imported on the error path, importing the limiter does not load it
+    from botocore.exceptions import ClientError
+
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+
+class _Bucket:
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token, going into debt if none is left, so concurrent callers queue up in order.
+
+        :return: The number of seconds the caller must wait before its call.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease >= DECREASE_COOLDOWN:
+                self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+                self.last_decrease = now
+            # Calls already waiting for a token must not go out at the old rate
+            self.tokens = min(self.tokens, 0.0)
+            return self.rate
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * INCREASE_FRACTION)
+
+
+class RateLimiter:
+    """
+    Adaptive token buckets per quota, shared by all threads and event loops of the process.
+    Waiting happens outside of any lock, with time.sleep() in call() and asyncio.sleep() in call_async().
+    """
+
+    def __init__(self, quotas=None, default_rate=DEFAULT_RATE, default_burst=DEFAULT_BURST,
+                 max_attempts=MAX_ATTEMPTS):
+        """
+        :param quotas: Optional mapping of quota key (e.g. a model ID) to requests per second,
+                       or to a (requests per second, burst) pair.
+        :param default_rate: The rate of quotas that are not configured.
+        :param default_burst: The burst of quotas that are not configured.
+        :param max_attempts: The maximum number of attempts of a throttled call.
+        """
+        self.default_rate = default_rate
+        self.default_burst = default_burst
+        self.max_attempts = max_attempts
+        self._buckets = {}
+        self._lock = threading.Lock()
+        for key, quota in (quotas or {}).items():
+            self.set_quota(key, *(quota if isinstance(quota, tuple) else (quota,)))
+
+    def set_quota(self, key, rate, burst=None):
+        """
+        :param key: The quota key, e.g. a model ID.
+        :param rate: The quota in requests per second, the adaptive rate never exceeds it.
+        :param burst: The number of calls that may go out at once, defaults to max(1, rate).
+        """
+        with self._lock:
+            self._buckets[key] = _Bucket(rate, burst or max(1, round(rate)))
+
+    def rate(self, key):
+        """:return: The current adaptive rate of the quota in requests per second."""
+        return self._bucket(key).rate
+
+    def call(self, key, function, *args, max_attempts=None, **kwargs):
+        """
+        Calls function(*args, **kwargs) within the quota, retrying throttled calls.
+
+        :param key: The quota key.
+        :param max_attempts: Optional number of attempts overriding the limiter's, e.g. 1 if the caller
+                             falls back to another quota on throttling.
+        :return: The function's result.
+        :raises ClientError: If the call failed for another reason than throttling, or was
+                             throttled max_attempts times.
+        :raises DeadlineExceeded: If the current deadline (see utils.deadline) passes before the call can be made.
+        """
+        bucket = self._bucket(key)
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(1, max_attempts + 1):
+            time.sleep(self._within_deadline(key, bucket.reserve()))
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                if not is_throttling_error(error) or attempt == max_attempts:
+                    raise
+                time.sleep(self._within_deadline(key, self._throttled(key, bucket, attempt)))
+                continue
+            bucket.succeeded()
+            return result
+
+    async def call_async(self, key, function, *args, max_attempts=None, **kwargs):
+        """
+        Awaits function(*args, **kwargs) within the quota without blocking the event loop,
+        see call().
+        """
+        # asyncio is imported here, the synchronous callers (e.g. the code executor agent) do not need it
+        import asyncio
+
+        bucket = self._bucket(key)
+        max_attempts = max_attempts or self.max_attempts
+        for attempt in range(1, max_attempts + 1):
+            await asyncio.sleep(self._within_deadline(key, bucket.reserve()))
+            try:
+                result = await function(*args, **kwargs)
+            except Exception as error:
+                if not is_throttling_error(error) or attempt == max_attempts:
+                    raise
+                await asyncio.sleep(self._within_deadline(key, self._throttled(key, bucket, attempt)))
+                continue
+            bucket.succeeded()
+            return result
+
+    def _bucket(self, key):
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = _Bucket(self.default_rate, self.default_burst)
+            return self._buckets[key]
+
+    @staticmethod
+    def _within_deadline(key, wait):
+        """
+        Returns the wait before the next attempt, or raises DeadlineExceeded right away if the current
+        deadline would pass before the attempt can be made.
+        """
+        if deadline.remaining(wait) < wait:
+            raise DeadlineExceeded(f"The time budget ran out waiting {wait:.1f}s for the '{key}' quota.")
+        deadline.check(f"the call to '{key}'")
+        return wait
+
+    @staticmethod
+    def _throttled(key, bucket, attempt):
+        """
+        Slows the quota down and returns the backoff before the next attempt, with full jitter.
+        """
+        rate = bucket.throttled()
+        emit({"type": "throttled", "key": key, "attempt": attempt, "rate": rate})
+        return random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempt - 1)))
+
+
+# The process-wide limiter shared by all Bedrock call sites.
+limiter = RateLimiter()
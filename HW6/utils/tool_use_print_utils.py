@@ -33,18 +33,56 @@ def footer():
     separator("=")
 
 
-def call_to_bedrock(conversation):
+def print_event(event):
+    """
+    Consumer of instrumentation events (see utils.instrumentation), logs the ones of interest to the user.
+
+    :param event: The instrumentation event.
+    """
+    name = event.get("name")
+    if event["type"] == "span_start" and name == "model_call":
+        call_to_bedrock(event["returning_tool_results"])
+    elif event["type"] == "span_start" and name == "tool":
+        tool_use(event["tool"], event["input"])
+    elif event["type"] == "response_from_cache":
+        response_from_cache(event["key"])
+    elif event["type"] == "conversation_compacted":
+        conversation_compacted(event)
+
+
+def call_to_bedrock(returning_tool_results):
     """
     Logs information about the call to Amazon Bedrock.
 
-    :param conversation: The conversation history.
+    :param returning_tool_results: True if the call returns tool results to the model.
     """
-    if "toolResult" in conversation[-1]["content"][0]:
+    if returning_tool_results:
         print("\033[0;90mReturning the tool response(s) to the model...\033[0m")
     else:
         print("\033[0;90mSending the query to the model...\033[0m")
 
 
+def response_from_cache(key):
+    """
+    Logs that the model's response was served from the response cache.
+
+    :param key: The cache key of the request.
+    """
+    print(f"\033[0;90mUsing the cached response {key[:12]}...\033[0m")
+
+
+def conversation_compacted(report):
+    """
+    Logs how much the conversation was shrunk before sending it to the model.
+
+    :param report: The compaction report with the original, compacted and saved bytes.
+    """
+    print(
+        f"\033[0;90mCompacted the conversation from {report['original_bytes']} to "
+        f"{report['compacted_bytes']} bytes ({report['saved_bytes']} bytes saved)...\033[0m"
+    )
+
+
 def tool_use(tool_name, input_data):
     """
     Logs information about the tool use.
@@ -65,6 +103,29 @@ def model_response(message):
     print(message)
 
 
+def model_response_start():
+    """
+    Logs the start of a streamed model response.
+    """
+    print("\033[0;90mThe model's response:\033[0m")
+
+
+def model_response_delta(text):
+    """
+    Logs a chunk of a streamed model response without a line break.
+
+    :param text: The generated text chunk.
+    """
+    print(text, end="", flush=True)
+
+
+def model_response_end():
+    """
+    Logs the end of a streamed model response.
+    """
+    print("")
+
+
 def separator(char="-"):
     """
     Logs a separator line.
@@ -0,0 +1,65 @@
+import random
+import time
+
+from utils import deadline
+from utils.instrumentation import span
+
+# Defaults for polling a resource until it reaches the expected state.
+DEFAULT_TIMEOUT = 300
+INITIAL_DELAY = 0.5
+MAX_DELAY = 8
+BACKOFF_FACTOR = 1.6
+JITTER = 0.25
+
+
+def wait_for(
+    fetch,
+    is_ready,
+    description,
+    is_failed=None,
+    timeout=DEFAULT_TIMEOUT,
+    initial_delay=INITIAL_DELAY,
+    max_delay=MAX_DELAY,
+    factor=BACKOFF_FACTOR,
+    jitter=JITTER,
+    on_poll=None,
+):
+    """
+    Polls fetch() until is_ready(result) is true. The delay between polls grows exponentially
+    from initial_delay up to max_delay, with random jitter so concurrent waiters do not poll in lockstep.
+
+    :param fetch: Function returning the current state of the resource.
+    :param is_ready: Predicate on the fetched state, True once the resource is ready.
+    :param description: What is being waited for, used in error messages.
+    :param is_failed: Optional predicate on the fetched state, True if the resource will never be ready.
+    :param timeout: The deadline in seconds, capped at the current deadline of the turn (see utils.deadline).
+    :param initial_delay: The delay before the second poll in seconds.
+    :param max_delay: The upper bound of the delay between polls in seconds.
+    :param factor: The factor the delay grows by after every poll.
+    :param jitter: The relative amount of random variation of each delay.
+    :param on_poll: Optional callback called with every fetched state, e.g. to print progress.
+    :return: The fetched state that satisfied is_ready.
+    :raises TimeoutError: If the resource was not ready before the deadline,
+                          DeadlineExceeded if the turn's deadline was the earlier one.
+    :raises RuntimeError: If is_failed returned True.
+    """
+    expires_at = time.monotonic() + timeout
+    delay = initial_delay
+    with span("wait", description=description) as record:
+        record["polls"] = 0
+        while True:
+            state = fetch()
+            record["polls"] += 1
+            if on_poll is not None:
+                on_poll(state)
+            if is_ready(state):
+                return state
+            if is_failed is not None and is_failed(state):
+                raise RuntimeError(f"Failed while waiting for {description}: {state}")
+
+            remaining = expires_at - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s waiting for {description}.")
+            deadline.check(f"{description} was reached")
+            time.sleep(min(delay * random.uniform(1 - jitter, 1 + jitter), deadline.remaining(remaining)))
+            delay = min(delay * factor, max_delay)
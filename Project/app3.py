@@ -1,104 +1,364 @@
+import time
+
+_rerun_start = time.perf_counter()
+
+import queue
+import threading
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
-from langchain_aws.agents.base import BedrockAgentsRunnable
-from langchain_community.tools import DuckDuckGoSearchResults
-from langchain.agents import Tool
-from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI
-from langgraph.prebuilt import create_react_agent
-from langsmith import traceable
-import boto3
 import config as conf
+from history_manager import HistoryManager
 
-# Initialize the Streamlit app
-st.title("Coding Interview Preparation Agent")
+# Number of recent reruns kept for the timing report.
+TIMING_WINDOW = 1000
+
+# Opt-in: answer near-duplicate requests to the Bedrock agent from the semantic cache.
+SEMANTIC_CACHE_ENABLED = getattr(conf, "semantic_cache", False)
+
+# Number of most recent chat messages shown, older ones are rendered a page of this size at a time on request.
+DISPLAY_WINDOW = 20
+
+# Attempts of a throttled call to the Bedrock agent before the turn fails.
+AGENT_MAX_ATTEMPTS = 6
+
+# Latency budget of a turn in seconds. The agent, search and model calls of the turn get the remaining time
+# as their timeout, and the answer streamed until then is shown if the budget runs out.
+TURN_BUDGET_SECONDS = getattr(conf, "turn_budget_seconds", 60)
+
+# Worker threads running the graphs of the turns, and the Bedrock agent calls made by their tools. The two
+# pools are separate, so a graph waiting for its agent call never holds the worker the call is queued for.
+TURN_WORKERS = 16
+AGENT_CALL_WORKERS = 16
+
+
+@st.cache_resource
+def get_timings():
+    """Process-wide timings: build time of each shared resource and the duration of recent reruns."""
+    return {"builds": {}, "reruns": deque(maxlen=TIMING_WINDOW), "lock": threading.Lock()}
+
+
+def _timed_build(name, build):
+    start = time.perf_counter()
+    resource = build()
+    timings = get_timings()
+    with timings["lock"]:
+        timings["builds"][name] = time.perf_counter() - start
+    return resource
+
+
+# Keeps the agent's chat history and the graph's message history within a token budget
+history_manager = HistoryManager()
+
+
+# Heavy clients and the agent graph are built once per process on first use and shared by all
+# sessions; the LangChain imports are deferred until then.
+@st.cache_resource
+def get_bedrock_agent():
+    def build():
+        import boto3
+        from botocore.config import Config
+        from langchain_aws.agents.base import BedrockAgentsRunnable
+
+        # Set up Bedrock agent. The client is shared by all sessions, so its adaptive retry mode (a client-side
+        # token bucket that slows down on throttling, with jittered retries) paces the whole process.
+        region_name = 'us-east-1'
+        client = boto3.client(
+            service_name='bedrock-agent-runtime',
+            region_name=region_name,
+            config=Config(
+                retries={"mode": "adaptive", "max_attempts": AGENT_MAX_ATTEMPTS},
+                read_timeout=TURN_BUDGET_SECONDS,
+            ),
+        )
+        return BedrockAgentsRunnable(
+            agent_id="JQNNUTIFGE",
+            agent_alias_id="ADSXXXOCVK",
+            client=client
+        )
+
+    return _timed_build("bedrock_agent", build)
+
+
+@st.cache_resource
+def get_search():
+    def build():
+        from langchain_community.utilities import DuckDuckGoSearchAPIWrapper
+        from search_layer import SearchLayer
+
+        wrapper = DuckDuckGoSearchAPIWrapper()
+        return SearchLayer(lambda query: wrapper.results(query, max_results=5))
+
+    return _timed_build("search", build)
+
+
+@st.cache_resource
+def get_turn_executor():
+    return ThreadPoolExecutor(max_workers=TURN_WORKERS, thread_name_prefix="turn")
+
+
+@st.cache_resource
+def get_agent_executor():
+    return ThreadPoolExecutor(max_workers=AGENT_CALL_WORKERS, thread_name_prefix="agent-call")
+
+
+def remaining_budget(config):
+    """
+    :param config: The RunnableConfig of a tool call, the turn's deadline is passed in its "configurable".
+    :return: The seconds left of the turn's budget, or None without a deadline.
+    """
+    deadline = (config or {}).get("configurable", {}).get("deadline")
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+@st.cache_resource
+def get_store():
+    from conversation_store import SQLiteConversationStore
+
+    return SQLiteConversationStore(getattr(conf, "conversation_db", "conversations.sqlite3"))
+
+
+@st.cache_resource
+def get_semantic_cache():
+    from semantic_cache import SemanticCache
+
+    return SemanticCache()
 
-# Set up Bedrock agent
-region_name = 'us-east-1'
-bedrock_agent = boto3.client(service_name='bedrock-agent-runtime', region_name=region_name)
-
-bedrock_agent = BedrockAgentsRunnable(
-    agent_id="JQNNUTIFGE", 
-    agent_alias_id="ADSXXXOCVK",
-    client=bedrock_agent
-)
-
-search = DuckDuckGoSearchResults()
-
-# Define the tools
-@tool
-@traceable
-def interact_with_agent(input_query, chat_history):
-    """Interact with the agent and store chat history. Return the response."""
-    result = bedrock_agent.invoke(
-        {
-            "input": input_query,
-            "chat_history": chat_history,
-        }
-    )
-    chat_history.append(input_query)
-    chat_history.append("Assistant: " + result.return_values['output'])
-    return result
-
-@tool
-@traceable
-def search_tool(input_data):
-    """Searches for the YouTube videos explaining the problem."""
-    return search.run(input_data)
 
 # System message for the agent
-system_message = """You are a Teacher of preparation for the coding interview. You are preparing a student for the coding interview. 
+system_message = """You are a Teacher of preparation for the coding interview. You are preparing a student for the coding interview.
 When the student is communicating with you always call the interact_with_agent_tool with only one exception - when the student wants to find a video
 with the explanation of the problem. In this case, call the search_tool.
 When the user asks you to give the problem in specific topic - call interact_with_agent_tool with the user request as an input.
 If the user asks you for a video - call the search_tool with the user request and problem as an input."""
 
-# Initialize the chat model and app
-model = ChatOpenAI(model="gpt-4o", openai_api_key=conf.open_ai_key)
-app = create_react_agent(model, [interact_with_agent, search_tool], state_modifier=system_message)
+
+@st.cache_resource
+def get_app():
+    def build():
+        from langchain_core.runnables import RunnableConfig
+        from langchain_core.tools import tool
+        from langchain_openai import ChatOpenAI
+        from langgraph.prebuilt import create_react_agent
+        from langsmith import traceable
+
+        # Define the tools
+        @tool
+        @traceable
+        def interact_with_agent(input_query, chat_history, config: RunnableConfig):
+            """Interact with the agent and store chat history. Return the response."""
+            chat_history = history_manager.bound_chat_history(list(chat_history))
+
+            # Requests that depend on the conversation bypass the cache, see SemanticCache.is_follow_up
+            cache = get_semantic_cache() if SEMANTIC_CACHE_ENABLED else None
+            result = cache.get(input_query) if cache is not None else None
+            if result is None:
+                # The agent call runs on a worker thread, so it is abandoned at the turn's deadline
+                future = get_agent_executor().submit(
+                    get_bedrock_agent().invoke,
+                    {
+                        "input": input_query,
+                        "chat_history": chat_history,
+                    },
+                )
+                try:
+                    result = future.result(timeout=remaining_budget(config))
+                except TimeoutError:
+                    return "The agent did not answer within the time budget of the turn."
+                if cache is not None:
+                    cache.put(input_query, result)
+            chat_history.append(input_query)
+            chat_history.append("Assistant: " + result.return_values['output'])
+            return result
+
+        @tool
+        @traceable
+        def search_tool(input_data, config: RunnableConfig):
+            """Searches for the YouTube videos explaining the problem."""
+            try:
+                return get_search().search(input_data, timeout=remaining_budget(config))
+            except TimeoutError:
+                return "The search returned no results within the time budget of the turn."
+
+        # Initialize the chat model and app, a single model call cannot take longer than a turn
+        model = ChatOpenAI(model="gpt-4o", openai_api_key=conf.open_ai_key, timeout=TURN_BUDGET_SECONDS)
+        return create_react_agent(model, [interact_with_agent, search_tool], state_modifier=system_message)
+
+    return _timed_build("app", build)
+
+
+def show_timing_report():
+    timings = get_timings()
+    with timings["lock"]:
+        builds = dict(timings["builds"])
+        reruns = sorted(timings["reruns"])
+    with st.sidebar.expander("Performance"):
+        for name, seconds in builds.items():
+            st.write(f"Built {name} in {seconds * 1000:.0f} ms")
+        if SEMANTIC_CACHE_ENABLED:
+            st.write(f"Answer cache hit rate: {get_semantic_cache().stats()['hit_rate']:.0%}")
+        if "search" in builds:
+            search_stats = get_search().stats()
+            st.write(f"Search cache hit rate: {search_stats['hit_rate']:.0%} ({search_stats['entries']} queries cached)")
+        if reruns:
+            st.write(
+                f"Reruns: {len(reruns)}, "
+                f"p50 {reruns[len(reruns) // 2] * 1000:.1f} ms, "
+                f"p95 {reruns[int(len(reruns) * 0.95)] * 1000:.1f} ms"
+            )
+
+
+def format_message(msg):
+    if isinstance(msg, dict) and msg.get('role'):  # It's a dictionary (our message format)
+        role = "User" if msg['role'] == "human" else "Assistant"
+        return f"**{role}:** {msg['content']}"
+    return f"**{msg}**"  # It's a string (legacy format or incorrect format)
+
+
+def _show_earlier_messages():
+    st.session_state["history_pages"] = st.session_state.get("history_pages", 1) + 1
+    st.session_state["show_history"] = True
+
+
+def render_history(session_id):
+    """
+    Renders the latest DISPLAY_WINDOW messages of the session as one element, loaded from the store.
+    Every click on "Show earlier messages" adds the DISPLAY_WINDOW messages before the oldest one shown.
+    """
+    store = get_store()
+    messages = store.load_page(session_id, limit=DISPLAY_WINDOW)
+    for _ in range(st.session_state.get("history_pages", 1) - 1):
+        if not messages:
+            break
+        earlier = store.load_page(session_id, before=messages[0]["seq"], limit=DISPLAY_WINDOW)
+        if not earlier:
+            break
+        messages = earlier + messages
+    hidden = store.count(session_id) - len(messages)
+    if hidden:
+        st.caption(f"{hidden} earlier messages not shown.")
+        st.button("Show earlier messages", key="show_earlier", on_click=_show_earlier_messages)
+    if messages:
+        st.markdown("\n\n".join(format_message(msg) for msg in messages))
+
+
+def _produce(app, inputs, deadline, events, stop):
+    """Runs the agent graph on a worker thread and passes its stream to the Send handler's thread."""
+    stream = app.stream(inputs, config={"configurable": {"deadline": deadline}}, stream_mode=["messages", "values"])
+    try:
+        for item in stream:
+            # An abandoned graph gives its worker back, its tools already stopped at the deadline
+            if stop.is_set() or time.monotonic() >= deadline:
+                break
+            events.put(("item", item))
+    except Exception as error:
+        events.put(("error", error))
+    finally:
+        stream.close()
+        events.put(("end", None))
+
+
+def stream_agent(app, inputs, deadline):
+    """
+    Runs the agent graph and shows tool calls and answer tokens as they arrive, until the turn's deadline.
+    Returns the final graph state, or None if the deadline passed first, and the answer text streamed so far.
+    """
+    status = st.status("Thinking...")
+    answer = st.empty()
+    tokens = []
+    final_state = None
+    events, stop = queue.Queue(), threading.Event()
+    get_turn_executor().submit(_produce, app, inputs, deadline, events, stop)
+    while True:
+        try:
+            kind, item = events.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            # The graph finishes in the background, its tools stop at the deadline
+            stop.set()
+            status.update(label="Time budget exceeded", state="error")
+            return None, "".join(tokens)
+        if kind == "end":
+            break
+        if kind == "error":
+            raise item
+
+        mode, payload = item
+        if mode == "values":
+            final_state = payload
+            continue
+
+        chunk, metadata = payload
+        if chunk.type == "tool":
+            status.write(f"`{chunk.name}` returned.")
+        elif getattr(chunk, "tool_call_chunks", None):
+            # Text before a tool call is not the final answer
+            tokens = []
+            for call in chunk.tool_call_chunks:
+                if call.get("name"):
+                    status.write(f"Calling `{call['name']}`...")
+        elif metadata.get("langgraph_node") == "agent" and isinstance(chunk.content, str) and chunk.content:
+            tokens.append(chunk.content)
+            answer.markdown("**Assistant:** " + "".join(tokens))
+
+    status.update(label="Done", state="complete")
+    answer.markdown("**Assistant:** " + final_state['messages'][-1].content)
+    return final_state, final_state['messages'][-1].content
+
+
+# Initialize the Streamlit app
+st.title("Coding Interview Preparation Agent")
 
 # Streamlit input and buttons
 query = st.text_input("You: ", placeholder="Ask a question about coding interviews...")
 
-if 'message_history' not in st.session_state or 'internal_history' not in st.session_state:
-    st.session_state.message_history = []
-    st.session_state.internal_history = []
+# The session ID is kept in the URL and the conversation in the store, so any worker can serve the session
+if "session" not in st.query_params:
+    st.query_params["session"] = uuid.uuid4().hex
+session_id = st.query_params["session"]
 
 if st.button("Send"):
     if query:
-        # Prepare the history
-        if len(st.session_state.internal_history) > 1:
-            history = [message['messages'] for message in st.session_state.internal_history[-1:]]
-        elif st.session_state.internal_history == []:
-            history = []
-        else:
-            history = st.session_state.internal_history['messages']
+        from langchain_core.messages import convert_to_messages, messages_from_dict, messages_to_dict
+
+        # The history is kept bounded and free of duplicates between turns
+        state = get_store().load_state(session_id)
+        history = messages_from_dict(state) if state else []
 
-        # Invoke the agent
-        messages = app.invoke({"messages": history + [("human", query)]})
+        # Show the conversation so far, the new exchange is appended below it while it streams
+        st.session_state["history_pages"] = 1
+        render_history(session_id)
+        st.markdown(format_message({"role": "human", "content": query}))
 
-        # Update the message history
-        # if st.session_state.message_history == []:
-        #     st.session_state.message_history = [messages]
-        # else:
-        #     st.session_state.message_history.append(messages)
+        # Invoke the agent within the turn's latency budget
+        deadline = time.monotonic() + TURN_BUDGET_SECONDS
+        messages, answer = stream_agent(get_app(), {"messages": history + [("human", query)]}, deadline)
 
-        if st.session_state.internal_history == []:
-            st.session_state.internal_history = messages
+        if messages is None:
+            # The partial answer is kept for display, the graph state stays at the last complete turn
+            answer = (answer + "\n\n" if answer else "") + \
+                f"_The answer is incomplete, the time budget of {TURN_BUDGET_SECONDS}s ran out._"
+            st.warning(f"No complete answer within {TURN_BUDGET_SECONDS}s, showing the partial answer.")
         else:
-            st.session_state.internal_history += messages
-        
-        # Display the chat history
-        st.session_state.message_history.append({"role": "human", "content": query})
-        st.session_state.message_history.append({"role": "AI", "content": messages['messages'][-1].content})
-        
-        for msg in st.session_state.message_history:
-            if msg.get('role'):  # It's a dictionary (our message format)
-                role = "User" if msg['role'] == "human" else "Assistant"
-                st.write(f"**{role}:** {msg['content']}")
-            elif isinstance(msg, str):  # It's a string (legacy format or incorrect format)
-                st.write(f"**{msg}**")
+            # The final state already contains the history that was passed in
+            bounded = convert_to_messages(history_manager.bound_messages(messages['messages']))
+            get_store().save_state(session_id, messages_to_dict(bounded))
+
+        get_store().append(session_id, "human", query)
+        get_store().append(session_id, "AI", answer)
+elif st.session_state.pop("show_history", False):
+    # Rerun of a click on "Show earlier messages"
+    render_history(session_id)
 
 if st.button("Reset"):
-    st.session_state.message_history = []
-    st.session_state.internal_history = []
-    st.write("Conversation history cleared.")
\ No newline at end of file
+    # Stored conversations are append-only, a reset starts a new session
+    st.query_params["session"] = uuid.uuid4().hex
+    st.session_state["history_pages"] = 1
+    st.write("Conversation history cleared.")
+
+# Record how long this rerun took, excluding the report itself
+timings = get_timings()
+with timings["lock"]:
+    timings["reruns"].append(time.perf_counter() - _rerun_start)
+show_timing_report()
@@ -0,0 +1,172 @@
+"""Durable conversation store, so sessions survive restarts and can be served by any app worker."""
+
+import json
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Default number of messages per page when loading the history for display.
+PAGE_SIZE = 20
+
+# Size limit of the in-memory cache of recently active sessions, in bytes of serialized data.
+MAX_MEMORY_BYTES = 16 * 1024 * 1024
+
+
+class ConversationStore(ABC):
+    """
+    Interface of a conversation store. Chat messages are appended once per turn and never rewritten;
+    the agent state (the bounded graph history) is replaced after every turn. Other backends, e.g. a
+    shared database for workers on several hosts, implement the same methods.
+    """
+
+    @abstractmethod
+    def append(self, session_id, role, content):
+        """Appends a chat message to the session."""
+
+    @abstractmethod
+    def load_page(self, session_id, before=None, limit=PAGE_SIZE):
+        """
+        :param session_id: The session.
+        :param before: Only messages with a sequence number below this, None for the latest messages.
+        :param limit: The maximum number of messages.
+        :return: The messages as dicts with "seq", "role" and "content", oldest first.
+        """
+
+    @abstractmethod
+    def count(self, session_id):
+        """:return: The number of chat messages of the session."""
+
+    @abstractmethod
+    def load_state(self, session_id):
+        """:return: The JSON-compatible agent state of the session, or None."""
+
+    @abstractmethod
+    def save_state(self, session_id, state):
+        """Replaces the agent state of the session."""
+
+    @abstractmethod
+    def close(self):
+        """Releases the store's connections, it cannot be used afterwards."""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    SQLite conversation store, the default local backend. The database runs in WAL mode, so several app
+    workers on one host can share it. Recently active sessions are kept in memory, and the least recently
+    used sessions are evicted once the cache exceeds max_memory_bytes; they are reloaded lazily from disk.
+    """
+
+    def __init__(self, path, max_memory_bytes=MAX_MEMORY_BYTES):
+        """
+        :param path: Path of the SQLite database.
+        :param max_memory_bytes: The size limit of the in-memory session cache.
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._memory_bytes = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+            "created_at REAL NOT NULL, PRIMARY KEY (session_id, seq))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS agent_state ("
+            "session_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def append(self, session_id, role, content):
+        with self._lock:
+            # Another worker may have appended in the meantime, the sequence number comes from the database
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO messages SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ? "
+                    "FROM messages WHERE session_id = ?",
+                    (session_id, role, content, time.time(), session_id),
+                )
+            self._forget(session_id)
+
+    def load_page(self, session_id, before=None, limit=PAGE_SIZE):
+        if before is None and limit <= PAGE_SIZE:
+            return self._session(session_id)["latest"][-limit:]
+        return self._query_page(session_id, before, limit)
+
+    def count(self, session_id):
+        return self._session(session_id)["count"]
+
+    def load_state(self, session_id):
+        return self._session(session_id)["state"]
+
+    def save_state(self, session_id, state):
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO agent_state VALUES (?, ?, ?)",
+                    (session_id, json.dumps(state), time.time()),
+                )
+            self._forget(session_id)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+            self._sessions.clear()
+            self._memory_bytes = 0
+
+    def _query_page(self, session_id, before, limit):
+        with self._lock:
+            return self._rows(session_id, before, limit)
+
+    def _rows(self, session_id, before, limit):
+        """Must be called with the lock held."""
+        rows = self._db.execute(
+            "SELECT seq, role, content FROM messages WHERE session_id = ? AND seq < ? "
+            "ORDER BY seq DESC LIMIT ?",
+            (session_id, before if before is not None else 2 ** 62, limit),
+        ).fetchall()
+        return [{"seq": seq, "role": role, "content": content} for seq, role, content in reversed(rows)]
+
+    def _session(self, session_id):
+        """
+        Returns the latest page, message count and agent state of the session. The cached copy is used
+        unless another worker changed the session since, which costs one indexed query to check.
+        """
+        with self._lock:
+            version = self._db.execute(
+                "SELECT (SELECT COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?), "
+                "(SELECT updated_at FROM agent_state WHERE session_id = ?)",
+                (session_id, session_id),
+            ).fetchone()
+            cached = self._sessions.get(session_id)
+            if cached is not None and cached[0]["version"] == version:
+                self._sessions.move_to_end(session_id)
+                return cached[0]
+
+            row = self._db.execute(
+                "SELECT state FROM agent_state WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            session = {
+                "version": version,
+                # Sequence numbers start at 1 and have no gaps
+                "count": version[0],
+                "latest": self._rows(session_id, None, PAGE_SIZE),
+                "state": json.loads(row[0]) if row else None,
+            }
+
+            size = len(json.dumps(session))
+            self._forget(session_id)
+            self._sessions[session_id] = (session, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.max_memory_bytes and len(self._sessions) > 1:
+                _, (_, evicted_size) = self._sessions.popitem(last=False)
+                self._memory_bytes -= evicted_size
+        return session
+
+    def _forget(self, session_id):
+        """Drops the session from the memory cache. Must be called with the lock held."""
+        if session_id in self._sessions:
+            self._memory_bytes -= self._sessions.pop(session_id)[1]
@@ -0,0 +1,142 @@
+"""Token-budgeted chat history: a sliding window over recent turns plus a rolling summary of older ones."""
+
+# Rough number of characters per token.
+CHARS_PER_TOKEN = 4
+
+# Default budgets in tokens.
+MAX_HISTORY_TOKENS = 3000
+MAX_SUMMARY_TOKENS = 500
+
+# Characters kept from each message folded into the default summary.
+SUMMARY_SNIPPET_CHARS = 200
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+def extractive_summary(previous_summary, dropped):
+    """
+    Default summarizer without a model call: the beginning of every dropped message, appended to the previous summary.
+
+    :param previous_summary: The summary so far, may be empty.
+    :param dropped: The (role, text) pairs that no longer fit into the window.
+    :return: The new summary.
+    """
+    snippets = [
+        (f"{role}: " if role else "") + " ".join(text.split())[:SUMMARY_SNIPPET_CHARS]
+        for role, text in dropped
+    ]
+    return " | ".join(([previous_summary] if previous_summary else []) + snippets)
+
+
+def _text(message):
+    """Text of a LangChain message, a (role, content) tuple or a plain string."""
+    if isinstance(message, str):
+        return message
+    if isinstance(message, tuple):
+        return str(message[1])
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    tool_calls = getattr(message, "tool_calls", None)
+    return content + (str(tool_calls) if tool_calls else "")
+
+
+def _role(message):
+    if isinstance(message, str):
+        return ""
+    if isinstance(message, tuple):
+        return message[0]
+    return getattr(message, "type", "message")
+
+
+def _is_summary(message):
+    return _role(message) == "system" and _text(message).startswith(SUMMARY_PREFIX)
+
+
+class HistoryManager:
+    """
+    Keeps chat histories within a token budget. The latest turns are kept verbatim, older turns are folded
+    into a summary that is carried along as the first entry. Feeding the bounded history back in on the next
+    turn makes the summary roll forward, so the history stays bounded however long the session runs.
+    """
+
+    def __init__(self, max_tokens=MAX_HISTORY_TOKENS, max_summary_tokens=MAX_SUMMARY_TOKENS, summarize=None):
+        """
+        :param max_tokens: The budget of the verbatim window.
+        :param max_summary_tokens: The budget of the summary, the oldest part is cut off beyond it.
+        :param summarize: Optional summarize(previous_summary, dropped) function, e.g. backed by a model.
+                          dropped is a list of (role, text) pairs. Defaults to extractive_summary.
+        """
+        self.max_chars = max_tokens * CHARS_PER_TOKEN
+        self.max_summary_chars = max_summary_tokens * CHARS_PER_TOKEN
+        self.summarize = summarize or extractive_summary
+
+    def bound_messages(self, messages):
+        """
+        Bounds the message list of the agent graph. Messages repeated by merging graph states are removed,
+        and the history is cut at turn boundaries (a human message), so tool calls stay with their results.
+
+        :param messages: LangChain messages or (role, content) tuples, oldest first.
+        :return: The bounded messages, starting with a ("system", summary) message if turns were dropped.
+        """
+        summary, messages = self._split_summary(self._deduplicate(messages))
+
+        turns = []
+        for message in messages:
+            if not turns or _role(message) in ("human", "user"):
+                turns.append([])
+            turns[-1].append(message)
+
+        kept = self._fit(turns, lambda turn: sum(len(_text(message)) for message in turn))
+        dropped = [message for turn in turns[:len(turns) - len(kept)] for message in turn]
+        return self._with_summary(summary, dropped, [message for turn in kept for message in turn],
+                                  lambda text: ("system", text))
+
+    def bound_chat_history(self, chat_history):
+        """
+        Bounds a chat history of plain strings, as passed to the Bedrock agent.
+
+        :param chat_history: The history entries, oldest first.
+        :return: The bounded entries, starting with a summary entry if entries were dropped.
+        """
+        summary = ""
+        if chat_history and chat_history[0].startswith(SUMMARY_PREFIX):
+            summary, chat_history = chat_history[0][len(SUMMARY_PREFIX):], chat_history[1:]
+
+        kept = self._fit([[entry] for entry in chat_history], lambda entry: len(entry[0]))
+        dropped = chat_history[:len(chat_history) - len(kept)]
+        return self._with_summary(summary, dropped, [entry for entry, in kept], lambda text: text)
+
+    def _fit(self, items, size):
+        """The longest suffix of items within the budget, always at least the last item."""
+        kept, total = [], 0
+        for item in reversed(items):
+            total += size(item)
+            if kept and total > self.max_chars:
+                break
+            kept.append(item)
+        return kept[::-1]
+
+    def _with_summary(self, summary, dropped, kept, make_entry):
+        if dropped:
+            summary = self.summarize(summary, [(_role(entry), _text(entry)) for entry in dropped])
+            summary = summary[-self.max_summary_chars:]
+        if not summary:
+            return kept
+        return [make_entry(SUMMARY_PREFIX + summary)] + kept
+
+    @staticmethod
+    def _split_summary(messages):
+        if messages and _is_summary(messages[0]):
+            return _text(messages[0])[len(SUMMARY_PREFIX):], messages[1:]
+        return "", messages
+
+    @staticmethod
+    def _deduplicate(messages):
+        """Removes repeated messages, by message ID where available, keeping the first occurrence."""
+        seen = set()
+        unique = []
+        for message in messages:
+            key = getattr(message, "id", None) or id(message)
+            if key not in seen:
+                seen.add(key)
+                unique.append(message)
+        return unique
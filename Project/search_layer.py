@@ -0,0 +1,143 @@
+"""Search layer with a normalized-query TTL cache, in-flight request coalescing and parallel query variants."""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# How long search results are reused, in seconds.
+TTL_SECONDS = 60 * 60
+
+# Maximum number of cached queries, the least recently used ones are evicted.
+MAX_ENTRIES = 1024
+
+# Maximum number of backend requests running at the same time.
+MAX_WORKERS = 4
+
+# Maximum number of merged results returned by search().
+MAX_RESULTS = 8
+
+
+def normalize_query(query):
+    """Lowercases the query and removes punctuation and repeated whitespace."""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+def video_variants(query):
+    """Default query variants for finding videos explaining a problem."""
+    return [query, f"{query} youtube", f"{query} explanation video"]
+
+
+def format_results(results):
+    return "\n".join(f"{result.get('title', '')}: {result.get('link', '')}" for result in results)
+
+
+class SearchLayer:
+    """
+    Runs searches through a backend with caching. Identical (normalized) queries within the TTL are
+    answered from the cache, and concurrent identical queries share one backend request. A search
+    fans out its query variants in parallel, and merges and deduplicates their results.
+    """
+
+    def __init__(self, backend, variants=video_variants, ttl_seconds=TTL_SECONDS, max_entries=MAX_ENTRIES,
+                 max_workers=MAX_WORKERS):
+        """
+        :param backend: Function returning a list of result dicts with "title", "link" and "snippet" for a query,
+                        e.g. DuckDuckGoSearchAPIWrapper().results with a fixed max_results.
+        :param variants: Function returning the query variants to search for a query.
+        :param ttl_seconds: How long results are cached.
+        :param max_entries: The maximum number of cached queries.
+        :param max_workers: The maximum number of concurrent backend requests.
+        """
+        self.backend = backend
+        self.variants = variants
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0}
+        self._cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+
+    def search(self, query, max_results=MAX_RESULTS, timeout=None):
+        """
+        Searches all variants of the query in parallel.
+
+        :param query: The search query.
+        :param max_results: The maximum number of results.
+        :param timeout: Optional time limit in seconds. Variants without results by then are left out, their
+                        requests finish in the background and are cached.
+        :return: The merged results, formatted one per line.
+        :raises TimeoutError: If no variant returned results within the timeout.
+        """
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        variants = list(dict.fromkeys(normalize_query(variant) for variant in self.variants(query)))
+        futures = [self._fetch(variant) for variant in variants]
+
+        result_lists, errors = [], []
+        for future in futures:
+            try:
+                result_lists.append(
+                    future.result(None if expires_at is None else max(0.0, expires_at - time.monotonic()))
+                )
+            except FutureTimeoutError:
+                errors.append(TimeoutError(f"No search results within {timeout}s."))
+            except Exception as error:
+                errors.append(error)
+        if not result_lists:
+            raise errors[0]
+
+        # Interleave the variants' results, so every variant contributes its best results first
+        merged, seen = [], set()
+        for rank in range(max(len(results) for results in result_lists)):
+            for results in result_lists:
+                if rank < len(results):
+                    link = results[rank].get("link", "").rstrip("/")
+                    if link not in seen:
+                        seen.add(link)
+                        merged.append(results[rank])
+        return format_results(merged[:max_results])
+
+    def stats(self):
+        """
+        :return: The hit, miss and coalesced counters and the hit rate; coalesced requests count as hits.
+        """
+        with self._lock:
+            stats = dict(self.counters, entries=len(self._cache))
+        lookups = stats["hits"] + stats["coalesced"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else 0.0
+        return stats
+
+    def _fetch(self, query):
+        """
+        Returns a future of the results of one normalized query, from the cache, a running request,
+        or a new backend request.
+        """
+        with self._lock:
+            entry = self._cache.get(query)
+            if entry is not None and entry[0] > time.monotonic():
+                self._cache.move_to_end(query)
+                self.counters["hits"] += 1
+                future = Future()
+                future.set_result(entry[1])
+                return future
+            if query in self._in_flight:
+                self.counters["coalesced"] += 1
+                return self._in_flight[query]
+
+            self.counters["misses"] += 1
+            future = self._executor.submit(self.backend, query)
+            self._in_flight[query] = future
+        future.add_done_callback(lambda done: self._store(query, done))
+        return future
+
+    def _store(self, query, future):
+        with self._lock:
+            self._in_flight.pop(query, None)
+            if future.exception() is not None:
+                return
+            self._cache[query] = (time.monotonic() + self.ttl_seconds, future.result())
+            self._cache.move_to_end(query)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
@@ -0,0 +1,136 @@
+"""Similarity-based answer cache for near-duplicate requests, using TF-IDF over normalized queries."""
+
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+# Minimum cosine similarity for a cached answer to be reused.
+SIMILARITY_THRESHOLD = 0.85
+
+# Maximum number of cached answers per topic, the least recently used ones are evicted.
+MAX_ENTRIES_PER_TOPIC = 32
+
+STOP_WORDS = {
+    "a", "an", "the", "me", "give", "please", "can", "could", "you", "i", "want", "need", "some",
+    "problem", "question", "task", "on", "about", "for", "with", "of", "in", "to", "and", "or",
+}
+
+# Words that make a request depend on the conversation, such requests always go to the agent.
+FOLLOW_UP_WORDS = {
+    "this", "that", "it", "its", "again", "another", "different", "other", "previous", "last", "next",
+    "more", "hint", "solution", "answer", "explain", "why", "wrong", "correct", "my",
+}
+
+TOPICS = {
+    "graph": {"graph", "graphs", "bfs", "dfs", "dijkstra", "topological"},
+    "tree": {"tree", "trees", "bst", "trie"},
+    "dynamic_programming": {"dp", "dynamic", "programming", "memoization", "knapsack"},
+    "array": {"array", "arrays", "subarray", "matrix"},
+    "string": {"string", "strings", "substring", "palindrome"},
+    "linked_list": {"linked", "list"},
+}
+
+
+def tokenize(query):
+    """Lowercased words of the query without punctuation and stop words."""
+    return [word for word in re.findall(r"\w+", query.lower()) if word not in STOP_WORDS]
+
+
+def topic_of(tokens):
+    for topic, words in TOPICS.items():
+        if words.intersection(tokens):
+            return topic
+    return "general"
+
+
+class SemanticCache:
+    """
+    Caches answers by query similarity. Queries are compared with TF-IDF weighted cosine similarity, so
+    "give me a medium graph problem" and "give me a graph problem, medium" share one answer. Entries are
+    grouped by topic, each topic holds at most max_entries_per_topic answers.
+    """
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries_per_topic=MAX_ENTRIES_PER_TOPIC):
+        """
+        :param threshold: The minimum similarity for a hit.
+        :param max_entries_per_topic: The capacity of each topic.
+        """
+        self.threshold = threshold
+        self.max_entries_per_topic = max_entries_per_topic
+        self.counters = {"hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+        self._topics = {}
+        self._document_frequency = Counter()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_follow_up(query):
+        """True if the query refers to the conversation, e.g. "give me a hint for this"."""
+        return bool(FOLLOW_UP_WORDS.intersection(re.findall(r"\w+", query.lower())))
+
+    def get(self, query, bypass=False):
+        """
+        :param query: The request.
+        :param bypass: If True, the cache is not consulted, e.g. for turns that depend on the context.
+        :return: The cached answer of the most similar query above the threshold, or None.
+        """
+        if bypass or self.is_follow_up(query):
+            with self._lock:
+                self.counters["bypassed"] += 1
+            return None
+
+        tokens = tokenize(query)
+        with self._lock:
+            entries = self._topics.get(topic_of(tokens), OrderedDict())
+            vector = self._vector(tokens)
+            best_key, best_similarity = None, 0.0
+            for key, (entry_tokens, _) in entries.items():
+                entry_vector = self._vector(entry_tokens)
+                similarity = sum(weight * entry_vector.get(term, 0.0) for term, weight in vector.items())
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is None or best_similarity < self.threshold:
+                self.counters["misses"] += 1
+                return None
+            entries.move_to_end(best_key)
+            self.counters["hits"] += 1
+            return entries[best_key][1]
+
+    def put(self, query, answer):
+        """
+        Caches the answer to the query, unless the query depends on the conversation.
+        """
+        if self.is_follow_up(query):
+            return
+        tokens = tokenize(query)
+        if not tokens:
+            return
+        key = " ".join(sorted(set(tokens)))
+        with self._lock:
+            entries = self._topics.setdefault(topic_of(tokens), OrderedDict())
+            if key not in entries:
+                self._document_frequency.update(set(tokens))
+            entries[key] = (tokens, answer)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries_per_topic:
+                evicted, _ = entries.popitem(last=False)
+                self._document_frequency.subtract(evicted.split())
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, entries=sum(len(entries) for entries in self._topics.values()))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _vector(self, tokens):
+        """Normalized TF-IDF vector of the tokens. Must be called with the lock held."""
+        documents = sum(len(entries) for entries in self._topics.values()) + 1
+        vector = {
+            term: count * (1.0 + math.log(documents / (1 + self._document_frequency[term])))
+            for term, count in Counter(tokens).items()
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
@@ -0,0 +1,224 @@
+"""Deterministic local stand-ins for the AWS and search backends used by the benchmarks."""
+
+import itertools
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+def text_message_events(text, chunk_size=16):
+    """converse_stream events of an assistant message with text only."""
+    events = [{"messageStart": {"role": "assistant"}}]
+    for start in range(0, len(text), chunk_size):
+        events.append({"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": text[start:start + chunk_size]}}})
+    events.append({"contentBlockStop": {"contentBlockIndex": 0}})
+    events.append({"messageStop": {"stopReason": "end_turn"}})
+    events.append({"metadata": {"usage": {"inputTokens": 0, "outputTokens": len(text) // 4}, "metrics": {"latencyMs": 0}}})
+    return events
+
+
+def tool_use_message_events(tool_use_id, name, tool_input, text="Saving the code.", chunk_size=64):
+    """converse_stream events of an assistant message with a text block and one tool use request."""
+    events = [
+        {"messageStart": {"role": "assistant"}},
+        {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": text}}},
+        {"contentBlockStop": {"contentBlockIndex": 0}},
+        {"contentBlockStart": {"contentBlockIndex": 1, "start": {"toolUse": {"toolUseId": tool_use_id, "name": name}}}},
+    ]
+    raw_input = json.dumps(tool_input)
+    for start in range(0, len(raw_input), chunk_size):
+        events.append({"contentBlockDelta": {"contentBlockIndex": 1, "delta": {"toolUse": {"input": raw_input[start:start + chunk_size]}}}})
+    events.append({"contentBlockStop": {"contentBlockIndex": 1}})
+    events.append({"messageStop": {"stopReason": "tool_use"}})
+    events.append({"metadata": {"usage": {"inputTokens": 0, "outputTokens": len(raw_input) // 4}, "metrics": {"latencyMs": 0}}})
+    return events
+
+
+def code_generation_script(tool_turns=1, code_bytes=4096, test_runs=False):
+    """
+    A recorded code generation conversation: tool_turns SaveToS3Tool requests with code of code_bytes,
+    each preceded by a passing RunPythonTool test run of the code if test_runs, followed by the final answer.
+    """
+    script = []
+    for turn in range(tool_turns):
+        code = f"# revision {turn}\n" + "x = 1\n" * (code_bytes // 6)
+        if test_runs:
+            script.append(tool_use_message_events(
+                f"tooluse-test-{turn}", "RunPythonTool", {"code": code, "tests": "assert x == 1"}, text="Testing the code."
+            ))
+        script.append(tool_use_message_events(f"tooluse-{turn}", "SaveToS3Tool", {"code": code}))
+    script.append(text_message_events("The code was saved to S3. " * 8))
+    return script
+
+
+class FakeBedrockRuntime:
+    """
+    bedrock-runtime stand-in that replays a recorded conversation. The n-th call of a conversation
+    (counted by the number of assistant messages already in the request) gets the n-th recorded response,
+    after latency_ms (or the model's entry in model_latency_ms) plus per_kb_ms for every KB of request payload.
+    """
+
+    def __init__(self, script, latency_ms=50, per_kb_ms=0.0, model_latency_ms=None):
+        self.script = script
+        self.latency_ms = latency_ms
+        self.per_kb_ms = per_kb_ms
+        self.model_latency_ms = model_latency_ms or {}
+        self.payload_bytes = []
+        # (model ID, turn) of every call
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def converse_stream(self, **request):
+        payload = len(json.dumps(request["messages"]).encode("utf-8"))
+        turn = sum(1 for message in request["messages"] if message["role"] == "assistant")
+        with self._lock:
+            self.payload_bytes.append(payload)
+            self.calls.append((request["modelId"], turn))
+        latency_ms = self.model_latency_ms.get(request["modelId"], self.latency_ms)
+        time.sleep((latency_ms + self.per_kb_ms * payload / 1024) / 1000)
+        events = json.loads(json.dumps(self.script[min(turn, len(self.script) - 1)]))
+        for event in events:
+            if "metadata" in event:
+                event["metadata"]["usage"]["inputTokens"] = payload // 4
+                event["metadata"]["metrics"]["latencyMs"] = latency_ms
+        return {"stream": iter(events)}
+
+
+class FakeS3:
+    """In-memory S3 client stand-in, used when moto is not installed."""
+
+    def __init__(self, latency_ms=20):
+        self.latency_ms = latency_ms
+        self.objects = {}
+        self.requests = 0
+
+    def _request(self):
+        self.requests += 1
+        time.sleep(self.latency_ms / 1000)
+
+    def head_object(self, Bucket, Key):
+        self._request()
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._request()
+        self.objects[(Bucket, Key)] = Body
+
+    def upload_fileobj(self, fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        self._request()
+        self.objects[(Bucket, Key)] = fileobj.read()
+
+
+class SerializedClient:
+    """
+    Passes the calls to a client one at a time. moto's in-memory S3 is not safe for concurrent writes to
+    the same key (the buffer of an overwritten object is closed while another request still reads it), S3 is.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+
+        return call
+
+
+class FakeIAM:
+    def create_role(self, RoleName, AssumeRolePolicyDocument):
+        return {"Role": {"Arn": f"arn:aws:iam::000000000000:role/{RoleName}"}}
+
+    def put_role_policy(self, **kwargs):
+        return {}
+
+    def delete_role_policy(self, **kwargs):
+        return {}
+
+    def delete_role(self, **kwargs):
+        return {}
+
+
+class FakeBedrockAgent:
+    """
+    bedrock-agent stand-in with the provisioning state machine of the real service: every transition
+    (CREATING -> NOT_PREPARED, PREPARING -> PREPARED, alias CREATING -> PREPARED) takes transition_seconds.
+    """
+
+    def __init__(self, transition_seconds=1.0):
+        self.transition_seconds = transition_seconds
+        self.polls = 0
+        self._agents = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def _status(self, resource, final):
+        self.polls += 1
+        if time.monotonic() - resource["since"] >= self.transition_seconds:
+            resource["status"] = final
+        return resource["status"]
+
+    def create_agent(self, **kwargs):
+        with self._lock:
+            agent_id = f"AGENT{next(self._ids):05d}"
+        self._agents[agent_id] = {"status": "CREATING", "since": time.monotonic()}
+        return {"agent": {"agentId": agent_id, "agentStatus": "CREATING"}}
+
+    def get_agent(self, agentId):
+        agent = self._agents[agentId]
+        final = "PREPARED" if agent["status"] in ("PREPARING", "PREPARED") else "NOT_PREPARED"
+        return {"agent": {"agentId": agentId, "agentStatus": self._status(agent, final)}}
+
+    def create_agent_action_group(self, **kwargs):
+        return {"agentActionGroup": {"actionGroupId": "ACTIONGROUP", "actionGroupState": "ENABLED"}}
+
+    def get_agent_action_group(self, **kwargs):
+        return {"agentActionGroup": {"actionGroupState": "ENABLED"}}
+
+    def prepare_agent(self, agentId):
+        self._agents[agentId].update(status="PREPARING", since=time.monotonic())
+        return {"agentStatus": "PREPARING"}
+
+    def create_agent_alias(self, agentId, agentAliasName):
+        self._agents[agentId]["alias"] = {"status": "CREATING", "since": time.monotonic()}
+        return {"agentAlias": {"agentAliasId": f"ALIAS{agentId[5:]}", "agentAliasStatus": "CREATING"}}
+
+    def get_agent_alias(self, agentId, agentAliasId):
+        if agentId not in self._agents:
+            raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": ""}}, "GetAgentAlias")
+        return {"agentAlias": {"agentAliasStatus": self._status(self._agents[agentId]["alias"], "PREPARED")}}
+
+    def delete_agent_alias(self, **kwargs):
+        return {}
+
+    def delete_agent(self, agentId, **kwargs):
+        self._agents.pop(agentId, None)
+        return {}
+
+
+class FakeSearch:
+    """Search backend stand-in returning deterministic results after latency_ms."""
+
+    def __init__(self, latency_ms=100, results=5):
+        self.latency_ms = latency_ms
+        self.results = results
+        self.calls = 0
+
+    def __call__(self, query):
+        self.calls += 1
+        time.sleep(self.latency_ms / 1000)
+        slug = "-".join(query.split())
+        return [
+            {"title": f"{query} #{rank}", "link": f"https://www.youtube.com/watch?v={slug}-{rank}", "snippet": query}
+            for rank in range(self.results)
+        ]
@@ -0,0 +1,561 @@
+"""
+Offline benchmark suite. Runs the code generation loop, the S3 tool, agent provisioning and the app's
+search, history and conversation store against the local stand-ins in fakes.py, reports latency
+percentiles, payload bytes, memory growth, throughput and the import time of the command line entry
+points, and fails if a metric crosses its threshold.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--only NAME ...] [--sessions N] [--json PATH] [--histograms] [--no-thresholds]
+
+S3 is simulated with moto if it is installed, otherwise with an in-memory stand-in.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "HW6"), os.path.join(ROOT, "Project"), os.path.dirname(os.path.abspath(__file__))]
+
+import fakes
+
+BENCHMARK_BUCKET = "benchmark-bucket"
+
+# Latency of every fake Converse call, in milliseconds.
+MODEL_LATENCY_MS = 50
+
+# Default number of concurrent sessions of the throughput benchmark.
+SESSIONS = 32
+
+# HW6 modules run as command line entry points, their import time is measured in a fresh interpreter.
+ENTRY_POINT_MODULES = ("tool_usage", "batch_runner", "code_executor_agent", "agent_registry")
+
+# Regression thresholds: metric -> ("max" or "min", limit). Overheads exclude the simulated latencies.
+THRESHOLDS = {
+    # The measurement is isolated from the garbage of other benchmarks and measured 11-25 ms across runs
+    "writer.turn_overhead_p95_ms": ("max", 40),
+    "writer.payload_bytes_max": ("max", 64 * 1024),
+    "routing.code_generation_off_default": ("max", 0),
+    "long_conversation.compacted_payload_bytes_max": ("max", 48 * 1024),
+    "long_conversation.memory_peak_kb": ("max", 4 * 1024),
+    "sessions.memory_growth_kb_per_session": ("max", 64),
+    "throughput.failed": ("max", 0),
+    "throughput.parallel_efficiency": ("min", 0.5),
+    "s3.save_p95_ms": ("max", 150),
+    "provisioning.overshoot_seconds": ("max", 6),
+    "provisioning.reuse_seconds": ("max", 0.5),
+    "search.p95_ms": ("max", 750),
+    "search.hit_rate": ("min", 0.5),
+    "history.bound_p95_ms": ("max", 5),
+    "history.bounded_chars_max": ("max", 16 * 1024),
+    "store.load_page_p95_ms": ("max", 5),
+    "sandbox.run_p95_ms": ("max", 100),
+    "imports.tool_usage_ms": ("max", 150),
+    "imports.batch_runner_ms": ("max", 175),
+    "imports.code_executor_agent_ms": ("max", 75),
+    "imports.agent_registry_ms": ("max", 50),
+    # The local stand-in of botocore imports too fast to show in the budgets above, loading it at all counts
+    "imports.code_executor_agent_loads_botocore": ("max", 0),
+    "imports.agent_registry_loads_botocore": ("max", 0),
+}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of the values, q between 0 and 100."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def _install_config():
+    """The benchmarks upload to BENCHMARK_BUCKET, the user's config.py is not needed."""
+    config = types.ModuleType("config")
+    config.bucket_name = BENCHMARK_BUCKET
+    sys.modules["config"] = config
+
+
+@contextlib.contextmanager
+def _s3_backend():
+    """
+    Points SaveToS3Tool to a simulated bucket and resets its per-process state.
+
+    :return: The name of the simulation, "moto" or "in-memory".
+    """
+    import save_to_s3_tool
+
+    try:
+        from moto import mock_aws
+    except ImportError:
+        mock_aws = None
+
+    with (mock_aws() if mock_aws else contextlib.nullcontext()):
+        if mock_aws:
+            import boto3
+
+            client = boto3.client("s3", region_name="us-east-1")
+            client.create_bucket(Bucket=BENCHMARK_BUCKET)
+            # The client is shared by the sessions of the concurrent benchmarks
+            client = fakes.SerializedClient(client)
+        else:
+            client = fakes.FakeS3()
+        save_to_s3_tool._s3_client = client
+        save_to_s3_tool._known_hashes.clear()
+        save_to_s3_tool._alias_hashes.clear()
+        save_to_s3_tool._alias_save_numbers.clear()
+        try:
+            yield "moto" if mock_aws else "in-memory"
+        finally:
+            save_to_s3_tool._s3_client = None
+
+
+def _writer(script, writer_class=None, latency_ms=MODEL_LATENCY_MS, model_latency_ms=None, **kwargs):
+    import tool_usage
+    from utils.rate_limiter import RateLimiter
+
+    runtime = fakes.FakeBedrockRuntime(script, latency_ms=latency_ms, model_latency_ms=model_latency_ms)
+    writer_class = writer_class or tool_usage.BackendWriter
+    # The stand-in has no quota, the account's quotas would dominate every latency
+    unlimited = RateLimiter(default_rate=10_000, default_burst=10_000)
+    return writer_class(bedrock_runtime_client=runtime, rate_limiter=unlimited, **kwargs), runtime
+
+
+def _conversation_timings(writer, prompt, max_turns):
+    """
+    Runs one conversation and measures each model turn (request to messageStop) and each round of tools.
+    """
+    model_turns, tool_rounds = [], []
+    mark = time.perf_counter()
+    for event in writer.stream(prompt, max_turns=max_turns):
+        now = time.perf_counter()
+        if event["type"] == "message_stop":
+            model_turns.append(now - mark)
+            mark = now
+        elif event["type"] == "tool_result":
+            tool_rounds.append(now - mark)
+            mark = now
+    return model_turns, tool_rounds
+
+
+@contextlib.contextmanager
+def _isolated():
+    """
+    Collects the garbage left by earlier benchmarks and pauses the garbage collector, so a latency
+    measurement does not pay for collections of objects it did not create.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+def bench_writer(sessions):
+    """Per-turn latency and payload size of the streamed code generation loop, one session at a time."""
+    writer, runtime = _writer(fakes.code_generation_script(tool_turns=2))
+    model_turns, tool_rounds = [], []
+    with _s3_backend():
+        # The first conversation creates the clients and worker threads, it is not measured
+        _conversation_timings(writer, "Warm-up", max_turns=5)
+        with _isolated():
+            for session in range(sessions):
+                turns, tools = _conversation_timings(writer, f"Write backend #{session}", max_turns=5)
+                model_turns += turns
+                tool_rounds += tools
+    turn_p95_ms = percentile(model_turns, 95) * 1000
+    return {
+        "turn_p50_ms": percentile(model_turns, 50) * 1000,
+        "turn_p95_ms": turn_p95_ms,
+        "turn_overhead_p95_ms": turn_p95_ms - MODEL_LATENCY_MS,
+        "tool_p95_ms": percentile(tool_rounds, 95) * 1000,
+        "payload_bytes_mean": sum(runtime.payload_bytes) / len(runtime.payload_bytes),
+        "payload_bytes_max": max(runtime.payload_bytes),
+    }
+
+
+def bench_routing(sessions):
+    """
+    Turn latency with and without the model router, with a slower code generation model than
+    summarization model. Code generation turns, including the one after a passing test run, must stay
+    on the default model.
+    """
+    import tool_usage
+    from tool_usage import SupportedModels
+
+    model_latency_ms = {
+        SupportedModels.CLAUDE_SONNET.value: 4 * MODEL_LATENCY_MS,
+        SupportedModels.CLAUDE_3_5_SONNET.value: 3 * MODEL_LATENCY_MS,
+        SupportedModels.CLAUDE_HAIKU.value: MODEL_LATENCY_MS,
+    }
+    # The first call writes the code and the second acts on its test run, the last one summarizes the save
+    script = fakes.code_generation_script(tool_turns=1, test_runs=True)
+    code_generation_turns = 2
+    metrics = {}
+    with _s3_backend():
+        for name, router in (("baseline_", None), ("", tool_usage.default_model_router())):
+            writer, runtime = _writer(script, model_latency_ms=model_latency_ms, router=router)
+            code_turns, summary_turns = [], []
+            for session in range(sessions):
+                model_turns = _conversation_timings(writer, f"Write backend #{session}", max_turns=5)[0]
+                code_turns += model_turns[:code_generation_turns]
+                summary_turns += model_turns[code_generation_turns:]
+            metrics[f"{name}turn_mean_ms"] = sum(code_turns + summary_turns) / len(code_turns + summary_turns) * 1000
+            metrics[f"{name}code_turn_p50_ms"] = percentile(code_turns, 50) * 1000
+            metrics[f"{name}summary_turn_p50_ms"] = percentile(summary_turns, 50) * 1000
+        metrics["code_generation_off_default"] = sum(
+            1 for model_id, turn in runtime.calls if turn < code_generation_turns and model_id != tool_usage.MODEL_ID
+        )
+    return metrics
+
+
+def bench_long_conversation(sessions):
+    """Payload and memory of a conversation with many large tool inputs, with and without compaction."""
+    from conversation_compactor import ConversationCompactor
+
+    script = fakes.code_generation_script(tool_turns=10, code_bytes=16 * 1024)
+    metrics = {}
+    with _s3_backend():
+        for name, compactor in (("", None), ("compacted_", ConversationCompactor(max_bytes=32 * 1024))):
+            writer, runtime = _writer(script, latency_ms=1, compactor=compactor)
+            tracemalloc.start()
+            _conversation_timings(writer, "Write a large backend", max_turns=12)
+            metrics[f"{name}memory_peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+            metrics[f"{name}payload_bytes_max"] = max(runtime.payload_bytes)
+            metrics[f"{name}payload_bytes_total"] = sum(runtime.payload_bytes)
+    # Memory is tracked for the compacted run, which is the configuration meant for long conversations
+    metrics["memory_peak_kb"] = metrics.pop("compacted_memory_peak_kb")
+    return metrics
+
+
+def bench_sessions(sessions):
+    """Memory retained per finished session by a long-lived writer, a leak shows up as steady growth."""
+    writer, _ = _writer(fakes.code_generation_script(tool_turns=1), latency_ms=1)
+    with _s3_backend():
+        # The first session pays for lazily created clients and caches
+        _conversation_timings(writer, "Warm up", max_turns=5)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for session in range(sessions):
+            _conversation_timings(writer, f"Write backend #{session}", max_turns=5)
+        growth = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+    return {"memory_growth_kb_per_session": growth / 1024 / sessions}
+
+
+def _tool_errors(conversation):
+    """:return: The error responses of the tools in the conversation."""
+    return [
+        content["json"]
+        for message in conversation
+        for content_block in message["content"]
+        if "toolResult" in content_block
+        for content in content_block["toolResult"]["content"]
+        if isinstance(content.get("json"), dict) and content["json"].get("error")
+    ]
+
+
+def bench_throughput(sessions):
+    """
+    Conversations per second with `sessions` conversations running concurrently on one event loop.
+    The parallel efficiency is the speedup over running them one after another, relative to the
+    number of model calls allowed in flight.
+    """
+    import tool_usage
+
+    writer, runtime = _writer(fakes.code_generation_script(tool_turns=2), writer_class=tool_usage.AsyncBackendWriter)
+
+    async def run_all(count):
+        return await asyncio.gather(*(
+            writer.run(f"Write backend #{session}", max_turns=5) for session in range(count)
+        ))
+
+    with _s3_backend():
+        start = time.perf_counter()
+        asyncio.run(run_all(1))
+        sequential = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = asyncio.run(run_all(sessions))
+        elapsed = time.perf_counter() - start
+    # A conversation whose tools failed is not counted, even if the model finished it
+    completed = sum(
+        1 for result in results
+        if result["status"] == tool_usage.ConversationStatus.COMPLETE.value and not _tool_errors(result["conversation"])
+    )
+    speedup = sessions * sequential / elapsed
+    return {
+        "sessions": sessions,
+        "completed": completed,
+        "failed": sessions - completed,
+        "seconds": elapsed,
+        "conversations_per_second": completed / elapsed,
+        "model_calls_per_second": len(runtime.payload_bytes) / elapsed,
+        "parallel_efficiency": speedup / min(sessions, tool_usage.MAX_CONCURRENT_MODEL_CALLS),
+    }
+
+
+def bench_s3(sessions):
+    """Latency of SaveToS3 for new and already uploaded code, including small and compressed artifacts."""
+    import save_to_s3_tool
+
+    codes = [f"# module {index}\n" + "print('hello')\n" * (index * 200) for index in range(sessions)]
+    timings, duplicate_timings = [], []
+    with _s3_backend() as backend:
+        for code in codes:
+            start = time.perf_counter()
+            save_to_s3_tool.SaveToS3(code, compress=True)
+            timings.append(time.perf_counter() - start)
+        for code in codes:
+            start = time.perf_counter()
+            save_to_s3_tool.SaveToS3(code, compress=True)
+            duplicate_timings.append(time.perf_counter() - start)
+    return {
+        "backend": backend,
+        "save_p50_ms": percentile(timings, 50) * 1000,
+        "save_p95_ms": percentile(timings, 95) * 1000,
+        "duplicate_save_p95_ms": percentile(duplicate_timings, 95) * 1000,
+    }
+
+
+def bench_provisioning(sessions):
+    """Provisioning time of a code executor agent against the simulated state machine, and reuse time."""
+    from agent_registry import AgentRegistry
+    from code_executor_agent import CodeExecutorAgent
+
+    bedrock_agent = fakes.FakeBedrockAgent(transition_seconds=1.0)
+    with tempfile.TemporaryDirectory() as directory:
+        registry = AgentRegistry(os.path.join(directory, "agents.sqlite3"))
+        start = time.perf_counter()
+        CodeExecutorAgent("benchmark", bedrock_agent_client=bedrock_agent, iam_client=fakes.FakeIAM(), registry=registry)
+        provisioning = time.perf_counter() - start
+        polls = bedrock_agent.polls
+
+        start = time.perf_counter()
+        CodeExecutorAgent("benchmark", bedrock_agent_client=bedrock_agent, iam_client=fakes.FakeIAM(), registry=registry)
+        reuse = time.perf_counter() - start
+    return {
+        "provisioning_seconds": provisioning,
+        # Three transitions of the state machine can not be waited for any faster
+        "overshoot_seconds": provisioning - 3 * bedrock_agent.transition_seconds,
+        "polls": polls,
+        "reuse_seconds": reuse,
+    }
+
+
+def bench_search(sessions):
+    """Latency and hit rate of the search layer with concurrent, partly repeated queries."""
+    from search_layer import SearchLayer
+
+    backend = fakes.FakeSearch(latency_ms=100)
+    search = SearchLayer(backend)
+    queries = [f"Two Sum variant {index % 8}!" for index in range(sessions * 4)]
+
+    def timed(query):
+        start = time.perf_counter()
+        search.search(query)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        timings = list(executor.map(timed, queries))
+    stats = search.stats()
+    return {
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "hit_rate": stats["hit_rate"],
+        "backend_calls": backend.calls,
+    }
+
+
+def bench_history(sessions):
+    """Cost of bounding the agent history per turn over a long session, and the size it is bounded to."""
+    from history_manager import HistoryManager
+
+    manager = HistoryManager()
+    messages, timings, sizes = [], [], []
+    for turn in range(sessions * 10):
+        messages += [("human", f"Question {turn}: " + "details " * 40), ("ai", f"Answer {turn}: " + "steps " * 150)]
+        start = time.perf_counter()
+        messages = manager.bound_messages(messages)
+        timings.append(time.perf_counter() - start)
+        sizes.append(sum(len(str(content)) for _, content in messages))
+    return {
+        "bound_p95_ms": percentile(timings, 95) * 1000,
+        "bounded_chars_max": max(sizes),
+    }
+
+
+def bench_store(sessions):
+    """Append and page load latency of the SQLite conversation store."""
+    from conversation_store import SQLiteConversationStore
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SQLiteConversationStore(os.path.join(directory, "conversations.sqlite3"))
+        appends, loads = [], []
+        for session in range(sessions):
+            session_id = f"session-{session}"
+            for turn in range(20):
+                start = time.perf_counter()
+                store.append(session_id, "human" if turn % 2 == 0 else "ai", f"Message {turn} " * 20)
+                appends.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                store.load_page(session_id)
+                loads.append(time.perf_counter() - start)
+        store.close()
+    return {
+        "append_p95_ms": percentile(appends, 95) * 1000,
+        "load_page_p95_ms": percentile(loads, 95) * 1000,
+    }
+
+
+def bench_sandbox(sessions):
+    """
+    Latency of RunPython in warm sandboxes, with a short pause between runs standing in for the model turn
+    in which the pool replenishes.
+    """
+    from python_sandbox import SandboxPool
+
+    pool = SandboxPool()
+    code = "def add(a, b):\n    return a + b\n"
+    tests = "assert add(1, 2) == 3\nprint('ok')\n"
+    time.sleep(1)
+    timings = []
+    try:
+        for _ in range(sessions):
+            start = time.perf_counter()
+            result = pool.run(code, tests)
+            timings.append(time.perf_counter() - start)
+            if result["status"] != "passed":
+                raise RuntimeError(f"The sandbox run failed: {result['stderr']}")
+            time.sleep(0.1)
+    finally:
+        pool.shutdown()
+    return {
+        "run_p50_ms": percentile(timings, 50) * 1000,
+        "run_p95_ms": percentile(timings, 95) * 1000,
+    }
+
+
+def import_time_ms(module):
+    """
+    Imports the module in a fresh interpreter with -X importtime.
+
+    :return: The cumulative import time of the module in milliseconds, its slowest direct or
+             indirect import as a (name, milliseconds) pair, and whether it loads botocore.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.join(ROOT, "HW6"), os.environ.get("PYTHONPATH")])))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.join(ROOT, "HW6"),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # Lines look like "import time:   self [us] | cumulative | imported package", nested imports are indented
+    cumulative = {}
+    slowest = (None, 0.0)
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, self_us, cumulative_us, name = (part.strip() for part in line.replace("import time:", "|", 1).split("|"))
+        cumulative[name] = int(cumulative_us) / 1000
+        if name != module and int(self_us) / 1000 > slowest[1]:
+            slowest = (name, int(self_us) / 1000)
+    return cumulative[module], slowest, "botocore" in cumulative
+
+
+def bench_imports(sessions):
+    """
+    Import time of the command line entry points in a fresh interpreter, the best of three runs,
+    so short-lived CLI and batch invocations do not pay for dependencies they do not use.
+    """
+    results = {}
+    for module in ENTRY_POINT_MODULES:
+        runs = [import_time_ms(module) for _ in range(3)]
+        total, slowest, loads_botocore = min(runs)
+        results[f"{module}_ms"] = total
+        results[f"{module}_slowest_import"] = f"{slowest[0]} {slowest[1]:.1f}ms"
+        results[f"{module}_loads_botocore"] = int(loads_botocore)
+    return results
+
+
+BENCHMARKS = {
+    "writer": bench_writer,
+    "routing": bench_routing,
+    "long_conversation": bench_long_conversation,
+    "sessions": bench_sessions,
+    "throughput": bench_throughput,
+    "s3": bench_s3,
+    "provisioning": bench_provisioning,
+    "search": bench_search,
+    "history": bench_history,
+    "store": bench_store,
+    "sandbox": bench_sandbox,
+    "imports": bench_imports,
+}
+
+
+def check_thresholds(results):
+    """:return: The metrics that cross their threshold, as (metric, value, kind, limit)."""
+    failures = []
+    for metric, (kind, limit) in THRESHOLDS.items():
+        benchmark, name = metric.split(".", 1)
+        value = results.get(benchmark, {}).get(name)
+        if value is None:
+            continue
+        if (kind == "max" and value > limit) or (kind == "min" and value < limit):
+            failures.append((metric, value, kind, limit))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument("--sessions", type=int, default=SESSIONS, help="Number of sessions per benchmark.")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    parser.add_argument("--histograms", action="store_true",
+                        help="Also report the instrumentation histograms of all spans, see HW6/utils/instrumentation.py.")
+    parser.add_argument("--no-thresholds", action="store_true", help="Report only, never fail.")
+    args = parser.parse_args(argv)
+
+    _install_config()
+    results = {}
+    for name in args.only or BENCHMARKS:
+        # The code under test prints its progress, which is not part of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = BENCHMARKS[name](args.sessions)
+        for metric, value in results[name].items():
+            formatted = f"{value:.3f}" if isinstance(value, float) else value
+            print(f"{name + '.' + metric:<50} {formatted}")
+
+    if args.histograms:
+        from utils import instrumentation
+
+        for metric, summary in instrumentation.histograms().items():
+            print(f"{metric:<50} " + " ".join(f"{key} {value:.1f}" for key, value in summary.items()))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    failures = [] if args.no_thresholds else check_thresholds(results)
+    for metric, value, kind, limit in failures:
+        print(f"REGRESSION {metric}: {value:.3f} (threshold: {kind} {limit})")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())